@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import json
+import os
+import random
+import time
+
+from s54http.compress import (
+    codec_caps,
+    CODECS,
+    StreamCompressor,
+    StreamDecompressor,
+)
+from s54http.scheduler import MAX_CHUNK
+
+
+def _json(size):
+    rows = []
+    length = 0
+    rng = random.Random(1)
+    while length < size:
+        row = json.dumps({
+            'id': rng.randrange(2**32),
+            'name': f'user{rng.randrange(10000)}',
+            'active': rng.random() > 0.5,
+            'score': round(rng.random() * 100, 3),
+            'tags': ['alpha', 'beta', 'gamma'][:rng.randrange(4)],
+        })
+        rows.append(row)
+        length += len(row) + 1
+    return '\n'.join(rows).encode('utf-8')[:size]
+
+
+def _html(size):
+    rng = random.Random(2)
+    words = ['<div class="item">', '</div>', '<a href="/page/', '">',
+             '</a>', 'lorem', 'ipsum', 'dolor', 'sit', 'amet', '\n']
+    out = []
+    length = 0
+    while length < size:
+        word = rng.choice(words)
+        out.append(word)
+        length += len(word) + 1
+    return ' '.join(out).encode('utf-8')[:size]
+
+
+def _random(size):
+    return os.urandom(size)
+
+
+def _tls(size):
+    records = []
+    for offset in range(0, size, MAX_CHUNK):
+        length = min(MAX_CHUNK, size - offset) - 5
+        records.append(b'\x17\x03\x03' + length.to_bytes(2, 'big'))
+        records.append(os.urandom(length))
+    return b''.join(records)
+
+
+PAYLOADS = {
+    'json': _json,
+    'html': _html,
+    'random': _random,
+    'tls': _tls,
+}
+
+
+def run(codec, data, chunk):
+    compressor = StreamCompressor(codec)
+    decompressor = StreamDecompressor(codec)
+    frames = []
+    start = time.process_time()
+    for packed, payload in compressor.split(data, chunk):
+        frames.append((packed, payload))
+    compress = time.process_time() - start
+    start = time.process_time()
+    for packed, payload in frames:
+        if packed:
+            decompressor.decompress(payload)
+    decompress = time.process_time() - start
+    wire = sum(len(payload) for _, payload in frames)
+    return wire, compress, decompress
+
+
+def main():
+    parser = argparse.ArgumentParser('compress')
+    parser.add_argument('--size', type=int, default=2**23)
+    parser.add_argument('--chunk', type=int, default=MAX_CHUNK)
+    parser.add_argument('--codecs', default=','.join(CODECS))
+    args = parser.parse_args()
+    caps = codec_caps(args.codecs)
+    codecs = [(name, cap) for name, cap in CODECS.items() if caps & cap]
+    print(f'{args.size} bytes per stream, {args.chunk} bytes per frame')
+    print(
+        f'{"payload":>8} {"codec":>6} {"ratio":>7} {"saved MB":>9} '
+        f'{"comp MB/s":>10} {"decomp MB/s":>12} {"cpu ms/MB saved":>16}'
+    )
+    for kind, build in PAYLOADS.items():
+        data = build(args.size)
+        for name, codec in codecs:
+            wire, compress, decompress = run(codec, data, args.chunk)
+            saved = (len(data) - wire) / 2**20
+            mb = len(data) / 2**20
+            cost = (compress + decompress) * 1000 / saved if saved > 0 else 0
+            print(
+                f'{kind:>8} {name:>6} {wire / len(data):7.3f} '
+                f'{saved:9.2f} {mb / max(compress, 1e-9):10.1f} '
+                f'{mb / max(decompress, 1e-9):12.1f} {cost:16.2f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
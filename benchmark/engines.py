@@ -0,0 +1,228 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import struct
+import subprocess
+import sys
+import time
+
+
+SERVER_PORT = 18443
+PROXY_PORT = 18080
+ECHO_PORT = 18999
+CHUNK = 2**16
+
+
+async def _echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(CHUNK)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+def _serve_echo(port):
+    async def serve():
+        server = await asyncio.start_server(_echo, '127.0.0.1', port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def _start(module, engine, args, extra):
+    return subprocess.Popen(
+        [
+            sys.executable,
+            '-m',
+            's54http.engine',
+            module,
+            '--engine',
+            engine,
+            '--ca',
+            args.ca,
+            '--loglevel',
+            'ERROR',
+        ] + extra,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+    )
+
+
+async def _socks(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', PROXY_PORT)
+    writer.write(
+        b'\x05\x01\x00\x05\x01\x00\x01\x7f\x00\x00\x01' +
+        struct.pack('!H', port)
+    )
+    reply = await reader.readexactly(12)
+    if reply[:2] != b'\x05\x00' or reply[3] != 0:
+        raise RuntimeError(f'socks connect failed {reply!r}')
+    return reader, writer
+
+
+async def _wait_ready(timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await _socks(ECHO_PORT)
+            writer.write(b'x')
+            await reader.readexactly(1)
+            writer.close()
+            return
+        except (OSError, asyncio.IncompleteReadError, RuntimeError):
+            if time.monotonic() > deadline:
+                raise RuntimeError('proxy not ready')
+            await asyncio.sleep(0.2)
+
+
+async def _stream(size):
+    reader, writer = await _socks(ECHO_PORT)
+    block = os.urandom(CHUNK)
+
+    async def send():
+        sent = 0
+        while sent < size:
+            writer.write(block)
+            await writer.drain()
+            sent += len(block)
+
+    sender = asyncio.ensure_future(send())
+    received = 0
+    while received < size:
+        data = await reader.read(CHUNK * 4)
+        if not data:
+            raise RuntimeError('stream closed early')
+        received += len(data)
+    await sender
+    writer.close()
+    return received
+
+
+async def throughput(streams, size):
+    """
+    MB/s echoed by streams streams at once
+    """
+    started = time.perf_counter()
+    done = await asyncio.gather(*[_stream(size) for _ in range(streams)])
+    return sum(done) / (time.perf_counter() - started) / 2**20
+
+
+async def latency(count):
+    """
+    microseconds of one 64 byte round trip over one stream
+    """
+    reader, writer = await _socks(ECHO_PORT)
+    payload = b'x' * 64
+    samples = []
+    for _ in range(count):
+        started = time.perf_counter()
+        writer.write(payload)
+        await reader.readexactly(len(payload))
+        samples.append(time.perf_counter() - started)
+    writer.close()
+    samples.sort()
+    return (
+        samples[len(samples) // 2] * 1e6,
+        samples[int(len(samples) * 0.99)] * 1e6,
+    )
+
+
+async def connections(count, concurrency):
+    """
+    streams opened, answered once and closed per second
+    """
+    left = [count]
+
+    async def client():
+        while left[0] > 0:
+            left[0] -= 1
+            reader, writer = await _socks(ECHO_PORT)
+            writer.write(b'ping')
+            await reader.readexactly(4)
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return count / (time.perf_counter() - started)
+
+
+async def _measure(args):
+    await _wait_ready()
+    rate = await throughput(args.streams, args.size * 2**20)
+    median, p99 = await latency(args.pings)
+    opened = await connections(args.connections, args.concurrency)
+    return rate, median, p99, opened
+
+
+def run(engine, args):
+    server = _start('s54http.server', engine, args, [
+        '-l', '127.0.0.1',
+        '-p', str(SERVER_PORT),
+        '--key', args.server_key,
+        '--cert', args.server_cert,
+    ])
+    time.sleep(1)
+    proxy = _start('s54http.proxy', engine, args, [
+        '-l', '127.0.0.1',
+        '-p', str(PROXY_PORT),
+        '-S', '127.0.0.1',
+        '-P', str(SERVER_PORT),
+        '--key', args.client_key,
+        '--cert', args.client_cert,
+    ])
+    try:
+        return asyncio.run(_measure(args))
+    finally:
+        for p in (proxy, server):
+            p.terminate()
+            p.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser('engines')
+    parser.add_argument('--ca', default='keys/ca.crt')
+    parser.add_argument('--server-key', default='keys/server.key')
+    parser.add_argument('--server-cert', default='keys/server.crt')
+    parser.add_argument('--client-key', default='keys/client.key')
+    parser.add_argument('--client-cert', default='keys/client.crt')
+    parser.add_argument('--engines', default='twisted,asyncio')
+    parser.add_argument('--streams', type=int, default=8)
+    parser.add_argument('--size', type=int, default=32,
+                        help='MB echoed by every stream')
+    parser.add_argument('--pings', type=int, default=2000)
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args()
+    for name in ('ca', 'server_key', 'server_cert', 'client_key',
+                 'client_cert'):
+        setattr(args, name, os.path.abspath(getattr(args, name)))
+    echo = multiprocessing.Process(
+        target=_serve_echo,
+        args=(ECHO_PORT,),
+        daemon=True
+    )
+    echo.start()
+    try:
+        for engine in args.engines.split(','):
+            rate, median, p99, opened = run(engine, args)
+            print(
+                f'{engine:8} throughput={rate:7.1f}MB/s '
+                f'latency median={median:6.0f}us p99={p99:6.0f}us '
+                f'connections={opened:6.0f}/s'
+            )
+    finally:
+        echo.terminate()
+
+
+if __name__ == '__main__':
+    main()
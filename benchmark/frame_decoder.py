@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import os
+import struct
+import timeit
+
+from s54http.frame import FrameDecoder
+
+
+def _build_stream(count, size):
+    payload = os.urandom(size)
+    frame = struct.pack('!IBI', 9 + size, 3, 1) + payload
+    return frame * count
+
+
+def _chunks(stream, chunk):
+    return [stream[i:i+chunk] for i in range(0, len(stream), chunk)]
+
+
+def decode_bytes(chunks):
+    buffer = b''
+    count = 0
+    for data in chunks:
+        buffer += data
+        while True:
+            if len(buffer) < 4:
+                break
+            length, = struct.unpack('!I', buffer[:4])
+            if len(buffer) < length:
+                break
+            message = memoryview(buffer)[:length]
+            count += len(message) > 0
+            buffer = buffer[length:]
+    return count
+
+
+def decode_frames(chunks):
+    decoder = FrameDecoder()
+    count = 0
+    for data in chunks:
+        for message in decoder.decode(data):
+            count += len(message) > 0
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser('frame_decoder')
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--chunk', type=int, default=2**18)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    stream = _build_stream(args.frames, args.size)
+    chunks = _chunks(stream, args.chunk)
+    assert decode_bytes(chunks) == decode_frames(chunks) == args.frames
+    print(
+        f'{args.frames} frames of {args.size} bytes, '
+        f'{len(chunks)} reads of {args.chunk} bytes'
+    )
+    for name, func in [('bytes', decode_bytes), ('frame', decode_frames)]:
+        elapsed = min(timeit.repeat(
+            lambda: func(chunks),
+            number=1,
+            repeat=args.repeat
+        ))
+        print(
+            f'{name:>6}: {elapsed * 1000:9.2f} ms '
+            f'{args.frames / elapsed:12.0f} frames/s'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import asyncio
+import os
+import resource
+import struct
+import subprocess
+import sys
+import time
+
+
+SERVER_PORT = 18443
+PROXY_PORT = 18080
+TARGET_PORT = 18999
+# ephemeral ports of one source address, more streams spread over more
+# loopback addresses
+PER_ADDRESS = 20000
+
+
+def _raise_nofile():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        # the server and the proxy inherit it
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def _rss(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError(f'no rss for pid {pid}')
+
+
+def _start(module, args, extra):
+    return subprocess.Popen(
+        [
+            sys.executable,
+            '-m',
+            's54http.engine',
+            module,
+            '--engine',
+            args.engine,
+            '--ca',
+            args.ca,
+            '--loglevel',
+            'ERROR',
+        ] + extra,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+    )
+
+
+async def _serve_targets(count, held):
+    async def accept(reader, writer):
+        # tells the stream it reached the end, then idles
+        writer.write(b'x')
+        held.append(writer)
+
+    servers = []
+    for index in range(count):
+        servers.append(await asyncio.start_server(
+            accept,
+            f'127.0.1.{index + 1}',
+            TARGET_PORT,
+            backlog=1024
+        ))
+    return servers
+
+
+async def _open(index, held):
+    group = index // PER_ADDRESS + 1
+    reader, writer = await asyncio.open_connection(
+        '127.0.0.1',
+        PROXY_PORT,
+        local_addr=(f'127.0.2.{group}', 0)
+    )
+    writer.write(
+        b'\x05\x01\x00\x05\x01\x00\x01' +
+        bytes((127, 0, 1, group)) +
+        struct.pack('!H', TARGET_PORT)
+    )
+    reply = await reader.readexactly(12)
+    if reply[:2] != b'\x05\x00' or reply[3] != 0:
+        raise RuntimeError(f'socks connect failed {reply!r}')
+    await reader.readexactly(1)
+    held.append(writer)
+
+
+async def _wait_ready(held, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await _open(0, held)
+            return
+        except (OSError, asyncio.IncompleteReadError, RuntimeError):
+            if time.monotonic() > deadline:
+                raise RuntimeError('proxy not ready')
+            await asyncio.sleep(0.2)
+
+
+async def _measure(args, pids):
+    held = []
+    targets = await _serve_targets(
+        (args.streams - 1) // PER_ADDRESS + 1,
+        held
+    )
+    await _wait_ready(held)
+    await asyncio.sleep(1)
+    before = {name: _rss(pid) for name, pid in pids.items()}
+    opened = list(range(args.streams))
+    started = time.perf_counter()
+
+    async def client():
+        while opened:
+            await _open(opened.pop(), held)
+
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(args.settle)
+    after = {name: _rss(pid) for name, pid in pids.items()}
+    for writer in held:
+        writer.transport.abort()
+    for server in targets:
+        server.close()
+    return before, after, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser('streams')
+    parser.add_argument('--ca', default='keys/ca.crt')
+    parser.add_argument('--server-key', default='keys/server.key')
+    parser.add_argument('--server-cert', default='keys/server.crt')
+    parser.add_argument('--client-key', default='keys/client.key')
+    parser.add_argument('--client-cert', default='keys/client.crt')
+    parser.add_argument('--engine', default='twisted')
+    parser.add_argument('--streams', type=int, default=100000)
+    # connects beyond the listen backlog of the proxy wait for syn retries
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--settle', type=float, default=2,
+                        help='seconds idle before rss is read')
+    args = parser.parse_args()
+    for name in ('ca', 'server_key', 'server_cert', 'client_key',
+                 'client_cert'):
+        setattr(args, name, os.path.abspath(getattr(args, name)))
+    nofile = _raise_nofile()
+    # this process holds both ends of every stream
+    if 2 * args.streams + 64 > nofile:
+        raise RuntimeError(
+            f'{args.streams} streams need {2 * args.streams + 64} '
+            f'open files, the limit is {nofile}'
+        )
+    server = _start('s54http.server', args, [
+        '-l', '127.0.0.1',
+        '-p', str(SERVER_PORT),
+        '--key', args.server_key,
+        '--cert', args.server_cert,
+    ])
+    time.sleep(1)
+    proxy = _start('s54http.proxy', args, [
+        '-l', '127.0.0.1',
+        '-p', str(PROXY_PORT),
+        '-S', '127.0.0.1',
+        '-P', str(SERVER_PORT),
+        '--key', args.client_key,
+        '--cert', args.client_cert,
+        '--tunnel-streams', str(args.streams + 1),
+    ])
+    pids = {'proxy': proxy.pid, 'server': server.pid}
+    try:
+        before, after, elapsed = asyncio.run(_measure(args, pids))
+    finally:
+        for p in (proxy, server):
+            p.terminate()
+            p.wait()
+    print(f'{args.streams} idle streams opened in {elapsed:.1f}s')
+    for name in pids:
+        grown = after[name] - before[name]
+        print(
+            f'{name:6} rss before={before[name] / 2**20:7.1f}MB '
+            f'after={after[name] / 2**20:7.1f}MB '
+            f'per stream={grown / args.streams:6.0f}B'
+        )
+
+
+if __name__ == '__main__':
+    main()
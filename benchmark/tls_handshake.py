@@ -0,0 +1,189 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import socket
+import threading
+import time
+
+from OpenSSL import SSL
+
+from s54http.utils import (
+    SSLCtxFactory,
+    TLS_VERSIONS,
+)
+
+
+class Verified:
+    """
+    counts full handshakes, resumed ones don't verify the peer again
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, x509, errno, errdepth, ok):
+        if 0 == errdepth:
+            self.count += 1
+        return ok
+
+
+def _contexts(args, version):
+    verified = Verified()
+    server = SSLCtxFactory(
+        False,
+        args.ca,
+        args.server_key,
+        args.server_cert,
+        callback=verified,
+        ciphers=args.ciphers,
+        tls_min=version
+    )
+    client = SSLCtxFactory(
+        True,
+        args.ca,
+        args.client_key,
+        args.client_cert,
+        ciphers=args.ciphers,
+        tls_min=version
+    )
+    for factory in (server, client):
+        factory.getContext().set_max_proto_version(TLS_VERSIONS[version])
+    return server, client, verified
+
+
+def _pump(source, target):
+    moved = False
+    while True:
+        try:
+            data = source.bio_read(2**16)
+        except SSL.WantReadError:
+            return moved
+        target.bio_write(data)
+        moved = True
+
+
+def _step(conn):
+    try:
+        conn.do_handshake()
+    except SSL.WantReadError:
+        return False
+    return True
+
+
+def handshake(server_ctx, client_ctx, session=None):
+    """
+    one handshake over memory bios, returns the client session
+    """
+    client = SSL.Connection(client_ctx.getContext(), None)
+    client.set_connect_state()
+    if session is not None:
+        client.set_session(session)
+    server = SSL.Connection(server_ctx.getContext(), None)
+    server.set_accept_state()
+    client_done = server_done = False
+    while not (client_done and server_done):
+        client_done = _step(client) or client_done
+        _pump(client, server)
+        server_done = _step(server) or server_done
+        _pump(server, client)
+    # tls 1.3 tickets go out with the first data of the server
+    server.send(b'x')
+    _pump(server, client)
+    client.recv(1)
+    # openssl spoils the session of a connection never shut down
+    client.shutdown()
+    return client.get_session()
+
+
+def memory_rate(server_ctx, client_ctx, count, resume):
+    session = handshake(server_ctx, client_ctx)
+    started = time.perf_counter()
+    for _ in range(count):
+        reused = session if resume else None
+        session = handshake(server_ctx, client_ctx, reused)
+    return count / (time.perf_counter() - started)
+
+
+def _serve(listener, server_ctx, count):
+    for _ in range(count):
+        sock, _ = listener.accept()
+        conn = SSL.Connection(server_ctx.getContext(), sock)
+        conn.set_accept_state()
+        conn.do_handshake()
+        conn.sendall(b'x')
+        conn.shutdown()
+        sock.close()
+
+
+def reconnect_latency(server_ctx, client_ctx, count, resume):
+    """
+    milliseconds from connect to the first byte over loopback
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    address = listener.getsockname()
+    thread = threading.Thread(
+        target=_serve,
+        args=(listener, server_ctx, count + 1),
+        daemon=True
+    )
+    thread.start()
+    session = None
+    latencies = []
+    for _ in range(count + 1):
+        started = time.perf_counter()
+        sock = socket.create_connection(address)
+        conn = SSL.Connection(client_ctx.getContext(), sock)
+        conn.set_connect_state()
+        if resume and session is not None:
+            conn.set_session(session)
+        conn.do_handshake()
+        conn.recv(1)
+        latencies.append(time.perf_counter() - started)
+        session = conn.get_session()
+        conn.shutdown()
+        sock.close()
+    thread.join()
+    listener.close()
+    # the first one never resumes
+    latencies = sorted(latencies[1:])
+    return (
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.9)] * 1000,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser('tls_handshake')
+    parser.add_argument('--ca', default='keys/ca.crt')
+    parser.add_argument('--server-key', default='keys/server.key')
+    parser.add_argument('--server-cert', default='keys/server.crt')
+    parser.add_argument('--client-key', default='keys/client.key')
+    parser.add_argument('--client-cert', default='keys/client.crt')
+    parser.add_argument('--ciphers', default='auto')
+    parser.add_argument('--count', type=int, default=200)
+    args = parser.parse_args()
+    for version in ('1.2', '1.3'):
+        for resume in (False, True):
+            server_ctx, client_ctx, verified = _contexts(args, version)
+            rate = memory_rate(server_ctx, client_ctx, args.count, resume)
+            full = verified.count
+            median, p90 = reconnect_latency(
+                server_ctx,
+                client_ctx,
+                args.count,
+                resume
+            )
+            print(
+                f'tls {version} resume={"yes" if resume else "no ":3} '
+                f'{rate:8.1f} handshakes/s '
+                f'full={full:4} of {args.count + 1:4} '
+                f'reconnect median={median:6.2f}ms p90={p90:6.2f}ms'
+            )
+
+
+if __name__ == '__main__':
+    main()
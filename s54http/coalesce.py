@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+
+from twisted.internet import reactor
+
+
+__all__ = [
+    'COALESCE_DELAY',
+    'WriteCoalescer',
+]
+
+
+# microseconds to hold frames, 0 flushes at the end of the reactor iteration
+COALESCE_DELAY = 0
+# pending bytes flushed at once without waiting
+COALESCE_LIMIT = 2**16
+
+
+class WriteCoalescer:
+    """
+    gathers the frames written to a tunnel during one reactor iteration,
+    or within delay microseconds, into one write to the transport.
+    """
+
+    __slots__ = [
+        'transport',
+        'delay',
+        'bypass',
+        'records',
+        'writes',
+        'bytes',
+        '_parts',
+        '_size',
+        '_call',
+    ]
+
+    def __init__(self, transport, *, delay=COALESCE_DELAY):
+        self.transport = transport
+        self.delay = delay
+        self.bypass = delay < 0
+        self.records = 0
+        self.writes = 0
+        self.bytes = 0
+        self._parts = []
+        self._size = 0
+        self._call = None
+
+    @property
+    def recordsPerWrite(self):
+        return self.records / self.writes if self.writes else 0.0
+
+    @property
+    def bytesPerWrite(self):
+        return self.bytes / self.writes if self.writes else 0.0
+
+    def stats(self):
+        return {
+            'writes': self.writes,
+            'records': self.records,
+            'bytes': self.bytes,
+            'records_per_write': self.recordsPerWrite,
+            'bytes_per_write': self.bytesPerWrite,
+        }
+
+    def setBypass(self, bypass):
+        bypass = bypass or self.delay < 0
+        if bypass and self._parts:
+            self.flush()
+        self.bypass = bypass
+
+    def write(self, data):
+        self.writeSequence((data,))
+
+    def writeSequence(self, seq):
+        if self.bypass:
+            data = b''.join(seq)
+            self.records += 1
+            self.writes += 1
+            self.bytes += len(data)
+            self.transport.write(data)
+            return
+        self.records += 1
+        for data in seq:
+            self._parts.append(data)
+            self._size += len(data)
+        if self._size >= COALESCE_LIMIT:
+            self.flush()
+        elif self._call is None:
+            self._call = reactor.callLater(self.delay / 1e6, self.flush)
+
+    def flush(self):
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+        if not self._parts:
+            return
+        data = b''.join(self._parts)
+        self._parts = []
+        self._size = 0
+        self.writes += 1
+        self.bytes += len(data)
+        self.transport.write(data)
+
+    def close(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._parts = []
+        self._size = 0
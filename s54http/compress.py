@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+
+import logging
+import zlib
+
+from s54http.frame import (
+    CAP_LZ4,
+    CAP_ZLIB,
+    CAP_ZSTD,
+    FrameError,
+    MAX_FRAME_LENGTH,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+
+__all__ = [
+    'CODECS',
+    'codec_caps',
+    'select_codec',
+    'StreamCompressor',
+    'StreamDecompressor',
+]
+
+
+logger = logging.getLogger(__name__)
+
+CODECS = {
+    'zlib': CAP_ZLIB,
+    'zstd': CAP_ZSTD,
+    'lz4': CAP_LZ4,
+}
+# codec picked when both peers offer several
+PREFERENCE = (
+    CAP_ZSTD,
+    CAP_LZ4,
+    CAP_ZLIB,
+)
+# bytes of a stream compressed before deciding whether it pays off
+SAMPLE_SIZE = 2**12
+# compressed / raw ratio above which a stream stops compressing
+MAX_RATIO = 0.9
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 1
+
+
+def _installed(cap):
+    if CAP_ZSTD == cap:
+        return zstandard is not None
+    if CAP_LZ4 == cap:
+        return lz4_block is not None
+    return True
+
+
+def codec_caps(names):
+    """
+    names: comma separated codecs, 'none' or empty offers nothing
+    """
+    caps = 0
+    for name in (names or '').split(','):
+        name = name.strip().lower()
+        if not name or 'none' == name:
+            continue
+        try:
+            cap = CODECS[name]
+        except KeyError:
+            raise RuntimeError(f'unknown compression codec {name}')
+        if not _installed(cap):
+            logger.warning('compression codec %s not installed', name)
+            continue
+        caps |= cap
+    return caps
+
+
+def select_codec(caps):
+    for cap in PREFERENCE:
+        if caps & cap:
+            return cap
+    return 0
+
+
+def _is_tls(data):
+    # handshake, alert, change cipher spec or application data record
+    return len(data) >= 3 and 0x14 <= data[0] <= 0x17 and 3 == data[1]
+
+
+class StreamCompressor:
+    """
+    compresses the data of one stream in its own context, every frame
+    is flushed so the peer can decode it at once. a stream that starts
+    with a tls record, or whose first SAMPLE_SIZE bytes don't shrink,
+    is sent raw from then on.
+    """
+
+    __slots__ = [
+        'codec',
+        'enabled',
+        'raw',
+        'packed',
+        '_context',
+    ]
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.enabled = True
+        self.raw = 0
+        self.packed = 0
+        if CAP_ZSTD == codec:
+            self._context = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL
+            ).compressobj()
+        elif CAP_ZLIB == codec:
+            self._context = zlib.compressobj(ZLIB_LEVEL)
+        else:
+            self._context = None
+
+    def _compress(self, data):
+        context = self._context
+        if CAP_ZSTD == self.codec:
+            return context.compress(data) + context.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            )
+        if CAP_ZLIB == self.codec:
+            return context.compress(data) + context.flush(zlib.Z_SYNC_FLUSH)
+        return lz4_block.compress(data, store_size=True)
+
+    def compress(self, data):
+        """
+        returns None when the data is sent raw
+        """
+        if not self.enabled:
+            return None
+        if 0 == self.raw and _is_tls(data):
+            self.enabled = False
+            self._context = None
+            return None
+        packed = self._compress(data)
+        if CAP_LZ4 == self.codec and len(packed) >= len(data):
+            # lz4 blocks stand alone, a frame that grows goes raw
+            packed = None
+        sampling = self.raw < SAMPLE_SIZE
+        self.raw += len(data)
+        self.packed += len(data) if packed is None else len(packed)
+        if sampling and self.raw >= SAMPLE_SIZE:
+            if self.packed > self.raw * MAX_RATIO:
+                # this frame is still decoded in context, the next are raw
+                self.enabled = False
+                self._context = None
+        return packed
+
+    def split(self, data, max_chunk):
+        """
+        yields (packed, payload) of every frame the data is sent in
+        """
+        length = len(data)
+        for offset in range(0, length, max_chunk):
+            if length > max_chunk:
+                chunk = data[offset:offset+max_chunk]
+            else:
+                chunk = data
+            packed = self.compress(chunk)
+            if packed is None:
+                yield False, chunk
+            else:
+                yield True, packed
+
+
+class _BoundedSink:
+    """
+    collects the output of a zstd stream writer, a frame decoded past
+    limit bytes is given up at the next output block
+    """
+
+    __slots__ = [
+        'limit',
+        'parts',
+        'size',
+    ]
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise FrameError('compressed frame too long')
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+class StreamDecompressor:
+
+    __slots__ = [
+        'codec',
+        'max_length',
+        '_sink',
+        '_context',
+    ]
+
+    def __init__(self, codec, max_length=MAX_FRAME_LENGTH):
+        self.codec = codec
+        self.max_length = max_length
+        self._sink = None
+        if CAP_ZSTD == codec:
+            self._sink = _BoundedSink(max_length)
+            self._context = zstandard.ZstdDecompressor().stream_writer(
+                self._sink
+            )
+        elif CAP_ZLIB == codec:
+            self._context = zlib.decompressobj()
+        else:
+            self._context = None
+
+    def decompress(self, payload):
+        try:
+            if CAP_ZLIB == self.codec:
+                data = self._context.decompress(payload, self.max_length)
+                if self._context.unconsumed_tail:
+                    raise FrameError('compressed frame too long')
+                return data
+            if CAP_ZSTD == self.codec:
+                self._context.write(payload)
+                data = self._sink.take()
+            else:
+                length = int.from_bytes(payload[:4], 'little')
+                if length > self.max_length:
+                    raise FrameError('compressed frame too long')
+                data = lz4_block.decompress(payload)
+        except FrameError:
+            raise
+        except Exception as e:
+            raise FrameError(f'invalid compressed frame[{e}]')
+        if len(data) > self.max_length:
+            raise FrameError('compressed frame too long')
+        return data
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+
+import errno
+import socket
+import sys
+
+from twisted.internet import (
+    error as TwistedError,
+    reactor,
+    tcp as TwistedTCP,
+)
+
+from s54http.frame import (
+    CONNECT_FAILED,
+    CONNECT_HOSTUNREACH,
+    CONNECT_NETUNREACH,
+    CONNECT_REFUSED,
+    CONNECT_TIMEOUT,
+)
+
+
+__all__ = [
+    'CONNECT_DELAY',
+    'connect_code',
+    'connect_tcp',
+    'FastOpenConnector',
+]
+
+
+# linux >= 4.11, connect() returns at once and the first write rides the SYN
+TCP_FASTOPEN_CONNECT = getattr(socket, 'TCP_FASTOPEN_CONNECT', 30)
+CONNECT_TIMEOUT_SECONDS = 30
+# seconds between the connects to the addresses of one host, rfc 8305
+CONNECT_DELAY = 0.25
+
+
+class FastOpenClient(TwistedTCP.Client):
+
+    def createInternetSocket(self):
+        s = super().createInternetSocket()
+        try:
+            s.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+        except OSError:
+            # kernel without fast open, a plain connect is made
+            pass
+        return s
+
+
+class FastOpenConnector(TwistedTCP.Connector):
+
+    def _makeTransport(self):
+        return FastOpenClient(
+            self.host,
+            self.port,
+            self.bindAddress,
+            self,
+            self.reactor
+        )
+
+
+def connect_tcp(host, port, factory, *,
+                fastopen=False,
+                timeout=CONNECT_TIMEOUT_SECONDS):
+    """
+    host is an ipv4 or ipv6 address
+    """
+    if not fastopen or not sys.platform.startswith('linux'):
+        return reactor.connectTCP(host, port, factory, timeout=timeout)
+    connector = FastOpenConnector(host, port, factory, timeout, None, reactor)
+    connector.connect()
+    return connector
+
+
+def connect_code(reason):
+    """
+    CODE of the connect reply for the failure of a connect
+
+    >>> from twisted.python.failure import Failure
+    >>> codes = [
+    ...     (TwistedError.ConnectionRefusedError(), CONNECT_REFUSED),
+    ...     (TwistedError.TCPTimedOutError(), CONNECT_TIMEOUT),
+    ...     (TwistedError.TimeoutError(), CONNECT_TIMEOUT),
+    ...     (TwistedError.NoRouteError(), CONNECT_NETUNREACH),
+    ...     (TwistedError.ConnectError(osError=errno.EHOSTUNREACH),
+    ...      CONNECT_HOSTUNREACH),
+    ...     (TwistedError.ConnectError(), CONNECT_FAILED),
+    ... ]
+    >>> [connect_code(Failure(e)) == code for e, code in codes]
+    [True, True, True, True, True, True]
+    """
+    if reason.check(TwistedError.ConnectionRefusedError):
+        return CONNECT_REFUSED
+    if reason.check(TwistedError.TCPTimedOutError, TwistedError.TimeoutError):
+        return CONNECT_TIMEOUT
+    if reason.check(TwistedError.NoRouteError):
+        return CONNECT_NETUNREACH
+    if (reason.check(TwistedError.ConnectError) and
+            errno.EHOSTUNREACH == reason.value.osError):
+        return CONNECT_HOSTUNREACH
+    return CONNECT_FAILED
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import importlib
+import os
+import sys
+
+__all__ = [
+    'describe_engine',
+    'ENGINES',
+    'install_engine',
+    'launch',
+]
+
+
+# twisted runs on its epoll reactor, asyncio on the asyncio event loop,
+# uvloop's when it is installed. both run the same twisted protocols
+ENGINES = (
+    'twisted',
+    'asyncio',
+)
+# processes started by workers and upgrades run the engine of their parent
+ENGINE_ENV = 'S54HTTP_ENGINE'
+# uvloop takes over the signal wakeup fd twisted learns of SIGCHLD from,
+# exited workers are looked for every second instead
+REAP_INTERVAL = 1
+_loop = None
+
+
+def _argv_engine(argv):
+    engine = None
+    for index, arg in enumerate(argv):
+        if '--engine' == arg and index + 1 < len(argv):
+            engine = argv[index + 1]
+        elif arg.startswith('--engine='):
+            engine = arg.partition('=')[2]
+    return engine
+
+
+def _install_asyncio():
+    global _loop
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+        loop = asyncio.new_event_loop()
+    else:
+        loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    from twisted.internet import asyncioreactor
+    try:
+        asyncioreactor.install(loop)
+    except Exception as e:
+        raise RuntimeError(f'engine asyncio not installed[{e}]')
+    _loop = loop
+    if uvloop is not None:
+        from twisted.internet import (
+            process as TwistedProcess,
+            reactor,
+            task as TwistedTask,
+        )
+        reaper = TwistedTask.LoopingCall(TwistedProcess.reapAllProcesses)
+        reactor.callWhenRunning(reaper.start, REAP_INTERVAL, now=False)
+
+
+def install_engine(engine=None):
+    """
+    the reactor of engine has to go in before anything imports
+    twisted.internet.reactor, launch does it for the command line.
+    None is the engine inherited from the parent, or twisted
+    """
+    if engine is None:
+        engine = os.environ.get(ENGINE_ENV) or 'twisted'
+    if engine not in ENGINES:
+        raise RuntimeError(f'unknown engine {engine}')
+    if 'asyncio' == engine and _loop is None:
+        if 'twisted.internet.reactor' in sys.modules:
+            raise RuntimeError(
+                'engine asyncio has to be installed before the reactor, '
+                'run python -m s54http.engine MODULE'
+            )
+        _install_asyncio()
+    elif 'twisted' == engine and _loop is not None:
+        raise RuntimeError('engine asyncio is installed already')
+    # processes started by workers and upgrades inherit it
+    os.environ[ENGINE_ENV] = engine
+    return engine
+
+
+def launch(module, argv=None):
+    """
+    installs the engine chosen by --engine, or inherited from the parent,
+    then runs main() of module
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    install_engine(_argv_engine(argv))
+    importlib.import_module(module).main()
+
+
+def proxy_main():
+    launch('s54http.proxy')
+
+
+def server_main():
+    launch('s54http.server')
+
+
+def describe_engine():
+    if _loop is None:
+        return 'twisted'
+    return f"asyncio on {type(_loop).__module__.split('.')[0]}"
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise SystemExit('usage: python -m s54http.engine MODULE [ARGS]')
+    module = sys.argv.pop(1)
+    # the engine installed has to be seen by the module imported
+    importlib.import_module('s54http.engine').launch(module)
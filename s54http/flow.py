@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+
+from twisted.internet import interfaces as TwistedInterface
+from zope import interface as ZopeInterface
+
+
+__all__ = [
+    'INITIAL_WINDOW',
+    'StreamWindow',
+    'WINDOW_SIZE',
+]
+
+
+# credit every stream starts with before the peer grants its own window
+INITIAL_WINDOW = 2**16
+WINDOW_SIZE = 2**18
+
+
+@ZopeInterface.implementer(TwistedInterface.IPushProducer)
+class StreamWindow:
+    """
+    credit of one stream: reading its transport stops once the credit
+    is spent, credit returns to the peer while its writes drain.
+    """
+
+    __slots__ = [
+        'size',
+        'credit',
+        'outstanding',
+        'consumed',
+        'transport',
+        'update',
+        '_starved',
+        '_throttled',
+        '_blocked',
+        '_reading',
+    ]
+
+    def __init__(self, size, update):
+        # size 0 leaves the stream without flow control
+        self.size = max(size, INITIAL_WINDOW) if size else 0
+        self.credit = INITIAL_WINDOW
+        self.outstanding = 0
+        self.consumed = 0
+        self.transport = None
+        self.update = update
+        self._starved = False
+        self._throttled = False
+        self._blocked = False
+        self._reading = True
+
+    def open(self):
+        if self.size > INITIAL_WINDOW:
+            self.update(self.size - INITIAL_WINDOW)
+
+    def attach(self, transport):
+        self.transport = transport
+        self._reading = True
+        transport.registerProducer(self, True)
+        self._updateReading()
+
+    def detach(self):
+        if self.transport is not None:
+            # a paused producer holds back the fin of a closing transport
+            self.transport.unregisterProducer()
+        self.transport = None
+        self.update = None
+
+    def shutdown(self):
+        """
+        the transport is done writing, its reading goes on under the
+        credit
+        """
+        transport = self.transport
+        transport.unregisterProducer()
+        transport.loseWriteConnection()
+
+    def _updateReading(self):
+        transport = self.transport
+        if transport is None:
+            return
+        paused = self._starved or self._throttled
+        if paused and self._reading:
+            self._reading = False
+            transport.pauseProducing()
+        elif not paused and not self._reading:
+            self._reading = True
+            transport.resumeProducing()
+
+    def spend(self, length):
+        if not self.size:
+            return
+        self.credit -= length
+        self.outstanding += length
+        if self.credit <= 0 and not self._starved:
+            self._starved = True
+            self._updateReading()
+
+    def grant(self, increment):
+        acked = min(increment, self.outstanding)
+        self.credit += increment
+        self.outstanding -= acked
+        if self.credit > 0 and self._starved:
+            self._starved = False
+            self._updateReading()
+        return acked
+
+    def resume(self, credit, outstanding):
+        """
+        starts over once a lost tunnel is back, the grants either side
+        had not sent yet are forgotten
+        """
+        self.credit = credit
+        self.outstanding = outstanding
+        self.consumed = 0
+        starved = bool(self.size) and credit <= 0
+        if starved != self._starved:
+            self._starved = starved
+            self._updateReading()
+
+    def throttle(self):
+        self._throttled = True
+        self._updateReading()
+
+    def unthrottle(self):
+        self._throttled = False
+        self._updateReading()
+
+    def consume(self, length):
+        if not self.size:
+            return
+        self.consumed += length
+        self._flush()
+
+    def _flush(self):
+        if self._blocked or self.update is None or not self.size:
+            return
+        if self.consumed < self.size // 2:
+            return
+        consumed, self.consumed = self.consumed, 0
+        self.update(consumed)
+
+    def pauseProducing(self):
+        self._blocked = True
+
+    def resumeProducing(self):
+        self._blocked = False
+        self._flush()
+
+    def stopProducing(self):
+        self._blocked = True
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+
+import struct
+
+
+__all__ = [
+    'CAP_COMPACT',
+    'CAP_CONNECT',
+    'CAP_DNS',
+    'CAP_HALFCLOSE',
+    'CAP_LZ4',
+    'CAP_OPEN',
+    'CAP_PING',
+    'CAP_RESUME',
+    'CAP_WINDOW',
+    'CAP_ZLIB',
+    'CAP_ZSTD',
+    'CONNECT_FAILED',
+    'CONNECT_HOSTUNREACH',
+    'CONNECT_NETUNREACH',
+    'CONNECT_NXDOMAIN',
+    'CONNECT_OK',
+    'CONNECT_REFUSED',
+    'CONNECT_TIMEOUT',
+    'FrameDecoder',
+    'FrameEncoder',
+    'FrameError',
+    'HELLO_ACK',
+    'HELLO_DRAIN',
+    'HELLO_LENGTH',
+    'HELLO_OFFER',
+    'HELLO_SWITCH',
+    'MAX_FRAME_LENGTH',
+    'PROTOCOL_VERSION',
+    'pack_hello',
+    'unpack_hello',
+]
+
+
+MAX_FRAME_LENGTH = 2**20
+# smallest legal frame is LEN + TYPE
+MIN_FRAME_LENGTH = 5
+# consumed bytes are only moved out of the buffer past this size
+COMPACT_THRESHOLD = 2**16
+
+PROTOCOL_VERSION = 1
+CAP_COMPACT = 1 << 0
+CAP_WINDOW = 1 << 1
+CAP_OPEN = 1 << 2
+CAP_ZLIB = 1 << 3
+CAP_ZSTD = 1 << 4
+CAP_LZ4 = 1 << 5
+CAP_DNS = 1 << 6
+CAP_RESUME = 1 << 7
+CAP_PING = 1 << 8
+# a stream closes once both of its directions are shut down
+CAP_HALFCLOSE = 1 << 9
+# the server answers connects that succeed too, not only failed ones
+CAP_CONNECT = 1 << 10
+
+# CODE of a connect reply, type 2, older proxies take all but 0 as failed
+CONNECT_OK = 0
+CONNECT_FAILED = 1
+CONNECT_NXDOMAIN = 2
+CONNECT_REFUSED = 3
+CONNECT_TIMEOUT = 4
+CONNECT_NETUNREACH = 5
+CONNECT_HOSTUNREACH = 6
+
+HELLO_OFFER = 0
+HELLO_ACK = 1
+HELLO_SWITCH = 2
+# the server is going away, tunnels close once their streams are done
+HELLO_DRAIN = 3
+HELLO_MAGIC = b'S5P'
+
+_LENGTH = struct.Struct('!I')
+_ID = struct.Struct('!I')
+_HEADER = struct.Struct('!IBI')
+_SHORT_HEADER = struct.Struct('!IB')
+_HELLO = struct.Struct('!3sBBI')
+HELLO_LENGTH = _HELLO.size
+
+
+class FrameError(RuntimeError):
+    pass
+
+
+def _varint(value):
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def pack_hello(kind, caps):
+    """
+    +-------+------+---------+------+
+    | MAGIC | KIND | VERSION | CAPS |
+    +-------+------+---------+------+
+    |   3   |   1  |    1    |   4  |
+    +-------+------+---------+------+
+    """
+    return _HELLO.pack(HELLO_MAGIC, kind, PROTOCOL_VERSION, caps)
+
+
+def unpack_hello(payload):
+    if len(payload) < _HELLO.size:
+        return None
+    magic, kind, version, caps = _HELLO.unpack_from(payload)
+    if magic != HELLO_MAGIC:
+        return None
+    return kind, version, caps
+
+
+class FrameEncoder:
+    """
+    legacy:
+    +-----+------+----+-----+
+    | LEN | TYPE | ID | ... |
+    +-----+------+----+-----+
+    |  4  |   1  |  4 |     |
+    +-----+------+----+-----+
+
+    compact, LEN counts the bytes after itself:
+    +--------+------+--------+-----+
+    |  LEN   | TYPE |   ID   | ... |
+    +--------+------+--------+-----+
+    | varint |   1  | varint |     |
+    +--------+------+--------+-----+
+    """
+
+    __slots__ = ['compact']
+
+    def __init__(self, compact=False):
+        self.compact = compact
+
+    def header(self, type, sock_id, length):
+        if self.compact:
+            sock_id = _varint(sock_id or 0)
+            body = 1 + len(sock_id) + length
+            return _varint(body) + bytes((type,)) + sock_id
+        if sock_id is None:
+            return _SHORT_HEADER.pack(5 + length, type)
+        return _HEADER.pack(9 + length, type, sock_id)
+
+    def pack(self, type, sock_id, payload=b''):
+        return self.header(type, sock_id, len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    frames are decoded out of one growable buffer, consumed bytes are
+    skipped with a read offset and only dropped when they dominate the
+    buffer, every payload is a memoryview into that buffer.
+    """
+
+    __slots__ = [
+        'max_length',
+        'compact',
+        '_buffer',
+        '_offset',
+    ]
+
+    def __init__(self, max_length=MAX_FRAME_LENGTH):
+        self.max_length = max_length
+        self.compact = False
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def _append(self, data):
+        buffer = self._buffer
+        offset = self._offset
+        try:
+            if offset == len(buffer):
+                buffer.clear()
+                self._offset = 0
+            elif offset >= COMPACT_THRESHOLD and offset * 2 >= len(buffer):
+                del buffer[:offset]
+                self._offset = 0
+            buffer += data
+        except BufferError:
+            # a message view is still alive, leave the old buffer to it
+            self._buffer = buffer[offset:]
+            self._buffer += data
+            self._offset = 0
+
+    def _decodeLegacy(self, buffer, offset, end):
+        if end - offset < 4:
+            return None
+        length, = _LENGTH.unpack_from(buffer, offset)
+        if length < MIN_FRAME_LENGTH or length > self.max_length:
+            raise FrameError(f'invalid frame length={length}')
+        if end - offset < length:
+            return None
+        type = buffer[offset + 4]
+        if length >= 9:
+            sock_id, = _ID.unpack_from(buffer, offset + 5)
+            start = offset + 9
+        else:
+            sock_id = 0
+            start = offset + 5
+        return type, sock_id, start, offset + length
+
+    def _decodeCompact(self, buffer, offset, end):
+        length = 0
+        shift = 0
+        while True:
+            if offset >= end:
+                return None
+            byte = buffer[offset]
+            offset += 1
+            length |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+            if shift > 28:
+                raise FrameError('invalid frame length')
+        if length < 2 or length > self.max_length:
+            raise FrameError(f'invalid frame length={length}')
+        if end - offset < length:
+            return None
+        stop = offset + length
+        type = buffer[offset]
+        offset += 1
+        sock_id = 0
+        shift = 0
+        while True:
+            if offset >= stop or shift > 28:
+                raise FrameError('invalid frame id')
+            byte = buffer[offset]
+            offset += 1
+            sock_id |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        return type, sock_id, offset, stop
+
+    def decode(self, data):
+        self._append(data)
+        buffer = self._buffer
+        end = len(buffer)
+        view = memoryview(buffer)
+        try:
+            while True:
+                if self.compact:
+                    frame = self._decodeCompact(buffer, self._offset, end)
+                else:
+                    frame = self._decodeLegacy(buffer, self._offset, end)
+                if frame is None:
+                    return
+                type, sock_id, start, stop = frame
+                self._offset = stop
+                yield type, sock_id, view[start:stop]
+        finally:
+            view.release()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+
+import struct
+
+from twisted.internet import (
+    reactor,
+    task as TwistedTask,
+)
+
+from s54http.frame import FrameError
+
+
+__all__ = [
+    'Heartbeat',
+    'PING_INTERVAL',
+    'PING_MISSES',
+]
+
+
+# seconds between pings, and pings in a row left unanswered before the
+# peer is taken for dead
+PING_INTERVAL = 10
+PING_MISSES = 3
+_STAMP = struct.Struct('!Q')
+
+
+class Heartbeat:
+    """
+    pings the peer every interval seconds and keeps a smoothed rtt of
+    its pongs, once misses pings in a row go unanswered dead() is called
+
+    type 14 ping, type 15 pong echoing it, ID 0:
+    +-----+------+----+-------+
+    | LEN | TYPE | ID | STAMP |
+    +-----+------+----+-------+
+    |  4  |   1  |  4 |   8   |
+    +-----+------+----+-------+
+
+    STAMP is read back by the side that pinged only, in microseconds
+    """
+
+    __slots__ = [
+        'send',
+        'dead',
+        'interval',
+        'misses',
+        'srtt',
+        'rttvar',
+        'missed',
+        'pings',
+        'pongs',
+        '_timer',
+    ]
+
+    def __init__(self, send, dead, *,
+                 interval=PING_INTERVAL,
+                 misses=PING_MISSES):
+        self.send = send
+        self.dead = dead
+        self.interval = interval
+        self.misses = misses
+        # 0 until the first pong
+        self.srtt = 0.0
+        self.rttvar = 0.0
+        self.missed = 0
+        self.pings = 0
+        self.pongs = 0
+        self._timer = None
+
+    @property
+    def rto(self):
+        return self.srtt + 4 * self.rttvar
+
+    def start(self):
+        # the first ping measures the rtt right away
+        self._timer = TwistedTask.LoopingCall(self.ping)
+        self._timer.start(self.interval, now=True)
+
+    def stop(self):
+        if self._timer is not None and self._timer.running:
+            self._timer.stop()
+        self._timer = None
+
+    def ping(self):
+        if self.missed >= self.misses:
+            self.stop()
+            self.dead()
+            return
+        self.missed += 1
+        self.pings += 1
+        stamp = int(reactor.seconds() * 1e6)
+        self.send(14, 0, _STAMP.pack(stamp))
+
+    def handlePing(self, payload):
+        self.send(15, 0, bytes(payload))
+
+    def handlePong(self, payload):
+        if _STAMP.size != len(payload):
+            raise FrameError('invalid pong')
+        stamp, = _STAMP.unpack(payload)
+        rtt = reactor.seconds() - stamp / 1e6
+        if rtt < 0:
+            return
+        self.missed = 0
+        self.sample(rtt)
+        self.pongs += 1
+
+    def sample(self, rtt):
+        if self.pongs:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+        else:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+
+    def stats(self):
+        return {
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'pings': self.pings,
+            'pongs': self.pongs,
+        }
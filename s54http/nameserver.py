@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+
+import logging
+import socket
+import struct
+
+from twisted.internet import (
+    defer as TwistedDefer,
+    reactor,
+)
+from twisted.names import (
+    common as DNSCommon,
+    dns as DNS,
+    error as DNSError,
+    server as DNSServer,
+)
+from twisted.python import failure as TwistedFailure
+
+from s54http.upgrade import (
+    adopt_datagram,
+    adopt_port,
+    inherited_fd,
+)
+from s54http.utils import DNSCache
+
+
+__all__ = [
+    'DNS_NXDOMAIN',
+    'DNS_OK',
+    'DNS_SERVFAIL',
+    'listen_dns',
+    'pack_dns_answer',
+    'TunnelResolver',
+    'unpack_dns_answer',
+]
+
+
+logger = logging.getLogger(__name__)
+
+DNS_OK = 0
+DNS_SERVFAIL = 2
+DNS_NXDOMAIN = 3
+_ANSWER = struct.Struct('!BI')
+
+
+def pack_dns_answer(code, ttl=0, addresses=()):
+    """
+    +------+-----+-----------+
+    | CODE | TTL | ADDRESSES |
+    +------+-----+-----------+
+    |   1  |  4  |           |
+    +------+-----+-----------+
+
+    every address, 4 bytes ipv4 or 16 bytes ipv6:
+    +-----+---------+
+    | LEN | ADDRESS |
+    +-----+---------+
+    |  1  |  4|16   |
+    +-----+---------+
+    """
+    parts = [_ANSWER.pack(code, max(int(ttl), 0))]
+    for address in addresses:
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        packed = socket.inet_pton(family, address)
+        parts.append(bytes((len(packed),)))
+        parts.append(packed)
+    return b''.join(parts)
+
+
+def unpack_dns_answer(payload):
+    """
+    returns (code, ttl, addresses)
+    """
+    code, ttl = _ANSWER.unpack_from(payload)
+    offset = _ANSWER.size
+    addresses = []
+    while offset < len(payload):
+        size = payload[offset]
+        packed = bytes(payload[offset+1:offset+1+size])
+        offset += 1 + size
+        family = socket.AF_INET6 if 16 == size else socket.AF_INET
+        addresses.append(socket.inet_ntop(family, packed))
+    return code, ttl, addresses
+
+
+class TunnelResolver(DNSCommon.ResolverBase):
+    """
+    answers A and AAAA queries from a local cache, misses are sent to
+    the server through the tunnel, concurrent misses of one name share
+    a query. every other query type is answered empty.
+    """
+
+    def __init__(self, query, cache):
+        super().__init__()
+        # query(name) returns a Deferred firing with (code, ttl, addresses)
+        self.query_tunnel = query
+        self.cache = cache
+        self._inflight = {}
+
+    def _records(self, name, type, addresses, ttl):
+        answers = []
+        for address in addresses:
+            if DNS.A == type and ':' not in address:
+                payload = DNS.Record_A(address, ttl)
+            elif DNS.AAAA == type and ':' in address:
+                payload = DNS.Record_AAAA(address, ttl)
+            else:
+                continue
+            answers.append(DNS.RRHeader(name, type, DNS.IN, ttl, payload))
+        return answers, [], []
+
+    def _lookup(self, name, cls, type, timeout):
+        if DNS.IN != cls or type not in (DNS.A, DNS.AAAA):
+            return TwistedDefer.succeed(([], [], []))
+        host = name.decode('ascii').rstrip('.').lower()
+        state, addresses = self.cache.get(host)
+        if DNSCache.NEGATIVE == state:
+            error = self.cache.error(host)
+            if error is None:
+                error = DNSError.DNSNameError(host)
+            return TwistedDefer.fail(error)
+        if DNSCache.MISS != state:
+            if DNSCache.STALE == state:
+                self._resolve(host).addErrback(lambda _: None)
+            ttl = int(self.cache.ttl(host))
+            return TwistedDefer.succeed(
+                self._records(name, type, addresses, ttl)
+            )
+
+        def answered(result):
+            addresses, ttl = result
+            return self._records(name, type, addresses, ttl)
+
+        return self._resolve(host).addCallback(answered)
+
+    def _resolve(self, host):
+        d = TwistedDefer.Deferred()
+        waiters = self._inflight.get(host)
+        if waiters is not None:
+            waiters.append(d)
+            return d
+        waiters = self._inflight[host] = [d]
+
+        def answered(result):
+            code, ttl, addresses = result
+            if DNS_OK == code and addresses:
+                self.cache.put(host, addresses, ttl)
+                return addresses, int(self.cache.ttl(host))
+            if DNS_NXDOMAIN == code or DNS_OK == code:
+                error = DNSError.DNSNameError(host)
+                self.cache.putNegative(host, error)
+                raise error
+            raise DNSError.ResolverError(host)
+
+        def finish(result):
+            self._inflight.pop(host, None)
+            for waiter in waiters:
+                if isinstance(result, TwistedFailure.Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+
+        self.query_tunnel(host).addCallback(answered).addBoth(finish)
+        return d
+
+
+def listen_dns(port, interface, resolver):
+    """
+    returns the udp and tcp ports, sockets handed over by an upgrade are
+    taken instead of new ones
+    """
+    factory = DNSServer.DNSServerFactory(clients=[resolver])
+    protocol = DNS.DNSDatagramProtocol(controller=factory)
+    fd = inherited_fd('dns-udp')
+    if fd is None:
+        udp = reactor.listenUDP(port, protocol, interface=interface)
+    else:
+        udp = adopt_datagram(fd, protocol)
+    fd = inherited_fd('dns-tcp')
+    if fd is None:
+        tcp = reactor.listenTCP(port, factory, interface=interface)
+    else:
+        tcp = adopt_port(fd, factory)
+    logger.info('dns listening on %s:%u', interface, port)
+    return udp, tcp
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 
+import functools
 import gc
 import logging
 import struct
@@ -9,14 +10,95 @@ import weakref
 
 from twisted.application import internet as TwistedInetService
 from twisted.internet import (
+    defer as TwistedDefer,
     endpoints as TwistedEndpoint,
     error as TwistedError,
+    interfaces as TwistedInterface,
     protocol as TwistedProtocol,
     reactor,
 )
-
+from twisted.names import error as DNSError
+from zope import interface as ZopeInterface
+
+from s54http.coalesce import COALESCE_DELAY
+from s54http.compress import (
+    codec_caps,
+    select_codec,
+    StreamCompressor,
+    StreamDecompressor,
+)
+from s54http.engine import (
+    describe_engine,
+    install_engine,
+)
+from s54http.flow import (
+    StreamWindow,
+    WINDOW_SIZE,
+)
+from s54http.frame import (
+    CAP_COMPACT,
+    CAP_CONNECT,
+    CAP_DNS,
+    CAP_HALFCLOSE,
+    CAP_OPEN,
+    CAP_PING,
+    CAP_RESUME,
+    CAP_WINDOW,
+    CONNECT_FAILED,
+    CONNECT_HOSTUNREACH,
+    CONNECT_NETUNREACH,
+    CONNECT_NXDOMAIN,
+    CONNECT_OK,
+    CONNECT_REFUSED,
+    CONNECT_TIMEOUT,
+    FrameDecoder,
+    FrameError,
+    HELLO_ACK,
+    HELLO_DRAIN,
+    HELLO_LENGTH,
+    HELLO_OFFER,
+    HELLO_SWITCH,
+    MAX_FRAME_LENGTH,
+    pack_hello,
+    unpack_hello,
+)
+from s54http.heartbeat import (
+    Heartbeat,
+    PING_INTERVAL,
+    PING_MISSES,
+)
+from s54http.nameserver import (
+    listen_dns,
+    TunnelResolver,
+    unpack_dns_answer,
+)
+from s54http.scheduler import (
+    FrameScheduler,
+    MAX_CHUNK,
+    PriorityRules,
+)
+from s54http.session import (
+    pack_resume,
+    pack_window,
+    ReplayBuffer,
+    RESUME_GRACE,
+    unpack_resume,
+    unpack_window,
+)
+from s54http.streams import StreamTable
+from s54http.upgrade import (
+    adopt_port,
+    DRAIN_TIMEOUT,
+    inherited_fd,
+    notify_ready,
+    reload_certificates,
+    Upgrader,
+    upgrading,
+)
 from s54http.utils import (
     daemonize,
+    DNSCache,
+    ClientTLS,
     init_logger,
     NullProxy,
     parse_args,
@@ -37,8 +119,80 @@ config = {
     'dhparam': 'keys/dhparam.pem',
     'pidfile': 's5p.pid',
     'logfile': 'proxy.log',
-    'loglevel': 'INFO'
+    'loglevel': 'INFO',
+    'max_frame': MAX_FRAME_LENGTH,
+    'tunnels': 1,
+    'max_tunnels': 0,
+    'tunnel_streams': 64,
+    'tunnel_policy': 'least-loaded',
+    'connect_reply': 'early',
+    'window': WINDOW_SIZE,
+    'max_chunk': MAX_CHUNK,
+    'priority': '',
+    'coalesce': COALESCE_DELAY,
+    'open_delay': 300,
+    'compress': '',
+    'dns_listen': 0,
+    'resume': RESUME_GRACE,
+    'pending_wait': 10,
+    'pending_memory': 2**22,
+    'ping': PING_INTERVAL,
+    'ping_misses': PING_MISSES,
+    'ciphers': 'auto',
+    'tls_min': '1.2',
+    'drain': DRAIN_TIMEOUT,
+    'engine': None,
 }
+TUNNEL_POLICIES = (
+    'least-loaded',
+    'round-robin',
+    'fastest',
+)
+# early answers a connect at once, strict once the server has connected
+CONNECT_REPLIES = (
+    'early',
+    'strict',
+)
+# socks5 REP of the CODE of a connect reply
+SOCKS_REPLIES = {
+    CONNECT_OK: 0,
+    CONNECT_FAILED: 1,
+    CONNECT_NETUNREACH: 3,
+    CONNECT_HOSTUNREACH: 4,
+    CONNECT_NXDOMAIN: 4,
+    CONNECT_REFUSED: 5,
+    CONNECT_TIMEOUT: 6,
+}
+# seconds to wait for the server hello before speaking the legacy protocol
+HELLO_TIMEOUT = 1.0
+# microseconds to wait for the first data of a stream before opening it
+OPEN_DELAY = 300
+# seconds to wait for the server to answer a dns query
+DNS_TIMEOUT = 5
+# new streams move to another server only once it scores this much
+# better than the current one
+SWITCH_MARGIN = 0.25
+# seconds a new stream waits for a tunnel, and the bytes all waiting
+# streams may buffer meanwhile
+PENDING_WAIT = 10
+PENDING_MEMORY = 2**22
+
+
+def parse_servers(saddr, sport):
+    """
+    saddr: addr[:port],addr[:port],...
+    """
+    servers = []
+    for item in (saddr or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if 1 == item.count(':'):
+            address, port = item.split(':')
+            servers.append((address, int(port)))
+        else:
+            servers.append((item, sport))
+    return servers
 
 
 class TunnelProtocol(TwistedProtocol.Protocol):
@@ -46,9 +200,9 @@ class TunnelProtocol(TwistedProtocol.Protocol):
     def connectionMade(self):
         self.transport.setTcpNoDelay(True)
         self.transport.setTcpKeepAlive(True)
-        self.buffer = b''
-        self.dispatcher = self.factory.dispatcher
-        self.dispatcher.tunnelConnected(self)
+        self.decoder = FrameDecoder(self.factory.max_frame)
+        self.tunnel = self.factory.tunnel
+        self.tunnel.tunnelConnected(self)
         server = self.transport.getPeer()
         logger.info(
             'proxy connected to %s:%u',
@@ -57,19 +211,21 @@ class TunnelProtocol(TwistedProtocol.Protocol):
         )
 
     def dataReceived(self, data):
-        self.buffer += data
-        while True:
-            if len(self.buffer) < 4:
-                return
-            length, = struct.unpack('!I', self.buffer[:4])
-            if len(self.buffer) < length:
-                return
-            message = memoryview(self.buffer)[:length]
-            self.dispatcher.dispatchMessage(message)
-            self.buffer = self.buffer[length:]
+        try:
+            for type, sock_id, payload in self.decoder.decode(data):
+                self.tunnel.dispatchMessage(type, sock_id, payload)
+        except FrameError as e:
+            server = self.transport.getPeer()
+            logger.error(
+                'proxy connection to %s:%u broken[%s]',
+                server.host,
+                server.port,
+                e
+            )
+            self.transport.abortConnection()
 
     def connectionLost(self, reason):
-        self.dispatcher.tunnelClosed()
+        self.tunnel.tunnelClosed()
         server = self.transport.getPeer()
         logger.info(
             'proxy connetion to %s:%u lost',
@@ -82,38 +238,103 @@ class TunnelFactory(TwistedProtocol.ClientFactory):
 
     protocol = TunnelProtocol
 
-    def __init__(self, dispatcher):
-        self.dispatcher = dispatcher
+    def __init__(self, tunnel, max_frame):
+        self.tunnel = tunnel
+        self.max_frame = max_frame
 
 
-class SocksDispatcher:
+@ZopeInterface.implementer(TwistedInterface.IPushProducer)
+class Producer:
+
+    __slots__ = ['tunnel']
+
+    def __init__(self, tunnel):
+        self.tunnel = tunnel
+
+    def pauseProducing(self):
+        logger.debug('local socks pause receiving data')
+        for sock in self.tunnel.socks.values():
+            sock.window.throttle()
+
+    def resumeProducing(self):
+        logger.debug('local socks resume receiving data')
+        for sock in self.tunnel.socks.values():
+            sock.window.unthrottle()
+
+    def stopProducing(self):
+        pass
+
+
+class Tunnel:
 
     __slots__ = [
+        'dispatcher',
+        'server',
+        'tls',
         'socks',
+        'outstanding',
         'transport',
+        'decoder',
+        'scheduler',
         'service',
+        'caps',
+        'token',
+        'resuming',
+        'draining',
+        'heartbeat',
+        '_hello_timer',
+        '_resume_timer',
         '__weakref__',
     ]
 
-    def __init__(self, addr, port, ssl_ctx):
+    def __init__(self, dispatcher, server, tls):
+        self.dispatcher = dispatcher
+        self.server = server
+        self.tls = tls
         self.socks = {}
+        self.outstanding = 0
         self.transport = None
+        self.decoder = None
+        self.scheduler = None
         self.service = None
-        self.connectTunnel(addr, port, ssl_ctx)
+        self.caps = None
+        # session the server keeps the streams in while the tunnel is lost
+        self.token = None
+        self.resuming = False
+        # the server is going away, no new streams
+        self.draining = False
+        self.heartbeat = None
+        self._hello_timer = None
+        self._resume_timer = None
+        self.connectTunnel(*server, tls)
 
     @property
     def isConnected(self):
         transport = self.transport
         if transport is None:
             return False
-        if isinstance(transport, NullProxy):
+        if isinstance(transport, NullProxy) or self.draining:
             return False
-        return True
+        # streams wait until the tunnel protocol is settled
+        return self.caps is not None
+
+    @property
+    def load(self):
+        return self.outstanding, len(self.socks)
 
-    def connectTunnel(self, addr, port, ssl_ctx):
-        factory = TunnelFactory(self)
+    @property
+    def rtt(self):
+        """
+        smoothed rtt of the tunnel, 0 until it is measured
+        """
+        if self.heartbeat is None:
+            return 0.0
+        return self.heartbeat.srtt
+
+    def connectTunnel(self, addr, port, tls):
+        factory = TunnelFactory(self, self.dispatcher.max_frame)
         wrapped = TwistedEndpoint.HostnameEndpoint(reactor, addr, port)
-        endpoint = TwistedEndpoint.wrapClientTLS(ssl_ctx, wrapped)
+        endpoint = TwistedEndpoint.wrapClientTLS(tls, wrapped)
         service = TwistedInetService.ClientService(endpoint, factory)
 
         def connected(p):
@@ -133,53 +354,658 @@ class SocksDispatcher:
 
     def tunnelConnected(self, p):
         self.transport = p.transport
+        self.decoder = p.decoder
+        self.scheduler = FrameScheduler(
+            p.transport,
+            producer=Producer(self),
+            max_chunk=self.dispatcher.max_chunk,
+            coalesce=self.dispatcher.coalesce
+        )
+        self.caps = None
+        self._hello_timer = reactor.callLater(
+            HELLO_TIMEOUT,
+            self.helloTimeout
+        )
+
+    def helloTimeout(self):
+        self._hello_timer = None
+        self.tls.saveSession(self.transport.getHandle())
+        if self.caps is None:
+            logger.info('server speaks the legacy tunnel protocol')
+            self.caps = 0
+            self.dispatcher.tunnelReady()
 
     def tunnelClosed(self):
+        if self._hello_timer is not None:
+            self._hello_timer.cancel()
+            self._hello_timer = None
+        resumable = bool(self.caps and self.caps & CAP_RESUME)
+        self.caps = None
+        if not isinstance(self.transport, NullProxy):
+            self.tls.keepSession(self.transport.getHandle())
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            stats = self.heartbeat.stats()
+            logger.info(
+                'tunnel srtt=%.1fms rttvar=%.1fms pings=%u pongs=%u',
+                stats['srtt'] * 1000,
+                stats['rttvar'] * 1000,
+                stats['pings'],
+                stats['pongs']
+            )
+            self.heartbeat = None
+        if isinstance(self.scheduler, FrameScheduler):
+            stats = self.scheduler.stats()
+            logger.info(
+                'tunnel writes=%u records/write=%.2f bytes/write=%.0f',
+                stats['writes'],
+                stats['records_per_write'],
+                stats['bytes_per_write']
+            )
         self.transport = NullProxy()
+        self.scheduler = NullProxy()
+        if self.draining:
+            # its server has gone, the session with it
+            self.token = None
+            self.resuming = False
+            resumable = False
+            reactor.callLater(0, self.dispatcher.retireTunnel, self)
+        if self.resuming or (resumable and self.token and self.socks):
+            self.detachSession()
+            return
+        self.token = None
         if self.socks:
             old_socks = self.socks
             self.socks = {}
-            for sock in old_socks.values():
-                transport = sock.transport
-                if transport is not None:
-                    transport.abortConnection()
+            self.outstanding = 0
+            for sock_id, sock in old_socks.items():
+                self.dispatcher.socks.pop(sock_id, None)
+                if sock.transport is not None:
+                    sock.refuse(1)
                     sock.transport = None
             del old_socks
         gc.collect()
 
-    def stopDispatch(self):
+    def detachSession(self):
+        """
+        streams hold their data until the tunnel is back, the ones the
+        server has never heard of are lost
+        """
+        if not self.resuming:
+            self.resuming = True
+            self._resume_timer = reactor.callLater(
+                self.dispatcher.resume,
+                self.expireSession
+            )
+        for sock_id, sock in list(self.socks.items()):
+            if sock.opening is not None:
+                self.dispatcher.closeSock(sock_id, abort=True)
+            else:
+                sock.held = True
+        logger.info('tunnel lost, holding %u streams', len(self.socks))
+
+    def dropHeld(self):
+        held = [sock_id for sock_id, sock in self.socks.items() if sock.held]
+        for sock_id in held:
+            self.dispatcher.closeSock(sock_id, abort=True)
+        return len(held)
+
+    def expireSession(self):
+        self._resume_timer = None
+        self.resuming = False
+        self.token = None
+        logger.info('tunnel session expired, %u streams lost',
+                    self.dropHeld())
+
+    def resumeSession(self, token, entries):
+        if self._resume_timer is not None:
+            self._resume_timer.cancel()
+            self._resume_timer = None
+        self.resuming = False
+        if token != self.token:
+            # a new session, the server has lost the old one
+            self.token = token
+            lost = self.dropHeld()
+            if lost:
+                logger.info('tunnel session not resumed, %u streams lost',
+                            lost)
+            return
+        offsets = {
+            sock_id: (received, window)
+            for sock_id, received, window in entries
+        }
+        resent = lost = 0
+        for sock_id, sock in list(self.socks.items()):
+            if not sock.held:
+                # opened since the tunnel is back
+                continue
+            entry = offsets.get(sock_id)
+            data = None if entry is None else sock.replay.since(entry[0])
+            if data is None:
+                # the server has closed it or its bytes are gone
+                self.dispatcher.closeSock(sock_id, abort=True)
+                lost += 1
+                continue
+            received, window = entry
+            sent = sock.replay.sent
+            sock.held = False
+            sock.window.resume(received + window - sent, sent - received)
+            sock.replay.ack(received)
+            # compression contexts are lost with the frames in flight
+            sock.compressor = None
+            self.scheduler.openStream(
+                sock_id,
+                self.dispatcher.priority.classify(sock.remote_port)
+            )
+            if data:
+                self.writeData(sock_id, 3, data)
+            # the fin may have been lost with the tunnel
+            if sock.read_closed and self.caps & CAP_HALFCLOSE:
+                self.writeFrame(sock_id, 16)
+            resent += 1
+        self.outstanding = sum(
+            sock.window.outstanding for sock in self.socks.values()
+        )
+        logger.info(
+            'tunnel session resumed streams=%u lost=%u',
+            resent,
+            lost
+        )
+
+    def stopTunnel(self):
+        # a tunnel closed on purpose isn't resumed
+        self.token = None
+        self.resuming = False
+        if self._resume_timer is not None:
+            self._resume_timer.cancel()
+            self._resume_timer = None
         if self.transport is not None:
             self.closeTunnel()
+            # tls holds its close back while a producer is registered
+            self.transport.unregisterProducer()
             self.transport.loseConnection()
             self.transport = NullProxy()
         self.service.stopService()
 
-    def closeSock(self, sock_id, *, abort=False):
+    def addSock(self, sock, priority):
+        self.socks[sock.sock_id] = sock
+        self.scheduler.openStream(sock.sock_id, priority)
+        sock.tunnel = self
+
+    def removeSock(self, sock_id):
+        sock = self.socks.pop(sock_id, None)
+        self.scheduler.closeStream(sock_id)
+        if sock is not None and sock.window is not None:
+            self.outstanding -= sock.window.outstanding
+            sock.window.detach()
+        if self.draining and not self.socks:
+            # the close of the stream goes out first
+            reactor.callLater(0, self.dispatcher.retireTunnel, self)
+
+    def write(self, type, sock_id=None, payload=b''):
+        self.scheduler.sendControl(type, sock_id, payload)
+
+    def writeFrame(self, sock_id, type, payload=b''):
+        self.scheduler.sendFrame(sock_id, type, payload)
+
+    def writeData(self, sock_id, type, data):
+        self.scheduler.sendData(sock_id, type, data)
+
+    def dispatchMessage(self, type, sock_id, payload):
+        if 0 == sock_id and 2 == type:
+            self.handleHello(payload)
+        elif 14 == type and self.heartbeat is not None:
+            self.heartbeat.handlePing(payload)
+        elif 15 == type and self.heartbeat is not None:
+            self.heartbeat.handlePong(payload)
+        else:
+            self.dispatcher.dispatchMessage(type, sock_id, payload)
+
+    def handleHello(self, payload):
+        """
+        type 2, ID 0:
+        +-----+------+----+------+-------+
+        | LEN | TYPE | ID | CODE | HELLO |
+        +-----+------+----+------+-------+
+        |  4  |   1  |  4 |   1  |   9   |
+        +-----+------+----+------+-------+
+        """
+        hello = unpack_hello(payload[1:])
+        if hello is None:
+            return
+        kind, version, caps = hello
+        if HELLO_OFFER == kind:
+            if self.caps is not None:
+                logger.info('server hello came too late, ignored')
+                return
+            self._hello_timer.cancel()
+            self._hello_timer = None
+            self.caps = caps & self.dispatcher.caps
+            if not self.caps & CAP_WINDOW:
+                self.caps &= ~CAP_RESUME
+            session = b''
+            if self.resuming and self.caps & CAP_RESUME:
+                session = pack_resume(self.token, [
+                    (sock_id, sock.received, sock.window.size)
+                    for sock_id, sock in self.socks.items()
+                ])
+            self.sendHello(HELLO_ACK, session)
+            self.scheduler.encoder.compact = bool(self.caps & CAP_COMPACT)
+            logger.info(
+                'tunnel protocol version=%u caps=%#x',
+                version,
+                self.caps
+            )
+            if self.resuming and not self.caps & CAP_RESUME:
+                self.expireSession()
+            if self.caps & CAP_PING:
+                self.startHeartbeat()
+            self.dispatcher.tunnelReady()
+        elif HELLO_SWITCH == kind and self.caps is not None:
+            # tls 1.3 tickets may follow the offer, never the switch
+            self.tls.saveSession(self.transport.getHandle())
+            if not self.caps:
+                return
+            self.decoder.compact = bool(self.caps & CAP_COMPACT)
+            if self.caps & CAP_RESUME:
+                token, entries = unpack_resume(payload[1+HELLO_LENGTH:])
+                self.resumeSession(token, entries)
+        elif HELLO_DRAIN == kind:
+            self.dispatcher.drainTunnel(self)
+
+    def startHeartbeat(self):
+        self.heartbeat = Heartbeat(
+            self.write,
+            self.peerDead,
+            interval=self.dispatcher.ping,
+            misses=self.dispatcher.ping_misses
+        )
+        self.heartbeat.start()
+
+    def peerDead(self):
+        logger.error(
+            'tunnel dead, %u pings unanswered',
+            self.heartbeat.missed
+        )
+        # the service reconnects once the connection is lost
+        self.transport.abortConnection()
+
+    def sendHello(self, kind, session=b''):
+        """
+        type 3, ID 0:
+        +-----+------+----+-------+---------+
+        | LEN | TYPE | ID | HELLO | SESSION |
+        +-----+------+----+-------+---------+
+        |  4  |   1  |  4 |   9   |         |
+        +-----+------+----+-------+---------+
+
+        SESSION only when a lost tunnel is resumed
+        """
+        self.write(3, 0, pack_hello(kind, self.caps) + session)
+
+    def closeTunnel(self):
+        """
+        type 7:
+        +-----+------+
+        | LEN | TYPE |
+        +-----+------+
+        |  4  |   1  |
+        +-----+------+
+        """
+        self.scheduler.sendLast(7)
+
+
+class SocksDispatcher:
+
+    __slots__ = [
+        'socks',
+        'tunnels',
+        'servers',
+        'server',
+        'ssl_ctx',
+        'tls',
+        'max_frame',
+        'max_tunnels',
+        'tunnel_streams',
+        'tunnel_policy',
+        'connect_reply',
+        'window',
+        'max_chunk',
+        'priority',
+        'coalesce',
+        'open_delay',
+        'compress',
+        'caps',
+        'resume',
+        'pending_wait',
+        'pending_memory',
+        'pending',
+        'pending_bytes',
+        'ping',
+        'ping_misses',
+        'dns_queries',
+        '_next_tunnel',
+        '_next_query',
+        '__weakref__',
+    ]
+
+    def __init__(self, servers, ssl_ctx, *,
+                 max_frame=MAX_FRAME_LENGTH,
+                 tunnels=1,
+                 max_tunnels=0,
+                 tunnel_streams=64,
+                 tunnel_policy='least-loaded',
+                 connect_reply='early',
+                 window=WINDOW_SIZE,
+                 max_chunk=MAX_CHUNK,
+                 priority='',
+                 coalesce=COALESCE_DELAY,
+                 open_delay=OPEN_DELAY,
+                 compress='',
+                 resume=RESUME_GRACE,
+                 pending_wait=PENDING_WAIT,
+                 pending_memory=PENDING_MEMORY,
+                 ping=PING_INTERVAL,
+                 ping_misses=PING_MISSES):
+        if tunnel_policy not in TUNNEL_POLICIES:
+            raise RuntimeError(f'unknown tunnel policy {tunnel_policy}')
+        if connect_reply not in CONNECT_REPLIES:
+            raise RuntimeError(f'unknown connect reply {connect_reply}')
+        # sock_ids are allocated by it as the streams are accepted
+        self.socks = StreamTable()
+        self.tunnels = []
+        self.servers = servers
+        # server new streams go to, it changes with hysteresis
+        self.server = servers[0]
+        self.ssl_ctx = ssl_ctx
+        # tls sessions, one per server
+        self.tls = {}
+        self.max_frame = max_frame
+        self.max_tunnels = max(tunnels, max_tunnels)
+        self.tunnel_streams = tunnel_streams
+        self.tunnel_policy = tunnel_policy
+        self.connect_reply = connect_reply
+        self.window = window
+        self.max_chunk = max_chunk
+        self.priority = PriorityRules(priority)
+        self.coalesce = coalesce
+        self.open_delay = open_delay
+        self.caps = CAP_COMPACT | CAP_DNS | CAP_HALFCLOSE
+        if 'strict' == connect_reply:
+            self.caps |= CAP_CONNECT
+        if window:
+            self.caps |= CAP_WINDOW
+        if open_delay >= 0:
+            self.caps |= CAP_OPEN
+        self.compress = compress
+        self.caps |= codec_caps(compress)
+        self.resume = resume
+        if resume > 0 and window:
+            self.caps |= CAP_RESUME
+        self.ping = ping
+        self.ping_misses = ping_misses
+        if ping > 0:
+            self.caps |= CAP_PING
+        self.pending_wait = pending_wait
+        self.pending_memory = pending_memory
+        # streams waiting for a tunnel, in the order they came
+        self.pending = {}
+        self.pending_bytes = 0
+        self._next_tunnel = 0
+        self.dns_queries = {}
+        self._next_query = 0
+        # every server keeps its tunnels warm to fail over at once
+        for server in servers:
+            for _ in range(tunnels):
+                self.addTunnel(server)
+
+    @property
+    def isConnected(self):
+        for tunnel in self.tunnels:
+            if tunnel.isConnected:
+                return True
+        return False
+
+    def addTunnel(self, server):
+        tls = self.tls.get(server)
+        if tls is None:
+            tls = self.tls[server] = ClientTLS(self.ssl_ctx)
+        tunnel = Tunnel(self, server, tls)
+        self.tunnels.append(tunnel)
+        logger.info(
+            'proxy open tunnel[%u] to %s:%u',
+            len(self.tunnels),
+            *server
+        )
+        return tunnel
+
+    def scoreServer(self, tunnels):
+        """
+        smoothed rtt of the server stretched by the share of its streams
+        slots in use, None until its rtt is measured
+        """
+        rtts = [t.rtt for t in tunnels if t.rtt]
+        if not rtts:
+            return None
+        streams = sum(len(t.socks) for t in tunnels)
+        load = streams / (self.tunnel_streams * len(tunnels) or 1)
+        return min(rtts) * (1 + load)
+
+    def selectServer(self, tunnels):
+        if len(self.servers) < 2:
+            return self.server
+        servers = {}
+        for tunnel in tunnels:
+            servers.setdefault(tunnel.server, []).append(tunnel)
+        scores = {
+            server: self.scoreServer(group)
+            for server, group in servers.items()
+        }
+        measured = [s for s in scores if scores[s] is not None]
+        current = self.server
+        if current not in servers:
+            # fail over, unmeasured servers in the order they were given
+            best = min(measured, key=scores.get) if measured else next(
+                s for s in self.servers if s in servers
+            )
+            logger.info('server %s:%u down, streams go to %s:%u',
+                        *current, *best)
+            self.server = best
+        elif measured:
+            best = min(measured, key=scores.get)
+            score = scores[current]
+            if score is None or scores[best] < score * (1 - SWITCH_MARGIN):
+                if best != current:
+                    logger.info(
+                        'streams go to server %s:%u score=%.1fms',
+                        *best,
+                        scores[best] * 1000
+                    )
+                self.server = best
+        return self.server
+
+    def selectTunnel(self):
+        tunnels = [t for t in self.tunnels if t.isConnected]
+        if not tunnels:
+            return None
+        server = self.selectServer(tunnels)
+        tunnels = [t for t in tunnels if t.server == server]
+        if self.tunnel_policy == 'round-robin':
+            self._next_tunnel = (self._next_tunnel + 1) % len(tunnels)
+            tunnel = tunnels[self._next_tunnel]
+        elif self.tunnel_policy == 'fastest':
+            tunnel = min(tunnels, key=lambda t: (t.rtt, t.load))
+        else:
+            tunnel = min(tunnels, key=lambda t: t.load)
+        opened = [
+            t for t in self.tunnels
+            if t.server == server and not t.draining
+        ]
+        if (len(tunnel.socks) >= self.tunnel_streams and
+                len(opened) < self.max_tunnels and
+                len(tunnels) == len(opened)):
+            self.addTunnel(server)
+        return tunnel
+
+    def drainTunnel(self, tunnel):
+        """
+        a new tunnel takes over the new streams, likely from the process
+        replacing the server, this one closes once its streams are done
+        """
+        if tunnel.draining:
+            return
+        tunnel.draining = True
+        logger.info(
+            'server %s:%u draining, tunnel has %u streams',
+            *tunnel.server,
+            len(tunnel.socks)
+        )
+        self.addTunnel(tunnel.server)
+        self.retireTunnel(tunnel)
+
+    def retireTunnel(self, tunnel):
+        if tunnel.socks or tunnel not in self.tunnels:
+            return
+        self.tunnels.remove(tunnel)
+        tunnel.stopTunnel()
+        logger.info('proxy closed drained tunnel to %s:%u', *tunnel.server)
+
+    def stopDispatch(self):
+        for sock, _, _ in list(self.pending.values()):
+            self.rejectPending(sock, 'proxy stopped')
+        for tunnel in self.tunnels:
+            tunnel.stopTunnel()
+
+    def holdPending(self, sock, host, port):
+        sock.open_timer = reactor.callLater(
+            self.pending_wait,
+            self.rejectPending,
+            sock,
+            'no tunnel in time'
+        )
+        self.pending[sock.sock_id] = sock, host, port
+        logger.info('sock_id[%u] waits for a tunnel', sock.sock_id)
+
+    def bufferPending(self, sock, data):
+        if sock.sock_id not in self.pending:
+            return
+        if self.pending_bytes + len(data) > self.pending_memory:
+            self.rejectPending(sock, 'pending memory full')
+            return
+        sock.buffer += data
+        self.pending_bytes += len(data)
+
+    def dropPending(self, sock):
+        if self.pending.pop(sock.sock_id, None) is None:
+            return False
+        if sock.open_timer is not None:
+            if sock.open_timer.active():
+                sock.open_timer.cancel()
+            sock.open_timer = None
+        self.pending_bytes -= len(sock.buffer)
+        return True
+
+    def rejectPending(self, sock, reason):
+        if not self.dropPending(sock):
+            return
+        sock.buffer = b''
+        logger.error('sock_id[%u] rejected[%s]', sock.sock_id, reason)
+        sock.refuse(1)
+
+    def tunnelReady(self):
+        """
+        streams waiting for a tunnel go out in the order they came
+        """
+        if not self.pending:
+            return
+        logger.info('tunnel ready, %u streams waited', len(self.pending))
+        for sock, host, port in list(self.pending.values()):
+            self.dropPending(sock)
+            data, sock.buffer = sock.buffer, b''
+            self.connectRemote(sock, host, port)
+            if data and sock.tunnel is not None:
+                self.sendRemote(sock, data)
+            if sock.read_closed and sock.tunnel is not None:
+                self.shutdownRemote(sock)
+
+    def closeSock(self, sock_id, *, abort=False, rep=1):
         try:
             sock = self.socks[sock_id]
         except KeyError:
             logger.error('sock_id[%u] closed again', sock_id)
         else:
             del self.socks[sock_id]
+            sock.tunnel.removeSock(sock_id)
             transport = sock.transport
             if transport is None:
                 return
             if abort:
-                transport.abortConnection()
+                sock.refuse(rep)
             else:
                 transport.loseConnection()
 
-    def dispatchMessage(self, message):
-        type, = struct.unpack('!B', message[4:5])
+    def dispatchMessage(self, type, sock_id, payload):
         if 2 == type:
-            self.handleConnect(message)
+            self.handleConnect(sock_id, payload)
         elif 4 == type:
-            self.handleRemote(message)
+            self.handleRemote(sock_id, payload)
         elif 6 == type:
-            self.handleClose(message)
+            self.handleClose(sock_id)
+        elif 8 == type:
+            self.recvWindow(sock_id, payload)
+        elif 11 == type:
+            self.handleCompressed(sock_id, payload)
+        elif 13 == type:
+            self.handleDNS(sock_id, payload)
+        elif 17 == type:
+            self.handleShutdown(sock_id)
         else:
             raise RuntimeError(f'receive unknown message type={type}')
 
+    def queryDNS(self, name):
+        """
+        type 12:
+        +-----+------+----+------+
+        | LEN | TYPE | ID | NAME |
+        +-----+------+----+------+
+        |  4  |   1  |  4 |      |
+        +-----+------+----+------+
+
+        returns a Deferred firing with (code, ttl, addresses)
+        """
+        tunnel = self.selectTunnel()
+        if tunnel is None or not tunnel.caps & CAP_DNS:
+            return TwistedDefer.fail(DNSError.ResolverError(name))
+        if 2**32 - 1 == self._next_query:
+            self._next_query = 0
+        self._next_query += 1
+        query_id = self._next_query
+        d = TwistedDefer.Deferred()
+        d.addTimeout(DNS_TIMEOUT, reactor)
+        d.addBoth(self._dnsDone, query_id)
+        self.dns_queries[query_id] = d
+        tunnel.write(12, query_id, name.encode('utf-8'))
+        return d
+
+    def _dnsDone(self, result, query_id):
+        self.dns_queries.pop(query_id, None)
+        return result
+
+    def handleDNS(self, query_id, payload):
+        """
+        type 13:
+        +-----+------+----+------+-----+-----------+
+        | LEN | TYPE | ID | CODE | TTL | ADDRESSES |
+        +-----+------+----+------+-----+-----------+
+        |  4  |   1  |  4 |   1  |  4  |           |
+        +-----+------+----+------+-----+-----------+
+        """
+        d = self.dns_queries.pop(query_id, None)
+        if d is None:
+            logger.info('dns query[%u] answered late', query_id)
+            return
+        d.callback(unpack_dns_answer(payload))
+
     def connectRemote(self, sock, host, port):
         """
         type 1:
@@ -190,26 +1016,76 @@ class SocksDispatcher:
         +-----+------+----+------+------+
         """
         sock_id = sock.sock_id
+        tunnel = self.selectTunnel()
+        if tunnel is None and self.pending_wait > 0:
+            self.holdPending(sock, host, port)
+            return
+        if tunnel is None:
+            logger.error('sock_id[%u] no tunnel connected', sock_id)
+            sock.refuse(1)
+            return
+        if not sock.replied and not tunnel.caps & CAP_CONNECT:
+            # the server only answers connects that fail
+            sock.sendConnectReply(0)
+        window = self.window if tunnel.caps & CAP_WINDOW else 0
+        sock.window = StreamWindow(window, sock.sendWindow)
+        sock.window.attach(sock.transport)
+        codec = select_codec(tunnel.caps)
+        if codec:
+            sock.compressor = StreamCompressor(codec)
+            sock.decompressor = StreamDecompressor(codec, self.max_frame)
+        if tunnel.caps & CAP_RESUME:
+            sock.replay = ReplayBuffer()
         self.socks[sock_id] = sock
-        host_length = len(host)
-        total_length = 11 + host_length
+        tunnel.addSock(sock, self.priority.classify(port))
         logger.info(
             'sock_id[%u] connect %s:%u',
             sock_id,
             host.decode('utf-8'),
             port,
         )
-        message = struct.pack(
-            f'!IBI{host_length}sH',
-            total_length,
-            1,
-            sock_id,
-            host,
-            port
-        )
-        self.transport.write(message)
+        # a client waiting for its reply has no data for the open frame
+        if tunnel.caps & CAP_OPEN and sock.replied:
+            # the first data of the stream goes out in the open frame
+            sock.opening = host, port
+            sock.open_timer = reactor.callLater(
+                self.open_delay / 1e6,
+                self.openRemote,
+                sock
+            )
+            return
+        tunnel.writeFrame(sock_id, 1, host + struct.pack('!H', port))
+        sock.window.open()
 
-    def handleConnect(self, message):
+    def openRemote(self, sock):
+        """
+        type 9:
+        +-----+------+----+----------+------+------+------+
+        | LEN | TYPE | ID | HOST_LEN | HOST | PORT | DATA |
+        +-----+------+----+----------+------+------+------+
+        |  4  |   1  |  4 |     1    |      |   2  |      |
+        +-----+------+----+----------+------+------+------+
+        """
+        if sock.open_timer is not None:
+            if sock.open_timer.active():
+                sock.open_timer.cancel()
+            sock.open_timer = None
+        host, port = sock.opening
+        sock.opening = None
+        data, sock.buffer = sock.buffer, b''
+        head = data[:self.max_chunk]
+        tunnel = sock.tunnel
+        address = struct.pack('!B', len(host)) + host + struct.pack('!H', port)
+        tunnel.writeFrame(sock.sock_id, 9, address + head)
+        if sock.replay is not None:
+            sock.replay.append(head)
+        tunnel.outstanding += len(head)
+        sock.window.spend(len(head))
+        sock.window.open()
+        if len(data) > len(head):
+            self.sendRemote(sock, data[len(head):])
+
+    def handleConnect(self, sock_id, payload):
         """
         type 2:
         +-----+------+----+------+
@@ -218,11 +1094,14 @@ class SocksDispatcher:
         |  4  |   1  |  4 |   1  |
         +-----+------+----+------+
         """
-        sock_id, code = struct.unpack('!IB', message[5:10])
-        if 0 == code:
+        code = payload[0]
+        if CONNECT_OK == code:
+            sock = self.socks.get(sock_id)
+            if sock is not None and not sock.replied:
+                sock.sendConnectReply(0)
             return
-        logger.info('sock_id[%u] connect failed', sock_id)
-        self.closeSock(sock_id, abort=True)
+        logger.info('sock_id[%u] connect failed[code=%u]', sock_id, code)
+        self.closeSock(sock_id, abort=True, rep=SOCKS_REPLIES.get(code, 1))
 
     def sendRemote(self, sock, data):
         """
@@ -232,7 +1111,21 @@ class SocksDispatcher:
         +-----+------+----+------+
         |  4  |   1  |  4 |      |
         +-----+------+----+------+
+
+        type 10:
+        +-----+------+----+-----------------+
+        | LEN | TYPE | ID | COMPRESSED DATA |
+        +-----+------+----+-----------------+
+        |  4  |   1  |  4 |                 |
+        +-----+------+----+-----------------+
         """
+        if sock.tunnel is None:
+            self.bufferPending(sock, data)
+            return
+        if sock.opening is not None:
+            sock.buffer += data
+            self.openRemote(sock)
+            return
         sock_id = sock.sock_id
         logger.debug(
             'sock_id[%u] send data length=%u to %s:%u',
@@ -241,16 +1134,23 @@ class SocksDispatcher:
             sock.remote_host,
             sock.remote_port
         )
-        total_length = 9 + len(data)
-        header = struct.pack(
-            f'!IBI',
-            total_length,
-            3,
-            sock_id,
-        )
-        self.transport.writeSequence([header, data])
+        tunnel = sock.tunnel
+        if sock.replay is not None:
+            sock.replay.append(data)
+        if sock.held:
+            # goes out from the replay buffer once the tunnel is back
+            tunnel.outstanding += len(data)
+            sock.window.spend(len(data))
+            return
+        if sock.compressor is None:
+            tunnel.writeData(sock_id, 3, data)
+        else:
+            for packed, payload in sock.compressor.split(data, self.max_chunk):
+                tunnel.writeData(sock_id, 10 if packed else 3, payload)
+        tunnel.outstanding += len(data)
+        sock.window.spend(len(data))
 
-    def handleRemote(self, message):
+    def handleRemote(self, sock_id, data):
         """
         type 4:
         +-----+------+----+------+
@@ -259,8 +1159,6 @@ class SocksDispatcher:
         |  4  |   1  |  4 |      |
         +-----+------+----+------+
         """
-        sock_id, = struct.unpack(f'!I', message[5:9])
-        data = message[9:]
         try:
             sock = self.socks[sock_id]
         except KeyError:
@@ -273,7 +1171,25 @@ class SocksDispatcher:
                 sock.remote_host,
                 sock.remote_port
             )
-            sock.transport.write(data)
+            sock.transport.write(bytes(data))
+            sock.received += len(data)
+            sock.window.consume(len(data))
+
+    def handleCompressed(self, sock_id, payload):
+        """
+        type 11:
+        +-----+------+----+-----------------+
+        | LEN | TYPE | ID | COMPRESSED DATA |
+        +-----+------+----+-----------------+
+        |  4  |   1  |  4 |                 |
+        +-----+------+----+-----------------+
+        """
+        try:
+            sock = self.socks[sock_id]
+        except KeyError:
+            logger.error('sock_id[%u] receive data after closed', sock_id)
+        else:
+            self.handleRemote(sock_id, sock.decompressor.decompress(payload))
 
     def closeRemote(self, sock):
         """
@@ -285,19 +1201,23 @@ class SocksDispatcher:
         +-----+------+----+
         """
         sock_id = sock.sock_id
+        if self.dropPending(sock):
+            logger.info('sock_id[%u] local closed while waiting', sock_id)
+            return
+        if sock.open_timer is not None:
+            sock.open_timer.cancel()
+            sock.open_timer = None
         if sock_id not in self.socks:
             return
         logger.info('sock_id[%u] local closed', sock_id)
         self.closeSock(sock_id)
-        message = struct.pack(
-            '!IBI',
-            9,
-            5,
-            sock_id
-        )
-        self.transport.write(message)
+        if sock.opening is not None:
+            # the server has never heard of this stream
+            sock.opening = None
+            return
+        sock.tunnel.writeFrame(sock_id, 5)
 
-    def handleClose(self, message):
+    def handleClose(self, sock_id):
         """
         type 6:
         +-----+------+----+
@@ -306,27 +1226,92 @@ class SocksDispatcher:
         |  4  |   1  |  4 |
         +-----+------+----+
         """
-        sock_id, = struct.unpack('!I', message[5:])
         logger.info('sock_id[%u] remote closed', sock_id)
         self.closeSock(sock_id, abort=True)
 
-    def closeTunnel(self):
+    def shutdownRemote(self, sock):
         """
-        type 7:
-        +-----+------+
-        | LEN | TYPE |
-        +-----+------+
-        |  4  |   1  |
-        +-----+------+
+        type 16:
+        +-----+------+----+
+        | LEN | TYPE | ID |
+        +-----+------+----+
+        |  4  |   1  |  4 |
+        +-----+------+----+
         """
-        message = struct.pack(
-            '!IB',
-            5,
-            7
-        )
-        self.transport.write(message)
+        sock_id = sock.sock_id
+        if sock_id in self.pending or sock.held:
+            # goes out once the stream has its tunnel
+            return
+        tunnel = sock.tunnel
+        if sock_id not in self.socks or not tunnel.caps & CAP_HALFCLOSE:
+            # the server only knows whole closes
+            sock.transport.loseConnection()
+            return
+        if sock.opening is not None:
+            self.openRemote(sock)
+        logger.info('sock_id[%u] local shut down writing', sock_id)
+        tunnel.writeFrame(sock_id, 16)
+        if sock.write_closed:
+            self.closeSock(sock_id)
+
+    def handleShutdown(self, sock_id):
+        """
+        type 17:
+        +-----+------+----+
+        | LEN | TYPE | ID |
+        +-----+------+----+
+        |  4  |   1  |  4 |
+        +-----+------+----+
+
+        the remote is done writing, the client gets its fin once the
+        bytes before it are written
+        """
+        sock = self.socks.get(sock_id)
+        if sock is None or sock.write_closed:
+            return
+        logger.info('sock_id[%u] remote shut down writing', sock_id)
+        sock.write_closed = True
+        if sock.read_closed:
+            self.closeSock(sock_id)
+        else:
+            sock.window.shutdown()
+
+    def sendWindow(self, sock, increment):
+        """
+        type 8:
+        +-----+------+----+-----------+----------+
+        | LEN | TYPE | ID | INCREMENT | RECEIVED |
+        +-----+------+----+-----------+----------+
+        |  4  |   1  |  4 |     4     |     8    |
+        +-----+------+----+-----------+----------+
+
+        RECEIVED only once sessions resume
+        """
+        received = None if sock.replay is None else sock.received
+        payload = pack_window(increment, received)
+        # stream ordered, the first grant must not overtake the open frame
+        sock.tunnel.writeFrame(sock.sock_id, 8, payload)
+
+    def recvWindow(self, sock_id, payload):
+        """
+        type 8:
+        +-----+------+----+-----------+----------+
+        | LEN | TYPE | ID | INCREMENT | RECEIVED |
+        +-----+------+----+-----------+----------+
+        |  4  |   1  |  4 |     4     |     8    |
+        +-----+------+----+-----------+----------+
+        """
+        increment, received = unpack_window(payload)
+        try:
+            sock = self.socks[sock_id]
+        except KeyError:
+            return
+        sock.tunnel.outstanding -= sock.window.grant(increment)
+        if received is not None and sock.replay is not None:
+            sock.replay.ack(received)
 
 
+@ZopeInterface.implementer(TwistedInterface.IHalfCloseableProtocol)
 class Socks5Protocol(TwistedProtocol.Protocol):
 
     def connectionMade(self):
@@ -334,14 +1319,43 @@ class Socks5Protocol(TwistedProtocol.Protocol):
         self.dispatcher = weakref.proxy(dispatcher)
         self.remote_host = None
         self.remote_port = None
+        self.tunnel = None
+        self.window = None
+        self.opening = None
+        self.open_timer = None
+        self.compressor = None
+        self.decompressor = None
+        # unacknowledged bytes and bytes received, once sessions resume
+        self.replay = None
+        self.received = 0
+        self.held = False
+        self.replied = False
+        # the client has sent its fin, the remote has sent its own
+        self.read_closed = False
+        self.write_closed = False
         self.state = 'waitHello'
         self.buffer = b''
-        self.sock_id = self.factory.sock_id
-        if not dispatcher.isConnected:
+        self.sock_id = dispatcher.socks.allocate()
+        # waits for a reconnecting tunnel once the handshake is done
+        if not dispatcher.isConnected and dispatcher.pending_wait <= 0:
             self.transport.abortConnection()
 
     def connectionLost(self, reason):
         self.dispatcher.closeRemote(self)
+        self.dispatcher.socks.release(self.sock_id)
+
+    def readConnectionLost(self):
+        if self.read_closed:
+            return
+        self.read_closed = True
+        if 'sendRemote' != self.state:
+            # the handshake is cut short
+            self.transport.loseConnection()
+            return
+        self.dispatcher.shutdownRemote(self)
+
+    def writeConnectionLost(self):
+        pass
 
     def dataReceived(self, data):
         method = getattr(self, self.state)
@@ -366,9 +1380,12 @@ class Socks5Protocol(TwistedProtocol.Protocol):
             return
         for method in self.buffer[2:2+nmethods]:
             if method == 0:
-                self.buffer = b''
+                # a pipelined connect request may follow in the same read
+                self.buffer = self.buffer[2+nmethods:]
                 self.state = 'waitConnectRemote'
                 self.sendHelloReply(0)
+                if self.buffer:
+                    self.waitConnectRemote(b'')
                 return
         self.sendHelloReply(0xFF)
         self.transport.loseConnection()
@@ -411,6 +1428,7 @@ class Socks5Protocol(TwistedProtocol.Protocol):
             ip1, ip2, ip3, ip4 = struct.unpack('!BBBB', self.buffer[4:8])
             host = f'{ip1}.{ip2}.{ip3}.{ip4}'.encode('utf-8')
             port, = struct.unpack('!H', self.buffer[8:10])
+            end = 10
         elif atyp == 3:
             if len(self.buffer) < 5:
                 return
@@ -419,7 +1437,8 @@ class Socks5Protocol(TwistedProtocol.Protocol):
                 return
             host = self.buffer[5:5+length]
             port, = struct.unpack('!H', self.buffer[5+length:7+length])
-        self.connectRemote(host, port)
+            end = 7 + length
+        self.connectRemote(host, port, self.buffer[end:])
 
     def sendConnectReply(self, rep):
         response = struct.pack(
@@ -435,41 +1454,53 @@ class Socks5Protocol(TwistedProtocol.Protocol):
             0
         )
         self.transport.write(response)
+        self.replied = True
+
+    def refuse(self, rep):
+        """
+        a client still waiting for its connect reply is told why before
+        the close, one already answered is cut
+        """
+        if self.replied:
+            self.transport.abortConnection()
+            return
+        self.sendConnectReply(rep)
+        self.transport.loseConnection()
 
-    def connectRemote(self, host, port):
-        self.sendConnectReply(0)
+    def connectRemote(self, host, port, data=b''):
+        if 'early' == self.dispatcher.connect_reply:
+            # the client sends its data while the server connects
+            self.sendConnectReply(0)
         self.remote_host = host.decode('utf-8').strip()
         self.remote_port = port
         self.buffer = b''
         self.state = 'sendRemote'
         self.dispatcher.connectRemote(self, host, port)
+        # pipelined payload goes out with the open frame
+        if data:
+            self.sendRemote(data)
 
     def sendRemote(self, data):
         self.dispatcher.sendRemote(self, data)
 
+    def sendWindow(self, increment):
+        self.dispatcher.sendWindow(self, increment)
+
 
 class Socks5Factory(TwistedProtocol.ServerFactory):
 
     protocol = Socks5Protocol
 
-    def __init__(self, address, port, ssl_ctx):
-        self._sock_id = 0
+    def __init__(self, servers, ssl_ctx, **kwargs):
         self.dispatcher = SocksDispatcher(
-            address,
-            port,
-            ssl_ctx
+            servers,
+            ssl_ctx,
+            **kwargs
         )
 
     def shutdown(self):
         self.dispatcher.stopDispatch()
 
-    @property
-    def sock_id(self):
-        if 2**32 - 1 == self._sock_id:
-            self._sock_id = 0
-        self._sock_id = self._sock_id + 1
-        return self._sock_id
-
 
 def _create_ssl_context(config):
 
@@ -487,20 +1518,55 @@ def _create_ssl_context(config):
         config['key'],
         config['cert'],
         dhparam=config['dhparam'],
-        callback=verify
+        callback=verify,
+        ciphers=config['ciphers'],
+        tls_min=config['tls_min']
     )
 
 
 def serve(config):
     ssl_ctx = _create_ssl_context(config)
     address, port = config['host'], config['port']
-    remote_addr, remote_port = config['saddr'], config['sport']
+    servers = parse_servers(config['saddr'], config['sport'])
     factory = Socks5Factory(
-        remote_addr,
-        remote_port,
-        ssl_ctx
+        servers,
+        ssl_ctx,
+        max_frame=config['max_frame'],
+        tunnels=config['tunnels'],
+        max_tunnels=config['max_tunnels'],
+        tunnel_streams=config['tunnel_streams'],
+        tunnel_policy=config['tunnel_policy'],
+        connect_reply=config['connect_reply'],
+        window=config['window'],
+        max_chunk=config['max_chunk'],
+        priority=config['priority'],
+        coalesce=config['coalesce'],
+        open_delay=config['open_delay'],
+        compress=config['compress'],
+        resume=config['resume'],
+        pending_wait=config['pending_wait'],
+        pending_memory=config['pending_memory'],
+        ping=config['ping'],
+        ping_misses=config['ping_misses'],
     )
 
+    ports = {}
+    if config['dns_listen']:
+        resolver = TunnelResolver(
+            factory.dispatcher.queryDNS,
+            DNSCache()
+        )
+        try:
+            ports['dns-udp'], ports['dns-tcp'] = listen_dns(
+                config['dns_listen'],
+                address,
+                resolver
+            )
+        except TwistedError.CannotListenError:
+            raise RuntimeError(
+                f"couldn't listen dns on :{config['dns_listen']}"
+            )
+
     def shutdown():
         logger.info('proxy stop running')
         factory.shutdown()
@@ -511,31 +1577,48 @@ def serve(config):
         shutdown
     )
 
+    fd = inherited_fd('socks')
     try:
-        reactor.listenTCP(
-            port,
-            factory,
-            interface=address
-        )
+        if fd is None:
+            ports['socks'] = reactor.listenTCP(
+                port,
+                factory,
+                interface=address
+            )
+        else:
+            ports['socks'] = adopt_port(fd, factory)
     except TwistedError.CannotListenError:
         raise RuntimeError(
             f"couldn't listen on :{port}, address already in use"
         )
+    dispatcher = factory.dispatcher
+    Upgrader(
+        's54http.proxy',
+        ports,
+        reload=functools.partial(reload_certificates, ssl_ctx),
+        active=lambda: len(dispatcher.socks) + len(dispatcher.pending),
+        drain=config['drain']
+    ).install()
+    notify_ready()
+    logger.info('proxy running on %s ...', describe_engine())
     reactor.run()
 
 
 def main():
     parse_args(config)
-    if not config['saddr']:
+    install_engine(config['engine'])
+    if not parse_servers(config['saddr'], config['sport']):
         raise RuntimeError('no server address found')
     init_logger(config, logger)
+    init_logger(config, logging.getLogger('s54http.upgrade'))
     if config['daemon']:
         pidfile = config['pidfile']
         logfile = config['logfile']
         daemonize(
             pidfile,
             stdout=logfile,
-            stderr=logfile
+            stderr=logfile,
+            replace=upgrading()
         )
     serve(config)
 
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+
+import collections
+
+from twisted.internet import (
+    defer as TwistedDefer,
+    reactor,
+)
+from twisted.names import (
+    client as TwistedDNS,
+    error as DNSError,
+)
+from twisted.python import failure as TwistedFailure
+
+
+__all__ = [
+    'RacingResolver',
+    'parse_nameservers',
+]
+
+
+# seconds before asking the next nameserver when nothing is known yet
+HEDGE_DELAY = 0.1
+MIN_HEDGE_DELAY = 0.005
+MAX_HEDGE_DELAY = 1.0
+HEDGE_PERCENTILE = 0.9
+# latency charged to a nameserver that failed to answer
+FAILURE_PENALTY = 1.0
+SAMPLES = 32
+
+
+def parse_nameservers(dns):
+    """
+    dns: addr[:port],addr[:port],..., an ipv6 addr with a port is
+    written [addr]:port
+
+    >>> parse_nameservers('8.8.8.8,1.1.1.1:5353,::1,[2001:4860::8888]:54')
+    [('8.8.8.8', 53), ('1.1.1.1', 5353), ('::1', 53), ('2001:4860::8888', 54)]
+    """
+    servers = []
+    for item in (dns or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if item.startswith('['):
+            address, _, port = item[1:].partition(']')
+            port = port[1:] if port.startswith(':') else ''
+            servers.append((address, int(port) if port else 53))
+        elif 1 == item.count(':'):
+            address, port = item.split(':')
+            servers.append((address, int(port)))
+        else:
+            servers.append((item, 53))
+    return servers
+
+
+class Nameserver:
+
+    __slots__ = [
+        'address',
+        'resolver',
+        'srtt',
+        'samples',
+        'answers',
+        'failures',
+    ]
+
+    def __init__(self, address, resolver):
+        self.address = address
+        self.resolver = resolver
+        # unmeasured nameservers are tried first
+        self.srtt = 0.0
+        self.samples = collections.deque(maxlen=SAMPLES)
+        self.answers = 0
+        self.failures = 0
+
+    def sample(self, latency):
+        if self.samples:
+            self.srtt += (latency - self.srtt) / 8
+        else:
+            self.srtt = latency
+        self.samples.append(latency)
+        self.answers += 1
+
+    def fail(self, latency):
+        self.failures += 1
+        self.sample(max(latency, FAILURE_PENALTY))
+
+    @property
+    def hedgeDelay(self):
+        if not self.samples:
+            return HEDGE_DELAY
+        samples = sorted(self.samples)
+        index = min(int(len(samples) * HEDGE_PERCENTILE), len(samples) - 1)
+        return min(max(samples[index], MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+
+class Query:
+
+    __slots__ = [
+        'method',
+        'name',
+        'servers',
+        'next',
+        'outstanding',
+        'done',
+        'timer',
+    ]
+
+    def __init__(self, method, name, servers):
+        self.method = method
+        self.name = name
+        self.servers = servers
+        self.next = 0
+        self.outstanding = 0
+        self.done = False
+        self.timer = None
+
+
+class RacingResolver:
+    """
+    asks the nameservers with the lowest smoothed latency first, `race`
+    of them at once, and the next one whenever the last one asked hasn't
+    answered within its latency percentile. concurrent lookups of one
+    name share a query.
+    """
+
+    __slots__ = [
+        'nameservers',
+        'race',
+        'queries',
+        'coalesced',
+        'hedged',
+        '_inflight',
+    ]
+
+    def __init__(self, servers=None, *, race=1):
+        if servers:
+            self.nameservers = [
+                Nameserver(
+                    f'{address}:{port}',
+                    TwistedDNS.createResolver(servers=[(address, port)])
+                )
+                for address, port in servers
+            ]
+        else:
+            self.nameservers = [
+                Nameserver('system', TwistedDNS.createResolver())
+            ]
+        self.race = max(race, 1)
+        self.queries = 0
+        self.coalesced = 0
+        self.hedged = 0
+        self._inflight = {}
+
+    def stats(self):
+        return {
+            'queries': self.queries,
+            'coalesced': self.coalesced,
+            'hedged': self.hedged,
+            'nameservers': [
+                (ns.address, ns.srtt, ns.answers, ns.failures)
+                for ns in self.nameservers
+            ],
+        }
+
+    def lookupAddress(self, name):
+        return self._lookup('lookupAddress', name)
+
+    def lookupIPV6Address(self, name):
+        return self._lookup('lookupIPV6Address', name)
+
+    def _lookup(self, method, name):
+        d = TwistedDefer.Deferred()
+        key = method, name
+        waiters = self._inflight.get(key)
+        if waiters is not None:
+            self.coalesced += 1
+            waiters.append(d)
+            return d
+        self._inflight[key] = [d]
+        self.queries += 1
+        servers = sorted(self.nameservers, key=lambda ns: ns.srtt)
+        query = Query(method, name, servers)
+        for _ in range(self.race):
+            if query.done or not self._ask(query):
+                break
+        return d
+
+    def _ask(self, query):
+        if query.next >= len(query.servers):
+            return False
+        ns = query.servers[query.next]
+        query.next += 1
+        query.outstanding += 1
+        start = reactor.seconds()
+        lookup = getattr(ns.resolver, query.method)
+        lookup(query.name).addCallbacks(
+            self._answered,
+            self._failed,
+            callbackArgs=(query, ns, start),
+            errbackArgs=(query, ns, start)
+        )
+        if (not query.done and query.timer is None and
+                query.next < len(query.servers)):
+            query.timer = reactor.callLater(
+                ns.hedgeDelay,
+                self._hedge,
+                query
+            )
+        return True
+
+    def _hedge(self, query):
+        query.timer = None
+        if query.done:
+            return
+        self.hedged += 1
+        self._ask(query)
+
+    def _answered(self, records, query, ns, start):
+        query.outstanding -= 1
+        ns.sample(reactor.seconds() - start)
+        self._finish(query, records)
+
+    def _failed(self, failure, query, ns, start):
+        query.outstanding -= 1
+        elapsed = reactor.seconds() - start
+        if failure.check(DNSError.DNSNameError):
+            # the name doesn't exist, no other nameserver will differ
+            ns.sample(elapsed)
+            self._finish(query, failure)
+            return
+        ns.fail(elapsed)
+        if query.done:
+            return
+        if not self._ask(query) and not query.outstanding:
+            self._finish(query, failure)
+
+    def _finish(self, query, result):
+        if query.done:
+            return
+        query.done = True
+        if query.timer is not None:
+            query.timer.cancel()
+            query.timer = None
+        for d in self._inflight.pop((query.method, query.name), ()):
+            if isinstance(result, TwistedFailure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
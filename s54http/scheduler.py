@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+
+import collections
+
+from twisted.internet import interfaces as TwistedInterface
+from zope import interface as ZopeInterface
+
+from s54http.coalesce import (
+    COALESCE_DELAY,
+    WriteCoalescer,
+)
+from s54http.frame import FrameEncoder
+
+
+__all__ = [
+    'DEFAULT_PRIORITY',
+    'FrameScheduler',
+    'MAX_CHUNK',
+    'PriorityRules',
+]
+
+
+MAX_CHUNK = 2**14
+DEFAULT_PRIORITY = 1
+# queued bytes at which the socks of the tunnel stop being read
+HIGH_WATER = 2**22
+LOW_WATER = 2**20
+
+
+class PriorityRules:
+    """
+    rule: PORT[-PORT][=CLASS],...
+
+    class 0 is served first, listed ports default to class 0 and
+    every other port is DEFAULT_PRIORITY.
+    """
+
+    __slots__ = ['rules']
+
+    def __init__(self, rule=''):
+        self.rules = []
+        for item in (rule or '').split(','):
+            item = item.strip()
+            if not item:
+                continue
+            ports, _, priority = item.partition('=')
+            low, _, high = ports.partition('-')
+            try:
+                low = int(low)
+                high = int(high) if high else low
+                priority = int(priority) if priority else 0
+            except ValueError:
+                raise RuntimeError(f'invalid priority rule {item}')
+            self.rules.append((low, high, priority))
+
+    def classify(self, port):
+        for low, high, priority in self.rules:
+            if low <= port <= high:
+                return priority
+        return DEFAULT_PRIORITY
+
+
+class StreamQueue:
+
+    __slots__ = [
+        'priority',
+        'frames',
+        'deficit',
+        'closing',
+    ]
+
+    def __init__(self, priority):
+        self.priority = priority
+        # an idle stream holds no queue, most of them are idle
+        self.frames = None
+        self.deficit = 0
+        self.closing = False
+
+
+@ZopeInterface.implementer(TwistedInterface.IPushProducer)
+class FrameScheduler:
+    """
+    outbound frames of one tunnel. frames go straight to the transport
+    while it accepts data, once it pauses they are queued per stream
+    and served by deficit round-robin, lower priority class first.
+    """
+
+    __slots__ = [
+        'transport',
+        'writer',
+        'encoder',
+        'producer',
+        'max_chunk',
+        'quantum',
+        'queued',
+        'streams',
+        'active',
+        'control',
+        '_paused',
+        '_throttled',
+    ]
+
+    def __init__(self, transport, *,
+                 producer=None,
+                 max_chunk=MAX_CHUNK,
+                 coalesce=COALESCE_DELAY):
+        self.transport = transport
+        self.writer = WriteCoalescer(transport, delay=coalesce)
+        self.encoder = FrameEncoder()
+        self.producer = producer
+        self.max_chunk = max_chunk
+        self.quantum = max_chunk + 9
+        self.queued = 0
+        self.streams = {}
+        self.active = []
+        self.control = collections.deque()
+        self._paused = False
+        self._throttled = False
+        transport.registerProducer(self, True)
+
+    def stats(self):
+        stats = self.writer.stats()
+        stats['queued'] = self.queued
+        stats['streams'] = len(self.streams)
+        return stats
+
+    def flush(self):
+        self.writer.flush()
+
+    def _updateBypass(self):
+        # a lone interactive stream gets its frames written at once
+        streams = self.streams
+        if len(streams) > 1:
+            bypass = False
+        elif streams:
+            stream, = streams.values()
+            bypass = stream.priority < DEFAULT_PRIORITY
+        else:
+            bypass = True
+        if bypass != self.writer.bypass:
+            self.writer.setBypass(bypass)
+
+    def openStream(self, sock_id, priority=DEFAULT_PRIORITY):
+        self.streams[sock_id] = StreamQueue(priority)
+        while len(self.active) <= priority:
+            self.active.append(collections.deque())
+        self._updateBypass()
+
+    def closeStream(self, sock_id):
+        stream = self.streams.get(sock_id)
+        if stream is None:
+            return
+        if stream.frames:
+            stream.closing = True
+        else:
+            del self.streams[sock_id]
+            self._updateBypass()
+
+    def sendControl(self, type, sock_id=None, payload=b''):
+        self._sendControl(self.encoder.pack(type, sock_id, payload))
+
+    def _sendControl(self, message):
+        if self._paused:
+            self.control.append(message)
+            self._queue(len(message))
+        else:
+            self.writer.write(message)
+
+    def sendLast(self, type, sock_id=None, payload=b''):
+        """
+        the queued control frames and this one go to the transport at
+        once, even while paused, as the tunnel is closed right after
+        """
+        self.writer.flush()
+        control = self.control
+        parts = []
+        while control:
+            message = control.popleft()
+            parts.append(message)
+            self.queued -= len(message)
+        parts.append(self.encoder.pack(type, sock_id, payload))
+        self.transport.write(b''.join(parts))
+
+    def sendFrame(self, sock_id, type, payload=b''):
+        message = self.encoder.pack(type, sock_id, payload)
+        stream = self.streams.get(sock_id)
+        if stream is None:
+            self._sendControl(message)
+        else:
+            self._send(sock_id, stream, len(message), (message,))
+
+    def sendData(self, sock_id, type, data):
+        stream = self.streams.get(sock_id)
+        header = self.encoder.header
+        max_chunk = self.max_chunk
+        length = len(data)
+        for offset in range(0, length, max_chunk):
+            if length > max_chunk:
+                chunk = data[offset:offset+max_chunk]
+            else:
+                chunk = data
+            head = header(type, sock_id, len(chunk))
+            if stream is None:
+                self._sendControl(head + chunk)
+            else:
+                size = len(head) + len(chunk)
+                self._send(sock_id, stream, size, (head, chunk))
+
+    def _send(self, sock_id, stream, size, parts):
+        if not self._paused and not stream.frames:
+            self.writer.writeSequence(parts)
+            return
+        if not stream.frames:
+            self.active[stream.priority].append(sock_id)
+            stream.frames = collections.deque()
+        stream.frames.append((size, parts))
+        self._queue(size)
+
+    def _queue(self, size):
+        self.queued += size
+        if (not self._throttled and self.producer is not None and
+                self.queued > HIGH_WATER):
+            self._throttled = True
+            self.producer.pauseProducing()
+
+    def _dequeue(self, size):
+        self.queued -= size
+        if self._throttled and self.queued < LOW_WATER:
+            self._throttled = False
+            self.producer.resumeProducing()
+
+    def _drain(self):
+        writer = self.writer
+        while not self._paused:
+            if self.control:
+                message = self.control.popleft()
+                writer.write(message)
+                self._dequeue(len(message))
+                continue
+            for active in self.active:
+                if active:
+                    break
+            else:
+                return
+            sock_id = active.popleft()
+            stream = self.streams[sock_id]
+            stream.deficit += self.quantum
+            frames = stream.frames
+            while frames and not self._paused:
+                size, parts = frames[0]
+                if size > stream.deficit:
+                    break
+                frames.popleft()
+                stream.deficit -= size
+                writer.writeSequence(parts)
+                self._dequeue(size)
+            if frames:
+                active.append(sock_id)
+            else:
+                stream.deficit = 0
+                stream.frames = None
+                if stream.closing:
+                    del self.streams[sock_id]
+                    self._updateBypass()
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._drain()
+
+    def stopProducing(self):
+        self._paused = True
+        self.writer.close()
+        self.control.clear()
+        self.streams.clear()
+        self.active = []
+        self.queued = 0
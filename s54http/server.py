@@ -2,31 +2,126 @@
 # -*- coding: utf-8 -*-
 
 
+import functools
 import gc
 import logging
+import os
 import re
+import signal
+import socket
 import struct
 import weakref
 
 from twisted.names import (
-    client as TwistedDNS,
     dns as DNS,
+    error as DNSError,
 )
 from twisted.internet import (
+    abstract as TwistedAbstract,
+    defer as TwistedDefer,
     error as TwistedError,
     interfaces as TwistedInterface,
     protocol as TwistedProtocol,
     reactor,
+    task as TwistedTask,
 )
+from twisted.python import failure as TwistedFailure
 from zope import interface as ZopeInterface
 
+from s54http.coalesce import COALESCE_DELAY
+from s54http.compress import (
+    codec_caps,
+    select_codec,
+    StreamCompressor,
+    StreamDecompressor,
+)
+from s54http.connect import (
+    CONNECT_DELAY,
+    connect_code,
+    connect_tcp,
+)
+from s54http.engine import (
+    describe_engine,
+    install_engine,
+)
+from s54http.flow import (
+    StreamWindow,
+    WINDOW_SIZE,
+)
+from s54http.frame import (
+    CAP_COMPACT,
+    CAP_CONNECT,
+    CAP_DNS,
+    CAP_HALFCLOSE,
+    CAP_OPEN,
+    CAP_PING,
+    CAP_RESUME,
+    CAP_WINDOW,
+    CONNECT_FAILED,
+    CONNECT_HOSTUNREACH,
+    CONNECT_NXDOMAIN,
+    CONNECT_OK,
+    FrameDecoder,
+    FrameError,
+    HELLO_ACK,
+    HELLO_DRAIN,
+    HELLO_LENGTH,
+    HELLO_OFFER,
+    HELLO_SWITCH,
+    MAX_FRAME_LENGTH,
+    pack_hello,
+    unpack_hello,
+)
+from s54http.heartbeat import (
+    Heartbeat,
+    PING_INTERVAL,
+    PING_MISSES,
+)
+from s54http.nameserver import (
+    DNS_NXDOMAIN,
+    DNS_OK,
+    DNS_SERVFAIL,
+    pack_dns_answer,
+)
+from s54http.resolver import (
+    parse_nameservers,
+    RacingResolver,
+)
+from s54http.scheduler import (
+    FrameScheduler,
+    MAX_CHUNK,
+    PriorityRules,
+)
+from s54http.session import (
+    new_token,
+    pack_resume,
+    pack_window,
+    ReplayBuffer,
+    RESUME_GRACE,
+    unpack_resume,
+    unpack_window,
+)
+from s54http.upgrade import (
+    DRAIN_TIMEOUT,
+    inherited_fd,
+    notify_ready,
+    reload_certificates,
+    Upgrader,
+    upgrading,
+)
 from s54http.utils import (
-    Cache,
     daemonize,
+    DNSCache,
     init_logger,
     NullProxy,
     parse_args,
     SSLCtxFactory,
+    TICKET_ROTATE,
+)
+from s54http.workers import (
+    listen_ssl,
+    report_stats,
+    WorkerPool,
 )
 
 
@@ -43,13 +138,132 @@ config = {
     'logfile': 'server.log',
     'loglevel': 'INFO',
     'dns': None,
+    'dns_race': 1,
+    'dns_cache_file': '',
+    'dns_cache_save': 300,
+    'dns_prefetch': 0,
+    'dns_cache': 1024,
+    'dns_min_ttl': 5,
+    'dns_max_ttl': 3600,
+    'dns_negative_ttl': 30,
+    'max_frame': MAX_FRAME_LENGTH,
+    'window': WINDOW_SIZE,
+    'max_chunk': MAX_CHUNK,
+    'priority': '',
+    'coalesce': COALESCE_DELAY,
+    'fastopen': False,
+    'connect_delay': 250,
+    'compress': 'zstd,lz4,zlib',
+    'resume': RESUME_GRACE,
+    'ciphers': 'auto',
+    'tls_min': '1.2',
+    'ticket_rotate': TICKET_ROTATE,
+    'ping': PING_INTERVAL,
+    'ping_misses': PING_MISSES,
+    'drain': DRAIN_TIMEOUT,
+    'engine': None,
+    'workers': 1,
+    # index of this worker process, 0 when not a worker
+    'worker': 0,
 }
 _IP = re.compile(r'[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}')
+# seconds tunnels wait for the hottest names to be resolved at start
+PREFETCH_TIMEOUT = 5
+# seconds to wait for the AAAA answer once the A answer is in
+RESOLUTION_DELAY = 0.05
+
+
+def _interleave(first, second):
+    addresses = []
+    for index in range(max(len(first), len(second))):
+        addresses.extend(first[index:index+1])
+        addresses.extend(second[index:index+1])
+    return addresses
+
+
+def resolve(resolver, cache, host):
+    """
+    looks up the ipv6 and ipv4 addresses of host and caches them
+    interleaved, ipv6 first as rfc 8305 asks. the AAAA answer is waited
+    for RESOLUTION_DELAY at most once the A answer is in. NXDOMAIN,
+    SERVFAIL and answers without any address are cached as failures.
+    """
+    d = TwistedDefer.Deferred()
+    answers = {}
+    timer = []
+
+    def addresses(rtype):
+        result = answers.get(rtype)
+        if result is None or isinstance(result, TwistedFailure.Failure):
+            return [], []
+        records = [a for a in result[0] if a.type == rtype]
+        if DNS.A == rtype:
+            found = [a.payload.dottedQuad().strip() for a in records]
+        else:
+            found = [
+                socket.inet_ntop(socket.AF_INET6, a.payload.address)
+                for a in records
+            ]
+        return found, [a.ttl for a in records]
+
+    def finish():
+        if d.called:
+            return
+        if timer and timer[0].active():
+            timer[0].cancel()
+        ipv6, ttl6 = addresses(DNS.AAAA)
+        ipv4, ttl4 = addresses(DNS.A)
+        if ipv6 or ipv4:
+            found = _interleave(ipv6, ipv4)
+            cache.put(host, found, min(ttl6 + ttl4))
+            d.callback(found)
+            return
+        failures = [
+            f for f in answers.values()
+            if isinstance(f, TwistedFailure.Failure)
+        ]
+        if failures:
+            failure = failures[-1]
+        else:
+            failure = TwistedFailure.Failure(RuntimeError('no address found'))
+        final = (DNSError.DNSNameError, DNSError.DNSServerError)
+        if all(f.check(*final) for f in failures):
+            # kept to answer the next lookups as this one
+            cache.putNegative(host, failure.value)
+        d.errback(failure)
+
+    def answered(result, rtype):
+        answers[rtype] = result
+        if 2 == len(answers):
+            finish()
+        elif DNS.A == rtype and not d.called:
+            timer.append(reactor.callLater(RESOLUTION_DELAY, finish))
+
+    resolver.lookupIPV6Address(host).addBoth(answered, DNS.AAAA)
+    resolver.lookupAddress(host).addBoth(answered, DNS.A)
+    return d
+
 
+def refresh(resolver, cache, host):
+
+    def failed(f):
+        logger.info(
+            'refresh host[%s] failed[%s]',
+            host,
+            f.getErrorMessage()
+        )
 
+    resolve(resolver, cache, host).addErrback(failed)
+
+
+@ZopeInterface.implementer(TwistedInterface.IHalfCloseableProtocol)
 class RemoteProtocol(TwistedProtocol.Protocol):
 
     def connectionMade(self):
+        if not self.factory.connected(self.transport.connector):
+            # another address of the stream won the race
+            self.transport.abortConnection()
+            return
         self.proxy = self.factory.proxy
         try:
             self.proxy.connectOk(self.transport)
@@ -62,22 +276,94 @@ class RemoteProtocol(TwistedProtocol.Protocol):
         except ReferenceError:
             self.transport.abortConnection()
 
+    def readConnectionLost(self):
+        try:
+            self.proxy.readClosed()
+        except ReferenceError:
+            self.transport.abortConnection()
+
+    def writeConnectionLost(self):
+        pass
+
 
 class RemoteFactory(TwistedProtocol.ClientFactory):
+    """
+    happy eyeballs over the addresses of one stream, a new connect starts
+    every delay seconds or as soon as the last one fails. the first one
+    connected wins and the others are stopped.
+    """
 
     protocol = RemoteProtocol
 
-    def __init__(self, proxy):
+    def __init__(self, proxy, addresses, port, *,
+                 delay=CONNECT_DELAY,
+                 fastopen=False):
         self.proxy = proxy
+        self.pending = list(addresses)
+        self.port = port
+        self.delay = delay
+        self.fastopen = fastopen
+        self.connectors = []
+        self.winner = None
+        self.timer = None
+        self.stopped = False
+
+    def connect(self):
+        self.timer = None
+        if not self.pending:
+            return
+        address = self.pending.pop(0)
+        self.connectors.append(connect_tcp(
+            address,
+            self.port,
+            self,
+            fastopen=self.fastopen
+        ))
+        if self.pending and self.timer is None and not self.stopped:
+            self.timer = reactor.callLater(self.delay, self.connect)
+
+    def stop(self):
+        self.stopped = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # the factory lives as long as the stream, stopped it holds no lists
+        self.pending = ()
+        connectors, self.connectors = self.connectors, ()
+        for connector in connectors:
+            if connector is self.winner:
+                continue
+            if 'connecting' == connector.state:
+                connector.stopConnecting()
+
+    def connected(self, connector):
+        if self.winner is not None:
+            return False
+        self.winner = connector
+        self.stop()
+        return True
 
     def clientConnectionFailed(self, connector, reason):
+        if connector in self.connectors:
+            self.connectors.remove(connector)
+        if self.stopped:
+            return
         message = reason.getErrorMessage()
         try:
-            self.proxy.connectErr(message)
+            self.proxy.connectFailed(connector.host, message)
+            if self.pending:
+                if self.timer is not None:
+                    self.timer.cancel()
+                self.connect()
+            elif not self.connectors:
+                # the last address tried tells the proxy why
+                self.proxy.connectErr(message, connect_code(reason))
         except ReferenceError:
-            pass
+            self.stop()
 
     def clientConnectionLost(self, connector, reason):
+        if connector is not self.winner:
+            return
         try:
             self.proxy.connectionClosed()
         except ReferenceError:
@@ -95,22 +381,50 @@ class SockProxy:
         'resolver',
         'address_cache',
         'buffer',
-        'has_connect',
+        'factory',
         'transport',
+        'window',
+        'compressor',
+        'decompressor',
+        'replay',
+        'received',
+        'read_closed',
+        'write_closed',
         '__weakref__',
     ]
 
-    def __init__(self, sock_id, dispatcher, host, port):
+    def __init__(self, sock_id, dispatcher, host, port, data=b''):
         self.sock_id = sock_id
         self.dispatcher = dispatcher
         self.remote_host = host
         self.remote_port = port
         self.resolver = dispatcher.resolver
         self.address_cache = dispatcher.address_cache
-        self.buffer = b''
-        self.has_connect = False
+        # written the moment the remote connection is made
+        self.buffer = data
+        # bytes of the stream received from the proxy
+        self.received = len(data)
+        if dispatcher.caps & CAP_RESUME:
+            self.replay = ReplayBuffer()
+        else:
+            self.replay = None
+        self.factory = None
         self.remote_addr = None
         self.transport = None
+        # the remote has sent its fin, the proxy has sent its own
+        self.read_closed = False
+        self.write_closed = False
+        self.window = StreamWindow(dispatcher.window, self.sendWindow)
+        self.window.open()
+        if dispatcher.codec:
+            self.compressor = StreamCompressor(dispatcher.codec)
+            self.decompressor = StreamDecompressor(
+                dispatcher.codec,
+                dispatcher.decoder.max_length
+            )
+        else:
+            self.compressor = None
+            self.decompressor = None
         self.resolveHost(host)
 
     @property
@@ -132,42 +446,59 @@ class SockProxy:
             return False
 
     def close(self, *, abort=True):
+        # a transport closed at once calls back into a closed sock
+        transport, self.transport = self.transport, NullProxy()
         self.dispatcher = NullProxy()
         self.buffer = b''
+        self.replay = None
         self.resolver = None
         self.remote_addr = None
         self.remote_host = None
         self.remote_port = None
-        if self.transport:
+        self.window.detach()
+        if self.factory is not None:
+            self.factory.stop()
+            self.factory = None
+        if transport:
             if abort:
-                self.transport.abortConnection()
+                transport.abortConnection()
             else:
-                self.transport.loseConnection()
-        self.transport = NullProxy()
+                transport.loseConnection()
+
+    def connectRemote(self, addresses):
+        dispatcher = self.dispatcher
+        # a fast open connect is made before the peer accepts it, it can
+        # neither win a race nor be answered as connected in strict mode
+        fastopen = (
+            dispatcher.fastopen and
+            bool(self.buffer) and
+            1 == len(addresses) and
+            not dispatcher.caps & CAP_CONNECT
+        )
+        self.factory = RemoteFactory(
+            weakref.proxy(self),
+            self.address_cache.order(self.remote_host, addresses),
+            self.remote_port,
+            delay=dispatcher.connect_delay,
+            fastopen=fastopen
+        )
+        self.factory.connect()
 
-    def connectRemote(self):
-        factory = RemoteFactory(weakref.proxy(self))
-        reactor.connectTCP(
-            self.remote_addr,
+    def connectFailed(self, address, message):
+        logger.info(
+            'sock_id[%u] connect %s[%s]:%u failed[%s]',
+            self.sock_id,
+            self.remote_host,
+            address,
             self.remote_port,
-            factory
+            message
         )
-        self.has_connect = True
+        self.address_cache.markFailed(self.remote_host, address)
 
-    def resolveOk(self, records):
+    def resolveOk(self, addresses):
         if self.isClosed:
             return
-        answers = records[0]
-        for answer in answers:
-            if answer.type != DNS.A:
-                continue
-            addr = answer.payload.dottedQuad().strip()
-            self.address_cache[self.remote_host] = addr
-            self.remote_addr = addr
-            self.connectRemote()
-            break
-        else:
-            self.resolveErr('no ipv4 address found')
+        self.connectRemote(addresses)
 
     def resolveErr(self, reason=''):
         if self.isClosed:
@@ -178,32 +509,63 @@ class SockProxy:
             self.remote_host,
             reason
         )
-        self.dispatcher.handleConnect(self.sock_id, 1)
+        if (isinstance(reason, TwistedFailure.Failure) and
+                not reason.check(DNSError.DNSNameError)):
+            # no answer, which is not an answer of no such name
+            code = CONNECT_HOSTUNREACH
+        else:
+            code = CONNECT_NXDOMAIN
+        self.dispatcher.handleConnect(self.sock_id, code)
 
     def resolveHost(self, host):
-        if _IP.match(host):
-            self.remote_addr = host
-        else:
-            try:
-                self.remote_addr = self.address_cache[host]
-            except KeyError:
-                # getHostByName can't be used here, it may return ipv6 address
-                self.resolver.lookupAddress(
-                    host
-                ).addCallbacks(
-                    self.resolveOk,
-                    self.resolveErr
-                )
-                return
-        self.connectRemote()
+        if _IP.match(host) or TwistedAbstract.isIPv6Address(host):
+            self.connectRemote([host])
+            return
+        state, addresses = self.address_cache.get(host)
+        if DNSCache.NEGATIVE == state:
+            # answer as the lookup that was cached did
+            error = self.address_cache.error(host)
+            if error is None:
+                error = DNSError.DNSNameError(host)
+            # the sock is not registered with the dispatcher yet
+            reactor.callLater(
+                0,
+                self.resolveErr,
+                TwistedFailure.Failure(error)
+            )
+            return
+        if DNSCache.MISS == state:
+            resolve(
+                self.resolver,
+                self.address_cache,
+                host
+            ).addCallbacks(
+                self.resolveOk,
+                self.resolveErr
+            )
+            return
+        if DNSCache.STALE == state:
+            self.refreshHost(host)
+        self.connectRemote(addresses)
+
+    def refreshHost(self, host):
+        refresh(self.resolver, self.address_cache, host)
 
     def connectOk(self, transport):
+        self.factory = None
         self.transport = transport
+        self.remote_addr = transport.getPeer().host
+        self.address_cache.markConnected(self.remote_host, self.remote_addr)
+        self.window.attach(transport)
         if self.buffer:
             self.transport.write(self.buffer)
+            self.window.consume(len(self.buffer))
             self.buffer = b''
+        if self.write_closed:
+            self.window.shutdown()
+        self.dispatcher.handleConnect(self.sock_id, CONNECT_OK)
 
-    def connectErr(self, message):
+    def connectErr(self, message, code=CONNECT_FAILED):
         logger.error(
             'sock_id[%u] connect %s:%u failed[%s]',
             self.sock_id,
@@ -211,18 +573,46 @@ class SockProxy:
             self.remote_port,
             message
         )
-        self.dispatcher.handleConnect(self.sock_id, 1)
+        self.dispatcher.handleConnect(self.sock_id, code)
 
     def sendRemote(self, data):
         if self.isConnected:
-            self.transport.write(data)
+            self.transport.write(bytes(data))
+            self.window.consume(len(data))
         else:
             self.buffer += data
 
     def recvRemote(self, data):
         self.dispatcher.handleRemote(self.sock_id, data)
+        self.window.spend(len(data))
+
+    def sendWindow(self, increment):
+        self.dispatcher.sendWindow(self.sock_id, increment)
+
+    def grantWindow(self, increment):
+        self.window.grant(increment)
+
+    def shutdownWrite(self):
+        self.write_closed = True
+        # still connecting, the fin follows the buffered data
+        if self.isConnected:
+            self.window.shutdown()
+
+    def readClosed(self):
+        if self.read_closed:
+            return
+        self.read_closed = True
+        logger.info(
+            'sock_id[%u] connection[%s:%u] shut down writing',
+            self.sock_id,
+            self.remote_host,
+            self.remote_port
+        )
+        self.dispatcher.handleShutdown(self.sock_id)
 
     def connectionClosed(self):
+        if self.isClosed:
+            return
         logger.info(
             'sock_id[%u] connection[%s:%u] closed',
             self.sock_id,
@@ -232,14 +622,10 @@ class SockProxy:
         self.dispatcher.handleClose(self.sock_id)
 
     def pauseProducing(self):
-        if self.transport is None:
-            return
-        self.transport.pauseProducing()
+        self.window.throttle()
 
     def resumeProducing(self):
-        if self.transport is None:
-            return
-        self.transport.resumeProducing()
+        self.window.unthrottle()
 
 
 class SocksDispatcher:
@@ -247,30 +633,258 @@ class SocksDispatcher:
     __slots__ = [
         'socks',
         'transport',
+        'decoder',
+        'scheduler',
         'resolver',
         'address_cache',
+        'factory',
+        'caps',
+        'window',
+        'priority',
+        'fastopen',
+        'connect_delay',
+        'codec',
+        'token',
+        'closing',
+        'heartbeat',
+        '_resume_timer',
     ]
 
     def __init__(self, p):
         self.socks = {}
         self.transport = p.transport
+        self.decoder = p.decoder
+        self.scheduler = FrameScheduler(
+            p.transport,
+            producer=Producer(self),
+            max_chunk=p.factory.max_chunk,
+            coalesce=p.factory.coalesce
+        )
         self.resolver = p.factory.resolver
         self.address_cache = p.factory.address_cache
-
-    def dispatchMessage(self, message):
-        type, = struct.unpack('!B', message[4:5])
+        self.factory = p.factory
+        # legacy until the proxy answers the hello
+        self.caps = 0
+        self.window = 0
+        self.codec = 0
+        self.priority = p.factory.priority
+        self.fastopen = p.factory.fastopen
+        self.connect_delay = p.factory.connect_delay
+        # session of the streams, kept a while once the tunnel is lost
+        self.token = None
+        self.closing = False
+        self.heartbeat = None
+        self._resume_timer = None
+        self.sendHello(HELLO_OFFER, p.factory.caps)
+
+    def dispatchMessage(self, type, sock_id, payload):
         if 1 == type:
-            self.connectRemote(message)
+            self.connectRemote(sock_id, payload)
         elif 3 == type:
-            self.sendRemote(message)
+            if 0 == sock_id:
+                self.handleHello(payload)
+            else:
+                self.sendRemote(sock_id, payload)
         elif 5 == type:
-            self.closeRemote(message)
+            self.closeRemote(sock_id)
         elif 7 == type:
             self.closeTunnel()
+        elif 8 == type:
+            self.recvWindow(sock_id, payload)
+        elif 9 == type:
+            self.openRemote(sock_id, payload)
+        elif 10 == type:
+            self.recvCompressed(sock_id, payload)
+        elif 12 == type:
+            self.queryDNS(sock_id, payload)
+        elif 14 == type and self.heartbeat is not None:
+            self.heartbeat.handlePing(payload)
+        elif 15 == type and self.heartbeat is not None:
+            self.heartbeat.handlePong(payload)
+        elif 16 == type:
+            self.shutdownRemote(sock_id)
         else:
             raise RuntimeError(f'receive unknown message type={type}')
 
-    def connectRemote(self, message):
+    def sendHello(self, kind, caps, session=b''):
+        """
+        type 2, ID 0:
+        +-----+------+----+------+-------+---------+
+        | LEN | TYPE | ID | CODE | HELLO | SESSION |
+        +-----+------+----+------+-------+---------+
+        |  4  |   1  |  4 |   1  |   9   |         |
+        +-----+------+----+------+-------+---------+
+
+        SESSION only in the switch once sessions resume
+        """
+        payload = b'\x00' + pack_hello(kind, caps) + session
+        self.scheduler.sendControl(2, 0, payload)
+
+    def handleHello(self, payload):
+        """
+        type 3, ID 0:
+        +-----+------+----+-------+---------+
+        | LEN | TYPE | ID | HELLO | SESSION |
+        +-----+------+----+-------+---------+
+        |  4  |   1  |  4 |   9   |         |
+        +-----+------+----+-------+---------+
+
+        SESSION only when the proxy resumes a lost tunnel
+        """
+        hello = unpack_hello(payload)
+        if hello is None or hello[0] != HELLO_ACK:
+            return
+        kind, version, caps = hello
+        self.caps = caps & self.factory.caps
+        if not self.caps & CAP_WINDOW:
+            # resumed streams start over from their windows
+            self.caps &= ~CAP_RESUME
+        if self.caps & CAP_WINDOW:
+            self.window = self.factory.window
+        self.codec = select_codec(self.caps)
+        compact = bool(self.caps & CAP_COMPACT)
+        self.decoder.compact = compact
+        session = b''
+        resent = []
+        if self.caps & CAP_RESUME:
+            token, entries = unpack_resume(payload[HELLO_LENGTH:])
+            resent = self.adoptSession(token, entries)
+            session = pack_resume(self.token, [
+                (sock_id, sock.received, sock.window.size)
+                for sock_id, sock in self.socks.items()
+            ])
+        self.sendHello(HELLO_SWITCH, self.caps, session)
+        self.scheduler.encoder.compact = compact
+        for sock_id, data in resent:
+            # the reply may have been lost with the tunnel, it goes first
+            if self.caps & CAP_CONNECT and self.socks[sock_id].isConnected:
+                self.scheduler.sendFrame(sock_id, 2, bytes((CONNECT_OK,)))
+            if data:
+                self.scheduler.sendData(sock_id, 4, data)
+            # the fin may have been lost with the tunnel
+            if self.socks[sock_id].read_closed:
+                self.scheduler.sendFrame(sock_id, 17)
+        if self.factory.draining:
+            self.sendDrain()
+        if self.caps & CAP_PING and self.heartbeat is None:
+            self.heartbeat = Heartbeat(
+                self.scheduler.sendControl,
+                self.peerDead,
+                interval=self.factory.ping,
+                misses=self.factory.ping_misses
+            )
+            self.heartbeat.start()
+        proxy = self.transport.getPeer()
+        logger.info(
+            'proxy[%s:%u] protocol version=%u caps=%#x',
+            proxy.host,
+            proxy.port,
+            version,
+            self.caps
+        )
+
+    def sendDrain(self):
+        """
+        the proxy moves its new streams to another tunnel and closes this
+        one once its streams are done, legacy proxies are cut at the
+        drain deadline
+        """
+        if self.caps:
+            self.sendHello(HELLO_DRAIN, self.caps)
+
+    def peerDead(self):
+        proxy = self.transport.getPeer()
+        logger.error(
+            'proxy[%s:%u] dead, %u pings unanswered',
+            proxy.host,
+            proxy.port,
+            self.heartbeat.missed
+        )
+        self.transport.abortConnection()
+
+    def adoptSession(self, token, entries):
+        """
+        takes over the streams of the lost tunnel the proxy resumes,
+        returns the bytes every stream sends again
+        """
+        sessions = self.factory.sessions
+        old = sessions.get(token) if token else None
+        if old is None:
+            if token:
+                logger.info('proxy session expired, streams lost')
+            self.token = new_token()
+            sessions[self.token] = self
+            return []
+        if old._resume_timer is not None:
+            old._resume_timer.cancel()
+            old._resume_timer = None
+        self.token = token
+        sessions[token] = self
+        offsets = {
+            sock_id: (received, window)
+            for sock_id, received, window in entries
+        }
+        resent = []
+        for sock_id, sock in old.socks.items():
+            entry = offsets.get(sock_id)
+            data = None
+            if entry is not None and sock.replay is not None:
+                data = sock.replay.since(entry[0])
+            if data is None:
+                # the proxy has closed it or its bytes are gone
+                sock.close(abort=True)
+                continue
+            received, window = entry
+            sent = sock.replay.sent
+            # its window updates go out through the new tunnel too
+            sock.dispatcher = self
+            sock.window.resume(received + window - sent, sent - received)
+            sock.replay.ack(received)
+            # compression contexts are lost with the frames in flight
+            sock.compressor = None
+            self.socks[sock_id] = sock
+            self.scheduler.openStream(
+                sock_id,
+                self.priority.classify(sock.remote_port)
+            )
+            resent.append((sock_id, data))
+        logger.info(
+            'proxy session resumed streams=%u lost=%u',
+            len(resent),
+            len(old.socks) - len(resent)
+        )
+        old.socks = {}
+        old.token = None
+        # the proxy is back before the lost tunnel was noticed here
+        old.transport.abortConnection()
+        return resent
+
+    def endSession(self):
+        if self.token is None:
+            return
+        if self.factory.sessions.get(self.token) is self:
+            del self.factory.sessions[self.token]
+        self.token = None
+
+    def detachSession(self):
+        for sock in self.socks.values():
+            # held in the replay buffers until the proxy is back
+            sock.compressor = None
+        self._resume_timer = reactor.callLater(
+            self.factory.resume,
+            self.expireSession
+        )
+        logger.info('proxy session detached streams=%u', len(self.socks))
+
+    def expireSession(self):
+        self._resume_timer = None
+        self.endSession()
+        logger.info('proxy session expired streams=%u', len(self.socks))
+        for sock in self.socks.values():
+            sock.close(abort=True)
+        self.socks = {}
+
+    def connectRemote(self, sock_id, payload):
         """
         type 1:
         +-----+------+----+------+------+
@@ -279,21 +893,40 @@ class SocksDispatcher:
         |  4  |   1  |  4 |      |   2  |
         +-----+------+----+------+------+
         """
-        sock_id, = struct.unpack('!I', message[5:9])
-        host = message[9:-2].tobytes().decode('utf-8').strip()
-        port, = struct.unpack('!H', message[-2:])
+        host = payload[:-2].tobytes().decode('utf-8').strip()
+        port, = struct.unpack('!H', payload[-2:])
+        self.createSock(sock_id, host, port)
+
+    def openRemote(self, sock_id, payload):
+        """
+        type 9:
+        +-----+------+----+----------+------+------+------+
+        | LEN | TYPE | ID | HOST_LEN | HOST | PORT | DATA |
+        +-----+------+----+----------+------+------+------+
+        |  4  |   1  |  4 |     1    |      |   2  |      |
+        +-----+------+----+----------+------+------+------+
+        """
+        length = payload[0]
+        host = payload[1:1+length].tobytes().decode('utf-8').strip()
+        port, = struct.unpack('!H', payload[1+length:3+length])
+        data = payload[3+length:].tobytes()
+        self.createSock(sock_id, host, port, data)
+
+    def createSock(self, sock_id, host, port, data=b''):
         logger.info(
             'sock_id[%u] connect %s:%u',
             sock_id,
             host,
             port
         )
+        self.scheduler.openStream(sock_id, self.priority.classify(port))
         try:
             self.socks[sock_id] = SockProxy(
                 sock_id,
                 self,
                 host,
                 port,
+                data,
             )
         except Exception as e:
             logger.error(
@@ -301,7 +934,7 @@ class SocksDispatcher:
                 sock_id,
                 e
             )
-            self.handleConnect(sock_id, 1)
+            self.handleConnect(sock_id, CONNECT_FAILED)
 
     def handleConnect(self, sock_id, code):
         """
@@ -311,20 +944,17 @@ class SocksDispatcher:
         +-----+------+----+------+
         |  4  |   1  |  4 |   1  |
         +-----+------+----+------+
+
+        connects that succeed are only answered with CAP_CONNECT
         """
-        if 0 == code:
+        if CONNECT_OK == code:
+            if self.caps & CAP_CONNECT:
+                self.scheduler.sendFrame(sock_id, 2, bytes((code,)))
             return
         self.closeSock(sock_id, abort=True)
-        message = struct.pack(
-            '!IBIB',
-            10,
-            2,
-            sock_id,
-            code
-        )
-        self.transport.write(message)
+        self.scheduler.sendFrame(sock_id, 2, bytes((code,)))
 
-    def sendRemote(self, message):
+    def sendRemote(self, sock_id, data):
         """
         type 3:
         +-----+------+----+------+
@@ -333,13 +963,30 @@ class SocksDispatcher:
         |  4  |   1  |  4 |      |
         +-----+------+----+------+
         """
-        sock_id, = struct.unpack('!I', message[5:9])
-        data = message[9:]
         try:
             sock = self.socks[sock_id]
         except KeyError:
             logger.error('sock_id[%u] receive data after closed', sock_id)
         else:
+            sock.received += len(data)
+            sock.sendRemote(data)
+
+    def recvCompressed(self, sock_id, payload):
+        """
+        type 10:
+        +-----+------+----+-----------------+
+        | LEN | TYPE | ID | COMPRESSED DATA |
+        +-----+------+----+-----------------+
+        |  4  |   1  |  4 |                 |
+        +-----+------+----+-----------------+
+        """
+        try:
+            sock = self.socks[sock_id]
+        except KeyError:
+            logger.error('sock_id[%u] receive data after closed', sock_id)
+        else:
+            data = sock.decompressor.decompress(payload)
+            sock.received += len(data)
             sock.sendRemote(data)
 
     def handleRemote(self, sock_id, data):
@@ -350,15 +997,23 @@ class SocksDispatcher:
         +-----+------+----+------+
         |  4  |   1  |  4 |      |
         +-----+------+----+------+
+
+        type 11:
+        +-----+------+----+-----------------+
+        | LEN | TYPE | ID | COMPRESSED DATA |
+        +-----+------+----+-----------------+
+        |  4  |   1  |  4 |                 |
+        +-----+------+----+-----------------+
         """
-        total_length = 9 + len(data)
-        header = struct.pack(
-            '!IBI',
-            total_length,
-            4,
-            sock_id,
-        )
-        self.transport.writeSequence([header, data])
+        sock = self.socks.get(sock_id)
+        if sock is not None and sock.replay is not None:
+            sock.replay.append(data)
+        if sock is None or sock.compressor is None:
+            self.scheduler.sendData(sock_id, 4, data)
+            return
+        max_chunk = self.scheduler.max_chunk
+        for packed, payload in sock.compressor.split(data, max_chunk):
+            self.scheduler.sendData(sock_id, 11 if packed else 4, payload)
 
     def closeSock(self, sock_id, *, abort=False):
         try:
@@ -368,8 +1023,9 @@ class SocksDispatcher:
         else:
             sock.close(abort=abort)
             del self.socks[sock_id]
+        self.scheduler.closeStream(sock_id)
 
-    def closeRemote(self, message):
+    def closeRemote(self, sock_id):
         """
         type 5:
         +-----+------+----+
@@ -378,7 +1034,6 @@ class SocksDispatcher:
         |  4  |   1  |  4 |
         +-----+------+----+
         """
-        sock_id, = struct.unpack('!I', message[5:9])
         logger.info('sock_id[%u] remote closed', sock_id)
         self.closeSock(sock_id, abort=True)
 
@@ -395,13 +1050,95 @@ class SocksDispatcher:
             return
         logger.info('sock_id[%u] local closed', sock_id)
         self.closeSock(sock_id)
-        message = struct.pack(
-            '!IBI',
-            9,
-            6,
-            sock_id
-        )
-        self.transport.write(message)
+        self.scheduler.sendFrame(sock_id, 6)
+
+    def shutdownRemote(self, sock_id):
+        """
+        type 16:
+        +-----+------+----+
+        | LEN | TYPE | ID |
+        +-----+------+----+
+        |  4  |   1  |  4 |
+        +-----+------+----+
+
+        the client is done writing, the remote gets its fin once the
+        bytes before it are written
+        """
+        sock = self.socks.get(sock_id)
+        if sock is None or sock.write_closed:
+            return
+        logger.info('sock_id[%u] remote shut down writing', sock_id)
+        sock.shutdownWrite()
+        if sock.read_closed:
+            self.closeSock(sock_id)
+
+    def handleShutdown(self, sock_id):
+        """
+        type 17:
+        +-----+------+----+
+        | LEN | TYPE | ID |
+        +-----+------+----+
+        |  4  |   1  |  4 |
+        +-----+------+----+
+        """
+        sock = self.socks.get(sock_id)
+        if sock is None:
+            return
+        if not self.caps & CAP_HALFCLOSE:
+            # the proxy only knows whole closes, the rest is flushed first
+            sock.transport.loseConnection()
+            return
+        self.scheduler.sendFrame(sock_id, 17)
+        if sock.write_closed:
+            self.closeSock(sock_id)
+
+    def queryDNS(self, query_id, payload):
+        """
+        type 12:
+        +-----+------+----+------+
+        | LEN | TYPE | ID | NAME |
+        +-----+------+----+------+
+        |  4  |   1  |  4 |      |
+        +-----+------+----+------+
+        """
+        host = payload.tobytes().decode('utf-8').strip().lower()
+        cache = self.address_cache
+        state, addresses = cache.get(host)
+        if DNSCache.NEGATIVE == state:
+            error = cache.error(host)
+            if error is None or isinstance(error, DNSError.DNSNameError):
+                self.answerDNS(query_id, DNS_NXDOMAIN, cache.ttl(host))
+            else:
+                self.answerDNS(query_id, DNS_SERVFAIL)
+            return
+        if DNSCache.MISS != state:
+            if DNSCache.STALE == state:
+                refresh(self.resolver, cache, host)
+            self.answerDNS(query_id, DNS_OK, cache.ttl(host), addresses)
+            return
+
+        def ok(addresses):
+            self.answerDNS(query_id, DNS_OK, cache.ttl(host), addresses)
+
+        def err(failure):
+            if failure.check(DNSError.DNSNameError):
+                self.answerDNS(query_id, DNS_NXDOMAIN, cache.ttl(host))
+            else:
+                self.answerDNS(query_id, DNS_SERVFAIL)
+
+        resolve(self.resolver, cache, host).addCallbacks(ok, err)
+
+    def answerDNS(self, query_id, code, ttl=0, addresses=()):
+        """
+        type 13:
+        +-----+------+----+------+-----+-----------+
+        | LEN | TYPE | ID | CODE | TTL | ADDRESSES |
+        +-----+------+----+------+-----+-----------+
+        |  4  |   1  |  4 |   1  |  4  |           |
+        +-----+------+----+------+-----+-----------+
+        """
+        payload = pack_dns_answer(code, ttl, addresses)
+        self.scheduler.sendControl(13, query_id, payload)
 
     def closeTunnel(self):
         """
@@ -418,10 +1155,101 @@ class SocksDispatcher:
             proxy.host,
             proxy.port
         )
+        self.closing = True
+        # tls holds its close back while a producer is registered
+        self.transport.unregisterProducer()
         self.transport.loseConnection()
 
+    def sendWindow(self, sock_id, increment):
+        """
+        type 8:
+        +-----+------+----+-----------+----------+
+        | LEN | TYPE | ID | INCREMENT | RECEIVED |
+        +-----+------+----+-----------+----------+
+        |  4  |   1  |  4 |     4     |     8    |
+        +-----+------+----+-----------+----------+
+
+        RECEIVED only once sessions resume
+        """
+        received = None
+        if self.caps & CAP_RESUME:
+            sock = self.socks.get(sock_id)
+            # the open grant goes out before the sock is registered
+            received = 0 if sock is None else sock.received
+        payload = pack_window(increment, received)
+        self.scheduler.sendControl(8, sock_id, payload)
+
+    def recvWindow(self, sock_id, payload):
+        """
+        type 8:
+        +-----+------+----+-----------+----------+
+        | LEN | TYPE | ID | INCREMENT | RECEIVED |
+        +-----+------+----+-----------+----------+
+        |  4  |   1  |  4 |     4     |     8    |
+        +-----+------+----+-----------+----------+
+        """
+        increment, received = unpack_window(payload)
+        try:
+            sock = self.socks[sock_id]
+        except KeyError:
+            return
+        sock.grantWindow(increment)
+        if received is not None and sock.replay is not None:
+            sock.replay.ack(received)
+
     def tunnelClosed(self):
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            stats = self.heartbeat.stats()
+            logger.info(
+                'tunnel srtt=%.1fms rttvar=%.1fms pings=%u pongs=%u',
+                stats['srtt'] * 1000,
+                stats['rttvar'] * 1000,
+                stats['pings'],
+                stats['pongs']
+            )
+            self.heartbeat = None
+        stats = self.scheduler.stats()
+        logger.info(
+            'tunnel writes=%u records/write=%.2f bytes/write=%.0f',
+            stats['writes'],
+            stats['records_per_write'],
+            stats['bytes_per_write']
+        )
+        stats = self.resolver.stats()
+        logger.info(
+            'dns queries=%u coalesced=%u hedged=%u',
+            stats['queries'],
+            stats['coalesced'],
+            stats['hedged']
+        )
+        for address, srtt, answers, failures in stats['nameservers']:
+            logger.info(
+                'dns nameserver[%s] srtt=%.1fms answers=%u failures=%u',
+                address,
+                srtt * 1000,
+                answers,
+                failures
+            )
+        stats = self.address_cache.stats()
+        logger.info(
+            'dns cache entries=%u hits=%u misses=%u stale=%u negative=%u '
+            'expired=%u evicted=%u',
+            stats['entries'],
+            stats['hits'],
+            stats['misses'],
+            stats['stale_hits'],
+            stats['negative_hits'],
+            stats['expired'],
+            stats['evicted']
+        )
         self.transport = NullProxy()
+        self.scheduler = NullProxy()
+        if self.token is not None and self.socks and not self.closing:
+            # the streams live on until the proxy resumes the session
+            self.detachSession()
+            return
+        self.endSession()
         for sock in self.socks.values():
             sock.close(abort=True)
         self.socks = {}
@@ -460,13 +1288,11 @@ class TunnelProtocol(TwistedProtocol.Protocol):
             return False
 
     def connectionVerified(self):
-        dispatcher = SocksDispatcher(self)
-        producer = Producer(dispatcher)
-        self.buffer = b''
-        self.dispatcher = dispatcher
+        self.decoder = FrameDecoder(self.factory.max_frame)
+        self.dispatcher = SocksDispatcher(self)
+        self.factory.tunnels.add(self.dispatcher)
         self.transport.setTcpNoDelay(True)
         self.transport.setTcpKeepAlive(True)
-        self.transport.registerProducer(producer, True)
         proxy = self.transport.getPeer()
         logger.info(
             'proxy[%s:%u] connected',
@@ -481,6 +1307,7 @@ class TunnelProtocol(TwistedProtocol.Protocol):
     def connectionLost(self, reason=None):
         proxy = self.transport.getPeer()
         if self.isVerified:
+            self.factory.tunnels.discard(self.dispatcher)
             self.transport.unregisterProducer()
             self.dispatcher.tunnelClosed()
             logger.info(
@@ -496,39 +1323,59 @@ class TunnelProtocol(TwistedProtocol.Protocol):
             )
 
     def dataReceived(self, data):
-        self.buffer += data
-        while True:
-            if len(self.buffer) < 4:
-                return
-            length, = struct.unpack('!I', self.buffer[:4])
-            if len(self.buffer) < length:
-                return
-            message = memoryview(self.buffer)[:length]
-            self.dispatcher.dispatchMessage(message)
-            self.buffer = self.buffer[length:]
+        try:
+            for type, sock_id, payload in self.decoder.decode(data):
+                self.dispatcher.dispatchMessage(type, sock_id, payload)
+        except FrameError as e:
+            proxy = self.transport.getPeer()
+            logger.error(
+                'proxy[%s:%u] broken[%s]',
+                proxy.host,
+                proxy.port,
+                e
+            )
+            self.transport.abortConnection()
 
 
 def _create_resolver(config):
-    dns = config['dns']
-    if dns is None:
-        servers = None
-    else:
-        dns = dns.strip()
-        if not dns:
-            servers = None
-        elif ':' in dns:
-            address, port = dns.split(':')
-            servers = [(address, int(port))]
-        else:
-            servers = [(dns, 53)]
-    return TwistedDNS.createResolver(servers=servers)
+    servers = parse_nameservers(config['dns'])
+    return RacingResolver(servers, race=config['dns_race'])
 
 
 def _create_tunnel_factory(config):
     factory = TwistedProtocol.ServerFactory()
     factory.protocol = TunnelProtocol
-    factory.address_cache = Cache()
+    factory.tunnels = set()
+    # the server is being replaced, tunnels are asked to move
+    factory.draining = False
+    factory.address_cache = DNSCache(
+        config['dns_cache'],
+        min_ttl=config['dns_min_ttl'],
+        max_ttl=config['dns_max_ttl'],
+        negative_ttl=config['dns_negative_ttl']
+    )
     factory.resolver = _create_resolver(config)
+    factory.max_frame = config['max_frame']
+    factory.window = config['window']
+    factory.caps = (
+        CAP_COMPACT | CAP_OPEN | CAP_DNS | CAP_HALFCLOSE | CAP_CONNECT
+    )
+    if factory.window:
+        factory.caps |= CAP_WINDOW
+    factory.max_chunk = config['max_chunk']
+    factory.priority = PriorityRules(config['priority'])
+    factory.coalesce = config['coalesce']
+    factory.fastopen = config['fastopen']
+    factory.connect_delay = config['connect_delay'] / 1000
+    factory.caps |= codec_caps(config['compress'])
+    factory.resume = config['resume']
+    factory.sessions = {}
+    if factory.resume > 0 and factory.window:
+        factory.caps |= CAP_RESUME
+    factory.ping = config['ping']
+    factory.ping_misses = config['ping_misses']
+    if factory.ping > 0:
+        factory.caps |= CAP_PING
     return factory
 
 
@@ -554,45 +1401,183 @@ def _create_ssl_context(config):
             conn.protocol.connectionVerified()
         return ok
 
+    def handshake(conn):
+        # a resumed session skips verify, its proxy was verified before
+        if not conn.protocol.isVerified:
+            logger.debug('proxy tls session resumed')
+            conn.protocol.connectionVerified()
+
     return SSLCtxFactory(
         False,
         config['ca'],
         config['key'],
         config['cert'],
         dhparam=config['dhparam'],
-        callback=verify
+        callback=verify,
+        handshake=handshake,
+        ciphers=config['ciphers'],
+        tls_min=config['tls_min'],
+        ticket_rotate=config['ticket_rotate']
+    )
+
+
+def _save_dns_cache(cache, path):
+    try:
+        count = cache.dump(path)
+    except OSError as e:
+        logger.error('save dns cache to %s failed[%s]', path, e)
+    else:
+        logger.debug('save %u dns names to %s', count, path)
+
+
+def _load_dns_cache(config, cache):
+    path = config['dns_cache_file']
+    if not path:
+        return []
+    names = []
+    if os.path.exists(path):
+        try:
+            names = cache.load(path)
+        except (OSError, RuntimeError) as e:
+            logger.error('load dns cache from %s failed[%s]', path, e)
+        logger.info(
+            'load %u dns names from %s, %u unexpired',
+            len(names),
+            path,
+            len(cache)
+        )
+    TwistedTask.LoopingCall(
+        _save_dns_cache,
+        cache,
+        path
+    ).start(config['dns_cache_save'], now=False)
+    reactor.addSystemEventTrigger(
+        'before',
+        'shutdown',
+        _save_dns_cache,
+        cache,
+        path
     )
+    return names
+
+
+def _prefetch(factory, names):
+    cache = factory.address_cache
+    names = [name for name in names if name not in cache]
+    logger.info('prefetch %u dns names', len(names))
+    d = TwistedDefer.DeferredList(
+        [resolve(factory.resolver, cache, name) for name in names],
+        consumeErrors=True
+    )
+    return d.addTimeout(PREFETCH_TIMEOUT, reactor)
+
+
+def _worker_stats(factory):
+    cache = factory.address_cache.stats()
+    return {
+        'pid': os.getpid(),
+        'tunnels': len(factory.tunnels),
+        'streams': sum(len(d.socks) for d in factory.tunnels),
+        'dns_queries': factory.resolver.stats()['queries'],
+        'dns_hits': cache['hits'],
+        'dns_misses': cache['misses'],
+    }
+
+
+def _drain_tunnels(factory):
+    factory.draining = True
+    for dispatcher in factory.tunnels:
+        dispatcher.sendDrain()
+
+
+def _serve_workers(config):
+    pool = WorkerPool('s54http.server', config, config['workers'])
+    reactor.addSystemEventTrigger(
+        'before',
+        'shutdown',
+        pool.stop
+    )
+    pool.start()
+    # the workers of a new server listen beside the old ones
+    Upgrader(
+        's54http.server',
+        {},
+        reload=functools.partial(pool.signalWorkers, signal.SIGHUP),
+        active=lambda: len(pool.processes),
+        quiesce=pool.drain,
+        drain=config['drain']
+    ).install()
+    pool.whenServing().addCallback(lambda _: notify_ready())
+    logger.info(
+        'server running %u workers on %s ...',
+        config['workers'],
+        describe_engine()
+    )
+    reactor.run()
 
 
 def serve(config):
+    if config['workers'] > 1 and not config['worker']:
+        _serve_workers(config)
+        return
     ssl_ctx = _create_ssl_context(config)
     tunnel_factory = _create_tunnel_factory(config)
+    names = _load_dns_cache(config, tunnel_factory.address_cache)
     address, port = config['host'], config['port']
     try:
-        reactor.listenSSL(
+        listener = listen_ssl(
             port,
             tunnel_factory,
             ssl_ctx,
-            interface=address,
+            address,
+            reuseport=bool(config['worker']),
+            fileno=inherited_fd('tunnel')
         )
     except TwistedError.CannotListenError:
         raise RuntimeError(
             f"couldn't listen on :{port}, address already in use"
         )
-    logger.info('server running ...')
+    prefetch = config['dns_prefetch']
+    if prefetch and names:
+        # tunnels queue in the backlog until the hottest names are known
+        listener.stopReading()
+        _prefetch(
+            tunnel_factory,
+            names[:prefetch]
+        ).addBoth(
+            lambda _: listener.startReading()
+        )
+    if config['worker']:
+        report_stats(functools.partial(_worker_stats, tunnel_factory))
+    # workers are upgraded by the parent
+    Upgrader(
+        None if config['worker'] else 's54http.server',
+        {'tunnel': listener},
+        reload=functools.partial(reload_certificates, ssl_ctx),
+        active=lambda: len(tunnel_factory.tunnels),
+        quiesce=functools.partial(_drain_tunnels, tunnel_factory),
+        drain=config['drain']
+    ).install()
+    notify_ready()
+    logger.info('server running on %s ...', describe_engine())
     reactor.run()
 
 
 def main():
     parse_args(config)
+    install_engine(config['engine'])
     init_logger(config, logger)
+    init_logger(config, logging.getLogger('s54http.upgrade'))
+    if config['workers'] > 1:
+        init_logger(config, logging.getLogger('s54http.workers'))
     if config['daemon']:
         pidfile = config['pidfile']
         logfile = config['logfile']
         daemonize(
             pidfile,
             stdout=logfile,
-            stderr=logfile
+            stderr=logfile,
+            replace=upgrading()
         )
     serve(config)
 
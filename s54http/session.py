@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import struct
+
+from s54http.frame import FrameError
+
+
+__all__ = [
+    'new_token',
+    'pack_resume',
+    'pack_window',
+    'ReplayBuffer',
+    'RESUME_GRACE',
+    'TOKEN_LENGTH',
+    'unpack_resume',
+    'unpack_window',
+]
+
+
+# seconds the streams of a lost tunnel wait for it to come back
+RESUME_GRACE = 30
+TOKEN_LENGTH = 16
+_ENTRY = struct.Struct('!IQI')
+_WINDOW = struct.Struct('!I')
+_WINDOW_ACK = struct.Struct('!IQ')
+
+
+def new_token():
+    return os.urandom(TOKEN_LENGTH)
+
+
+def pack_resume(token, entries=()):
+    """
+    +-------+---------+
+    | TOKEN | STREAMS |
+    +-------+---------+
+    |   16  |         |
+    +-------+---------+
+
+    every stream, bytes received from the peer and the window it may
+    send beyond them:
+    +----+----------+--------+
+    | ID | RECEIVED | WINDOW |
+    +----+----------+--------+
+    |  4 |     8    |    4   |
+    +----+----------+--------+
+    """
+    parts = [token]
+    for sock_id, received, window in entries:
+        parts.append(_ENTRY.pack(sock_id, received, window))
+    return b''.join(parts)
+
+
+def unpack_resume(payload):
+    """
+    returns (token, entries), token is None when there is none
+    """
+    if len(payload) < TOKEN_LENGTH:
+        return None, []
+    if (len(payload) - TOKEN_LENGTH) % _ENTRY.size:
+        raise FrameError('invalid resume streams')
+    token = bytes(payload[:TOKEN_LENGTH])
+    entries = [
+        _ENTRY.unpack_from(payload, offset)
+        for offset in range(TOKEN_LENGTH, len(payload), _ENTRY.size)
+    ]
+    return token, entries
+
+
+def pack_window(increment, received=None):
+    """
+    +-----------+----------+
+    | INCREMENT | RECEIVED |
+    +-----------+----------+
+    |     4     |     8    |
+    +-----------+----------+
+
+    RECEIVED only once sessions resume, it acknowledges the bytes
+    """
+    if received is None:
+        return _WINDOW.pack(increment)
+    return _WINDOW_ACK.pack(increment, received)
+
+
+def unpack_window(payload):
+    """
+    returns (increment, received), received is None when not sent
+    """
+    if _WINDOW_ACK.size == len(payload):
+        return _WINDOW_ACK.unpack(payload)
+    increment, = _WINDOW.unpack(payload)
+    return increment, None
+
+
+class ReplayBuffer:
+    """
+    bytes of one stream sent to the peer but not acknowledged yet, from
+    offset acked up to sent. the peer's window bounds its size.
+    """
+
+    __slots__ = [
+        'acked',
+        'data',
+    ]
+
+    def __init__(self):
+        self.acked = 0
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def sent(self):
+        return self.acked + len(self.data)
+
+    def append(self, data):
+        self.data += data
+
+    def ack(self, offset):
+        count = offset - self.acked
+        if count <= 0:
+            return
+        if offset > self.sent:
+            raise FrameError('acknowledged bytes never sent')
+        del self.data[:count]
+        self.acked = offset
+
+    def since(self, offset):
+        """
+        returns the bytes sent from offset on, None once they are gone
+        """
+        if offset < self.acked or offset > self.sent:
+            return None
+        return bytes(self.data[offset-self.acked:])
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+
+import array
+import collections
+
+
+__all__ = [
+    'StreamTable',
+]
+
+
+# the low bits of a sock_id count how often its slot was reused, frames
+# of a closed stream don't reach the stream that took its slot next
+GENERATION_BITS = 8
+GENERATION_MASK = 2**GENERATION_BITS - 1
+# sock_id is 4 bytes on the wire
+MAX_INDEX = 2**(32 - GENERATION_BITS) - 1
+# a slot allocated to a stream not registered yet
+_EMPTY = None
+_FREE = object()
+
+
+class StreamTable:
+    """
+    streams by sock_id in a list of slots, a sock_id is allocated when
+    the stream is accepted and released when it is gone. the slots
+    freed first are reused first and ids stay small, their varints too.
+    sock_id 0 belongs to the tunnel and is never allocated.
+
+    only allocated ids are registered, lookups of stale ids fail like
+    those of unknown ones.
+    """
+
+    __slots__ = [
+        '_records',
+        '_generations',
+        '_free',
+        '_count',
+    ]
+
+    def __init__(self):
+        self._records = [_FREE]
+        self._generations = array.array('B', [0])
+        self._free = collections.deque()
+        self._count = 0
+
+    def allocate(self):
+        if self._free:
+            index = self._free.popleft()
+        else:
+            index = len(self._records)
+            if index > MAX_INDEX:
+                raise RuntimeError('stream table full')
+            self._records.append(_FREE)
+            self._generations.append(0)
+        self._records[index] = _EMPTY
+        return index << GENERATION_BITS | self._generations[index]
+
+    def release(self, sock_id):
+        index = self._index(sock_id)
+        if index < 0 or self._records[index] is _FREE:
+            return False
+        if self._records[index] is not _EMPTY:
+            self._count -= 1
+        self._records[index] = _FREE
+        self._generations[index] = self._generations[index] + 1 & \
+            GENERATION_MASK
+        self._free.append(index)
+        return True
+
+    def _index(self, sock_id):
+        index = sock_id >> GENERATION_BITS
+        if (0 < index < len(self._records) and
+                self._generations[index] == sock_id & GENERATION_MASK):
+            return index
+        return -1
+
+    def _slot(self, sock_id):
+        index = self._index(sock_id)
+        if index < 0 or self._records[index] is _FREE:
+            raise KeyError(sock_id)
+        return index
+
+    def __getitem__(self, sock_id):
+        record = self._records[self._slot(sock_id)]
+        if record is _EMPTY:
+            raise KeyError(sock_id)
+        return record
+
+    def __setitem__(self, sock_id, record):
+        index = self._slot(sock_id)
+        if self._records[index] is _EMPTY:
+            self._count += 1
+        self._records[index] = record
+
+    def __delitem__(self, sock_id):
+        index = self._slot(sock_id)
+        if self._records[index] is _EMPTY:
+            raise KeyError(sock_id)
+        # the id stays allocated until released
+        self._records[index] = _EMPTY
+        self._count -= 1
+
+    def get(self, sock_id, default=None):
+        try:
+            return self[sock_id]
+        except KeyError:
+            return default
+
+    def pop(self, sock_id, default=None):
+        try:
+            record = self[sock_id]
+        except KeyError:
+            return default
+        del self[sock_id]
+        return record
+
+    def __contains__(self, sock_id):
+        index = self._index(sock_id)
+        if index < 0:
+            return False
+        record = self._records[index]
+        return record is not _EMPTY and record is not _FREE
+
+    def __len__(self):
+        return self._count
+
+    def items(self):
+        generations = self._generations
+        for index, record in enumerate(self._records):
+            if record is _EMPTY or record is _FREE:
+                continue
+            yield index << GENERATION_BITS | generations[index], record
+
+    def values(self):
+        for _, record in self.items():
+            yield record
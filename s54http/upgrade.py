@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+
+import logging
+import os
+import signal
+import socket
+import sys
+
+from twisted.internet import (
+    error as TwistedError,
+    protocol as TwistedProtocol,
+    reactor,
+    task as TwistedTask,
+)
+
+
+__all__ = [
+    'adopt_datagram',
+    'adopt_port',
+    'DRAIN_TIMEOUT',
+    'inherited_fd',
+    'notify_ready',
+    'reload_certificates',
+    'Upgrader',
+    'upgrading',
+]
+
+
+logger = logging.getLogger(__name__)
+
+# a process started by an upgrade finds its listen sockets here as
+# name=fd,... and tells the old process on READY_FD it is serving
+UPGRADE_ENV = 'S54HTTP_UPGRADE'
+READY_FD = 3
+LISTEN_FD = 4
+# seconds the old process gets to finish its tunnels and streams
+DRAIN_TIMEOUT = 300
+DRAIN_INTERVAL = 1
+# seconds the new process gets to start serving, the old one goes on
+# serving if it doesn't
+READY_TIMEOUT = 60
+# relative paths on the command line are relative to it, a daemon has
+# left it by the time it upgrades
+_CWD = os.getcwd()
+
+
+def _parse_upgrade():
+    # workers must not take the sockets for theirs
+    value = os.environ.pop(UPGRADE_ENV, None)
+    if value is None:
+        return None
+    fds = {}
+    for item in value.split(','):
+        name, _, fd = item.partition('=')
+        if name:
+            fds[name] = int(fd)
+    return fds
+
+
+_inherited = _parse_upgrade()
+
+
+def upgrading():
+    """
+    whether an older process handed over its listen sockets
+    """
+    return _inherited is not None
+
+
+def inherited_fd(name):
+    if _inherited is None:
+        return None
+    return _inherited.pop(name, None)
+
+
+def _family(fd):
+    s = socket.socket(fileno=fd)
+    family = s.family
+    s.detach()
+    return family
+
+
+def adopt_port(fd, factory):
+    port = reactor.adoptStreamPort(fd, _family(fd), factory)
+    # the adopted port has its own copy of the socket
+    os.close(fd)
+    return port
+
+
+def adopt_datagram(fd, protocol):
+    port = reactor.adoptDatagramPort(fd, _family(fd), protocol)
+    os.close(fd)
+    return port
+
+
+def notify_ready():
+    """
+    the old process stops accepting once the new one is serving
+    """
+    global _inherited
+    if _inherited is None:
+        return
+    for fd in _inherited.values():
+        os.close(fd)
+    _inherited = None
+    try:
+        os.write(READY_FD, b'ready\n')
+        os.close(READY_FD)
+    except OSError as e:
+        logger.error('upgrade notify ready failed[%s]', e)
+
+
+def reload_certificates(ctx_factory):
+    try:
+        ctx_factory.reload()
+    except RuntimeError as e:
+        logger.error('%s, certificates kept', e)
+    else:
+        logger.info('certificates reloaded, new handshakes use them')
+
+
+class UpgradeProtocol(TwistedProtocol.ProcessProtocol):
+
+    def __init__(self, upgrader):
+        self.upgrader = upgrader
+        self.ready = False
+        self.timer = reactor.callLater(READY_TIMEOUT, self.readyTimeout)
+
+    def childDataReceived(self, fd, data):
+        if READY_FD != fd or self.ready:
+            return
+        self.ready = True
+        self.timer.cancel()
+        self.upgrader.upgraded(self.transport.pid)
+
+    def childConnectionLost(self, fd):
+        # a daemon's pipe lives on in its grandchild
+        if READY_FD != fd or self.ready:
+            return
+        self.timer.cancel()
+        self.upgrader.upgradeFailed('exited before serving')
+
+    def readyTimeout(self):
+        try:
+            self.transport.signalProcess('TERM')
+        except TwistedError.ProcessExitedAlready:
+            pass
+        self.ready = True
+        self.upgrader.upgradeFailed('not serving in time')
+
+
+class Upgrader:
+    """
+    SIGHUP calls reload(). SIGQUIT stops the ports, calls quiesce() and
+    waits up to drain seconds for active() to reach 0 before stopping
+    the reactor. SIGUSR2 starts `module` again with the ports handed
+    over and drains once it is serving, without a module it is ignored.
+    """
+
+    __slots__ = [
+        'module',
+        'ports',
+        'reload',
+        'active',
+        'quiesce',
+        'drain',
+        'draining',
+        'child',
+        '_deadline',
+        '_timer',
+    ]
+
+    def __init__(self, module, ports, *,
+                 reload,
+                 active,
+                 quiesce=None,
+                 drain=DRAIN_TIMEOUT):
+        self.module = module
+        # name -> listening port
+        self.ports = ports
+        self.reload = reload
+        self.active = active
+        self.quiesce = quiesce
+        self.drain = drain
+        self.draining = False
+        self.child = None
+        self._deadline = 0
+        self._timer = None
+
+    def install(self):
+        handlers = {
+            signal.SIGHUP: self.reload,
+            signal.SIGQUIT: self.startDrain,
+        }
+        if self.module is not None:
+            handlers[signal.SIGUSR2] = self.upgrade
+        for signum, handler in handlers.items():
+            signal.signal(
+                signum,
+                lambda signum, frame, handler=handler:
+                    reactor.callFromThread(handler)
+            )
+
+    def upgrade(self):
+        if self.child is not None or self.draining:
+            logger.error('upgrade already going on')
+            return
+        child_fds = {0: 0, 1: 1, 2: 2, READY_FD: 'r'}
+        handed = []
+        for fd, (name, port) in enumerate(
+                sorted(self.ports.items()),
+                LISTEN_FD):
+            child_fds[fd] = port.fileno()
+            handed.append(f'{name}={fd}')
+        env = dict(os.environ)
+        # the new process imports s54http wherever this one found it
+        env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+        env[UPGRADE_ENV] = ','.join(handed)
+        self.child = reactor.spawnProcess(
+            UpgradeProtocol(self),
+            sys.executable,
+            [sys.executable, '-m', 's54http.engine', self.module] +
+            sys.argv[1:],
+            env=env,
+            path=_CWD,
+            childFDs=child_fds
+        )
+        logger.info('upgrade started pid[%u]', self.child.pid)
+
+    def upgraded(self, pid):
+        logger.info('upgrade pid[%u] serving', pid)
+        self.startDrain()
+
+    def upgradeFailed(self, reason):
+        logger.error('upgrade failed[%s], still serving', reason)
+        self.child = None
+
+    def startDrain(self):
+        if self.draining:
+            return
+        self.draining = True
+        for port in self.ports.values():
+            # stopListening shuts the socket down for the new process too
+            port.stopReading()
+            port.socket.close()
+        if self.quiesce is not None:
+            self.quiesce()
+        logger.info('draining %u for up to %us', self.active(), self.drain)
+        self._deadline = reactor.seconds() + self.drain
+        self._timer = TwistedTask.LoopingCall(self.checkDrain)
+        self._timer.start(DRAIN_INTERVAL, now=True)
+
+    def checkDrain(self):
+        left = self.active()
+        if left and reactor.seconds() < self._deadline:
+            return
+        if left:
+            logger.info('drain timed out, %u cut', left)
+        else:
+            logger.info('drained')
+        self._timer.stop()
+        reactor.stop()
@@ -7,15 +7,26 @@ import collections
 import logging
 import os
 import pathlib
+import socket
+import struct
 import sys
+import time
 
 from OpenSSL import SSL
+from twisted.internet import interfaces as TwistedInterface
+from zope import interface as ZopeInterface
+
+from s54http.engine import ENGINES
 
 
 __all__ = [
     'Cache',
+    'ClientTLS',
+    'DNSCache',
     'SSLCtxFactory',
     'NullProxy',
+    'TICKET_ROTATE',
+    'TLS_VERSIONS',
     'daemonize',
     'init_logger',
     'parse_args',
@@ -42,19 +53,85 @@ class NullProxy:
         return self
 
 
+# tls 1.2 cipher list and tls 1.3 cipher suites, in order of preference,
+# the client's order wins
+CIPHERS = {
+    'aesgcm': (
+        'ECDHE-RSA-AES128-GCM-SHA256:ECDHE-RSA-AES256-GCM-SHA384:'
+        'ECDHE-RSA-CHACHA20-POLY1305',
+        'TLS_AES_128_GCM_SHA256:TLS_AES_256_GCM_SHA384:'
+        'TLS_CHACHA20_POLY1305_SHA256',
+    ),
+    'chacha20': (
+        'ECDHE-RSA-CHACHA20-POLY1305:ECDHE-RSA-AES128-GCM-SHA256:'
+        'ECDHE-RSA-AES256-GCM-SHA384',
+        'TLS_CHACHA20_POLY1305_SHA256:TLS_AES_128_GCM_SHA256:'
+        'TLS_AES_256_GCM_SHA384',
+    ),
+}
+TLS_VERSIONS = {
+    '1.2': SSL.TLS1_2_VERSION,
+    '1.3': SSL.TLS1_3_VERSION,
+}
+# seconds a server ticket key lives, tickets don't outlive it
+TICKET_ROTATE = 3600
+
+
+def _has_aes():
+    """
+    aes instructions make aes-gcm faster than chacha20, assumed when the
+    cpu can't be asked
+    """
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name.strip() in ('flags', 'Features'):
+                    return 'aes' in value.split()
+    except OSError:
+        pass
+    return True
+
+
+def select_ciphers(ciphers):
+    if 'auto' == ciphers:
+        ciphers = 'aesgcm' if _has_aes() else 'chacha20'
+    try:
+        return CIPHERS[ciphers]
+    except KeyError:
+        raise RuntimeError(f'unknown ciphers {ciphers}')
+
+
+@ZopeInterface.implementer(TwistedInterface.IOpenSSLContextFactory)
 class SSLCtxFactory:
+    """
+    tls 1.2 and 1.3, peers resume their sessions instead of a full
+    handshake. a server starts over with a new context and so a new
+    ticket key every ticket_rotate seconds.
+    """
 
-    method = SSL.TLSv1_2_METHOD
+    method = SSL.TLS_METHOD
 
     def __init__(self, client, ca, key, cert, *,
                  dhparam=None,
-                 callback=None):
+                 callback=None,
+                 handshake=None,
+                 ciphers='auto',
+                 tls_min='1.2',
+                 ticket_rotate=TICKET_ROTATE):
         self.isClient = client
         self._ca = ca
         self._key = key
         self._cert = cert
         self._dhparam = dhparam
+        self._ciphers = select_ciphers(ciphers)
+        try:
+            self._tls_min = TLS_VERSIONS[tls_min]
+        except KeyError:
+            raise RuntimeError(f'unknown tls version {tls_min}')
+        self._ticket_rotate = ticket_rotate
         self._ctx = None
+        self._created = 0
         if callback is None:
 
             def verify(conn, x509, errno, errdepth, ok):
@@ -62,30 +139,66 @@ class SSLCtxFactory:
 
             callback = verify
         self._callback = callback
+        # called with the connection once a handshake is done
+        self._handshake = handshake
         self.cacheContext()
 
     def cacheContext(self):
         if self._ctx is not None:
             return
-        ctx = SSL.Context(SSL.TLSv1_2_METHOD)
-        ctx.set_options(SSL.OP_NO_SSLv2)
-        ctx.set_options(SSL.OP_NO_SSLv3)
-        ctx.set_options(SSL.OP_NO_TLSv1)
-        ctx.set_options(SSL.OP_NO_TLSv1_1)
+        ctx = SSL.Context(self.method)
+        ctx.set_min_proto_version(self._tls_min)
         ctx.use_certificate_file(self._cert)
         ctx.use_privatekey_file(self._key)
         ctx.check_privatekey()
         ctx.load_verify_locations(self._ca)
         if self._dhparam:
             ctx.load_tmp_dh(self._dhparam)
-        ctx.set_cipher_list('ECDHE-RSA-AES128-GCM-SHA256')
+        cipher_list, ciphersuites = self._ciphers
+        ctx.set_cipher_list(cipher_list.encode('ascii'))
+        ctx.set_tls13_ciphersuites(ciphersuites.encode('ascii'))
         ctx.set_verify(
             SSL.VERIFY_PEER |
             SSL.VERIFY_FAIL_IF_NO_PEER_CERT |
             SSL.VERIFY_CLIENT_ONCE,
             self._callback
         )
+        if self._handshake is not None:
+            ctx.set_info_callback(self._infoCallback)
+        if self.isClient:
+            # a lost tunnel is no error that spoils the session, frames
+            # cut short are noticed by the tunnel protocol anyway
+            ctx.set_options(SSL.OP_IGNORE_UNEXPECTED_EOF)
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        else:
+            # sessions of verified clients resume only within this id
+            ctx.set_session_id(b's54http')
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+            if self._ticket_rotate > 0:
+                ctx.set_timeout(self._ticket_rotate)
         self._ctx = ctx
+        self._created = time.monotonic()
+
+    def _infoCallback(self, conn, where, ret):
+        if where & SSL.SSL_CB_HANDSHAKE_DONE:
+            self._handshake(conn)
+
+    def rotate(self):
+        self._ctx = None
+        self.cacheContext()
+
+    def reload(self):
+        """
+        reads the key and certificates again for new handshakes, the old
+        context is kept when they are broken
+        """
+        ctx = self._ctx
+        self._ctx = None
+        try:
+            self.cacheContext()
+        except (OSError, SSL.Error) as e:
+            self._ctx = ctx
+            raise RuntimeError(f'reload certificates failed[{e}]')
 
     def __getstate__(self):
         state = self.__dict__.copy()
@@ -96,26 +209,396 @@ class SSLCtxFactory:
         self.__dict__ = state
 
     def getContext(self):
+        if (not self.isClient and self._ticket_rotate > 0 and
+                time.monotonic() - self._created > self._ticket_rotate):
+            self.rotate()
         return self._ctx
 
 
+@ZopeInterface.implementer(TwistedInterface.IOpenSSLClientConnectionCreator)
+class ClientTLS:
+    """
+    client connections to one server, every one offers the session of
+    the last one to skip the full handshake
+    """
+
+    __slots__ = [
+        'ctx_factory',
+        'session',
+    ]
+
+    def __init__(self, ctx_factory):
+        self.ctx_factory = ctx_factory
+        self.session = None
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        conn = SSL.Connection(self.ctx_factory.getContext(), None)
+        if self.session is not None:
+            conn.set_session(self.session)
+        return conn
+
+    def saveSession(self, conn):
+        session = conn.get_session()
+        if session is not None:
+            self.session = session
+
+    def keepSession(self, conn):
+        """
+        openssl spoils the session of a connection that was never shut
+        down, a lost tunnel isn't
+        """
+        conn.set_shutdown(conn.get_shutdown() | SSL.SENT_SHUTDOWN)
+
+
 class Cache(collections.OrderedDict):
 
     def __init__(self, limit=1024):
         super().__init__()
         self.limit = limit
 
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
     def __setitem__(self, key, value):
-        while len(self) >= self.limit:
-            self.popitem(last=False)
+        if key in self:
+            self.move_to_end(key)
+        else:
+            while len(self) >= self.limit:
+                self.popitem(last=False)
         super().__setitem__(key, value)
 
 
+DNS_MIN_TTL = 5
+DNS_MAX_TTL = 3600
+DNS_NEGATIVE_TTL = 30
+# seconds past its ttl an address may still be served once
+DNS_STALE_TTL = 60
+# seconds an address that failed to connect is tried last
+DNS_FAILED_TTL = 300
+DNS_CACHE_MAGIC = b'S5DC'
+DNS_CACHE_VERSION = 2
+_DNS_CACHE_HEADER = struct.Struct('!4sBI')
+_DNS_CACHE_RECORD = struct.Struct('!dIB')
+
+
+class DNSEntry:
+
+    __slots__ = [
+        'addresses',
+        'expires',
+        'stale',
+        'hits',
+        'error',
+    ]
+
+    def __init__(self, addresses, expires, hits=0, error=None):
+        # None marks a cached failure, error is the exception it failed with
+        self.addresses = addresses
+        self.expires = expires
+        self.stale = False
+        self.hits = hits
+        self.error = error
+
+
+class DNSCache:
+    """
+    lru of resolved addresses, every entry expires with its record ttl
+    clamped to [min_ttl, max_ttl]. failures are cached for negative_ttl.
+    an address just past its ttl is served once more as STALE, the
+    caller is expected to refresh it. addresses that failed to connect
+    are remembered per host and ordered last.
+    """
+
+    MISS = 0
+    HIT = 1
+    STALE = 2
+    NEGATIVE = 3
+
+    __slots__ = [
+        'limit',
+        'min_ttl',
+        'max_ttl',
+        'negative_ttl',
+        'stale_ttl',
+        'hits',
+        'misses',
+        'stale_hits',
+        'negative_hits',
+        'expired',
+        'evicted',
+        '_entries',
+        '_failed',
+    ]
+
+    def __init__(self, limit=1024, *,
+                 min_ttl=DNS_MIN_TTL,
+                 max_ttl=DNS_MAX_TTL,
+                 negative_ttl=DNS_NEGATIVE_TTL,
+                 stale_ttl=DNS_STALE_TTL):
+        self.limit = limit
+        self.min_ttl = min_ttl
+        self.max_ttl = max(min_ttl, max_ttl)
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.expired = 0
+        self.evicted = 0
+        self._entries = collections.OrderedDict()
+        self._failed = Cache(limit)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, host):
+        return host in self._entries
+
+    def get(self, host):
+        """
+        returns (state, addresses)
+        """
+        entries = self._entries
+        entry = entries.get(host)
+        if entry is None:
+            self.misses += 1
+            return self.MISS, None
+        now = time.monotonic()
+        if now < entry.expires:
+            entries.move_to_end(host)
+            if entry.addresses is None:
+                self.negative_hits += 1
+                return self.NEGATIVE, None
+            self.hits += 1
+            entry.hits += 1
+            return self.HIT, entry.addresses
+        if (entry.addresses is not None and not entry.stale and
+                now < entry.expires + self.stale_ttl):
+            entry.stale = True
+            entries.move_to_end(host)
+            self.stale_hits += 1
+            entry.hits += 1
+            return self.STALE, entry.addresses
+        del entries[host]
+        self.expired += 1
+        self.misses += 1
+        return self.MISS, None
+
+    def _put(self, host, addresses, ttl, hits=None, error=None):
+        entries = self._entries
+        entry = entries.pop(host, None)
+        if entry is None:
+            while len(entries) >= self.limit:
+                entries.popitem(last=False)
+                self.evicted += 1
+        if hits is None:
+            hits = 0 if entry is None else entry.hits
+        entries[host] = DNSEntry(
+            addresses,
+            time.monotonic() + ttl,
+            hits,
+            error
+        )
+
+    def put(self, host, addresses, ttl):
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        self._put(host, tuple(addresses), ttl)
+
+    def putNegative(self, host, error=None):
+        self._put(host, None, self.negative_ttl, error=error)
+
+    def pop(self, host):
+        self._entries.pop(host, None)
+
+    def ttl(self, host):
+        """
+        seconds left before the entry of host expires
+        """
+        entry = self._entries.get(host)
+        if entry is None:
+            return 0
+        return max(entry.expires - time.monotonic(), 0)
+
+    def error(self, host):
+        """
+        exception of the failure cached for host, None if unknown
+        """
+        entry = self._entries.get(host)
+        if entry is None:
+            return None
+        return entry.error
+
+    def markFailed(self, host, address):
+        failed = self._failed.get(host)
+        if failed is None:
+            failed = self._failed[host] = {}
+        failed[address] = time.monotonic()
+
+    def markConnected(self, host, address):
+        failed = self._failed.get(host)
+        if failed is not None:
+            failed.pop(address, None)
+
+    def order(self, host, addresses):
+        """
+        addresses that failed lately go last, the order is kept otherwise
+        """
+        failed = self._failed.get(host)
+        if not failed:
+            return list(addresses)
+        now = time.monotonic()
+        for address, when in list(failed.items()):
+            if now - when >= DNS_FAILED_TTL:
+                del failed[address]
+        return sorted(addresses, key=lambda address: address in failed)
+
+    def hottest(self, count):
+        entries = sorted(
+            self._entries.items(),
+            key=lambda item: item[1].hits,
+            reverse=True
+        )
+        return [host for host, _ in entries[:count]]
+
+    def dump(self, path):
+        """
+        addresses are saved least recently used first, failures are not.
+
+        +-------+---------+-------+
+        | MAGIC | VERSION | COUNT |
+        +-------+---------+-------+
+        |   4   |    1    |   4   |
+        +-------+---------+-------+
+
+        every record, EXPIRES in seconds since the epoch:
+        +----------+------+---------+------+-------+-----------+
+        | NAME_LEN | NAME | EXPIRES | HITS | COUNT | ADDRESSES |
+        +----------+------+---------+------+-------+-----------+
+        |    1     |      |    8    |   4  |   1   |           |
+        +----------+------+---------+------+-------+-----------+
+
+        every address, 4 bytes ipv4 or 16 bytes ipv6:
+        +-----+---------+
+        | LEN | ADDRESS |
+        +-----+---------+
+        |  1  |  4|16   |
+        +-----+---------+
+        """
+        wall = time.time() - time.monotonic()
+        records = []
+        count = 0
+        for host, entry in self._entries.items():
+            if entry.addresses is None:
+                continue
+            name = host.encode('utf-8')
+            if len(name) > 255:
+                continue
+            addresses = [
+                socket.inet_pton(
+                    socket.AF_INET6 if ':' in address else socket.AF_INET,
+                    address
+                )
+                for address in entry.addresses[:255]
+            ]
+            records.append(bytes((len(name),)))
+            records.append(name)
+            records.append(_DNS_CACHE_RECORD.pack(
+                entry.expires + wall,
+                min(entry.hits, 2**32 - 1),
+                len(addresses)
+            ))
+            for address in addresses:
+                records.append(bytes((len(address),)))
+                records.append(address)
+            count += 1
+        header = _DNS_CACHE_HEADER.pack(
+            DNS_CACHE_MAGIC,
+            DNS_CACHE_VERSION,
+            count
+        )
+        # workers save one file each in turn
+        temp = f'{path}.{os.getpid()}.tmp'
+        with open(temp, mode='wb') as fp:
+            fp.write(header)
+            fp.write(b''.join(records))
+        os.replace(temp, path)
+        return count
+
+    def load(self, path):
+        """
+        returns the names of the file hottest first, expired ones included,
+        only the unexpired are cached.
+        """
+        with open(path, mode='rb') as fp:
+            data = fp.read()
+        if len(data) < _DNS_CACHE_HEADER.size:
+            raise RuntimeError(f'{path} is not a dns cache file')
+        magic, version, count = _DNS_CACHE_HEADER.unpack_from(data)
+        if magic != DNS_CACHE_MAGIC or version != DNS_CACHE_VERSION:
+            raise RuntimeError(f'{path} is not a dns cache file')
+        now = time.time()
+        offset = _DNS_CACHE_HEADER.size
+        names = []
+        try:
+            for _ in range(count):
+                length = data[offset]
+                host = data[offset+1:offset+1+length].decode('utf-8')
+                offset += 1 + length
+                expires, hits, number = _DNS_CACHE_RECORD.unpack_from(
+                    data,
+                    offset
+                )
+                offset += _DNS_CACHE_RECORD.size
+                addresses = []
+                for _ in range(number):
+                    size = data[offset]
+                    address = data[offset+1:offset+1+size]
+                    offset += 1 + size
+                    addresses.append(socket.inet_ntop(
+                        socket.AF_INET6 if 16 == size else socket.AF_INET,
+                        address
+                    ))
+                names.append((hits, host))
+                if expires <= now:
+                    continue
+                self._put(host, tuple(addresses), expires - now, hits)
+        except (IndexError, ValueError, struct.error, UnicodeDecodeError):
+            raise RuntimeError(f'{path} is truncated')
+        names.sort(key=lambda item: item[0], reverse=True)
+        return [host for _, host in names]
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'negative_hits': self.negative_hits,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+
+def _remove_pidfile(pidfile, pid):
+    # an upgraded process has written its own pid over it
+    try:
+        with open(pidfile) as fp:
+            if fp.read().strip() != str(pid):
+                return
+        os.remove(pidfile)
+    except OSError:
+        pass
+
+
 def daemonize(pidfile, *,
               stdin='/dev/null',
               stdout='/dev/null',
-              stderr='/dev/null'):
-    if os.path.exists(pidfile):
+              stderr='/dev/null',
+              replace=False):
+    if os.path.exists(pidfile) and not replace:
         logging.getLogger(__name__).info('already running')
         raise SystemExit(1)
 
@@ -147,7 +630,7 @@ def daemonize(pidfile, *,
     with open(pidfile, 'w') as fp:
         print(os.getpid(), file=fp)
 
-    atexit.register(lambda: os.remove(pidfile))
+    atexit.register(_remove_pidfile, pidfile, os.getpid())
 
 
 def init_logger(config, logger):
@@ -169,7 +652,8 @@ def parse_args(config):
         'cert',
         'dhparam',
         'pidfile',
-        'logfile'
+        'logfile',
+        'dns_cache_file',
     ]
     FILE_ARGUMENT = [
         'ca',
@@ -221,7 +705,7 @@ def parse_args(config):
     parser.add_argument(
         "-S",
         dest="saddr",
-        help="server address"
+        help="server addresses[addr[:port],...]"
     )
     parser.add_argument(
         "-P",
@@ -247,16 +731,220 @@ def parse_args(config):
     parser.add_argument(
         "--dns",
         dest="dns",
-        help="dns server[addr:port|addr]"
+        help="dns servers[addr:port|[ipv6]:port|addr,...]"
+    )
+    parser.add_argument(
+        "--dns-race",
+        dest="dns_race",
+        type=int,
+        help="dns servers asked at once, others are asked when it is late"
+    )
+    parser.add_argument(
+        "--dns-cache",
+        dest="dns_cache",
+        type=int,
+        help="max number of cached dns names"
+    )
+    parser.add_argument(
+        "--dns-cache-file",
+        dest="dns_cache_file",
+        help="file the dns cache is saved to and loaded from"
+    )
+    parser.add_argument(
+        "--dns-cache-save",
+        dest="dns_cache_save",
+        type=int,
+        help="seconds between saves of the dns cache"
+    )
+    parser.add_argument(
+        "--dns-prefetch",
+        dest="dns_prefetch",
+        type=int,
+        help="resolve the N hottest saved names before serving"
+    )
+    parser.add_argument(
+        "--dns-min-ttl",
+        dest="dns_min_ttl",
+        type=int,
+        help="seconds a dns answer is cached at least"
+    )
+    parser.add_argument(
+        "--dns-max-ttl",
+        dest="dns_max_ttl",
+        type=int,
+        help="seconds a dns answer is cached at most"
+    )
+    parser.add_argument(
+        "--dns-negative-ttl",
+        dest="dns_negative_ttl",
+        type=int,
+        help="seconds a failed dns lookup is cached"
+    )
+    parser.add_argument(
+        "--dns-listen",
+        dest="dns_listen",
+        type=int,
+        help="port of the local dns server resolving through the tunnel"
+    )
+    parser.add_argument(
+        "--max-frame",
+        dest="max_frame",
+        type=int,
+        help="max tunnel frame length"
+    )
+    parser.add_argument(
+        "--tunnels",
+        dest="tunnels",
+        type=int,
+        help="number of tunnels kept open to server"
+    )
+    parser.add_argument(
+        "--max-tunnels",
+        dest="max_tunnels",
+        type=int,
+        help="grow tunnels up to this number under load"
+    )
+    parser.add_argument(
+        "--tunnel-streams",
+        dest="tunnel_streams",
+        type=int,
+        help="streams per tunnel before opening another one"
+    )
+    parser.add_argument(
+        "--tunnel-policy",
+        dest="tunnel_policy",
+        choices=['least-loaded', 'round-robin', 'fastest'],
+        help="how new streams are spread over tunnels"
+    )
+    parser.add_argument(
+        "--connect-reply",
+        dest="connect_reply",
+        choices=['early', 'strict'],
+        help="answer socks connects at once or once the server connected"
+    )
+    parser.add_argument(
+        "--window",
+        dest="window",
+        type=int,
+        help="receive window of every stream in bytes"
+    )
+    parser.add_argument(
+        "--max-chunk",
+        dest="max_chunk",
+        type=int,
+        help="max payload of one data frame"
+    )
+    parser.add_argument(
+        "--priority",
+        dest="priority",
+        help="stream priority by port[PORT[-PORT][=CLASS],...]"
+    )
+    parser.add_argument(
+        "--coalesce",
+        dest="coalesce",
+        type=int,
+        help="microseconds to coalesce tunnel writes, -1 disables"
+    )
+    parser.add_argument(
+        "--open-delay",
+        dest="open_delay",
+        type=int,
+        help="microseconds to wait for first data of a stream, -1 disables"
+    )
+    parser.add_argument(
+        "--fastopen",
+        dest="fastopen",
+        action="store_true",
+        help="tcp fast open to hosts of one address, off with strict replies"
+    )
+    parser.add_argument(
+        "--connect-delay",
+        dest="connect_delay",
+        type=int,
+        help="milliseconds before connecting the next address of a host"
+    )
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        type=int,
+        help="seconds streams of a lost tunnel wait for it, -1 disables"
+    )
+    parser.add_argument(
+        "--ciphers",
+        dest="ciphers",
+        choices=['auto', 'aesgcm', 'chacha20'],
+        help="preferred tls ciphers, auto picks aesgcm on cpus with aes"
+    )
+    parser.add_argument(
+        "--tls-min",
+        dest="tls_min",
+        choices=['1.2', '1.3'],
+        help="lowest tls version accepted"
+    )
+    parser.add_argument(
+        "--ticket-rotate",
+        dest="ticket_rotate",
+        type=int,
+        help="seconds before the tls ticket key is replaced, -1 never"
+    )
+    parser.add_argument(
+        "--ping",
+        dest="ping",
+        type=int,
+        help="seconds between tunnel pings, -1 disables"
+    )
+    parser.add_argument(
+        "--ping-misses",
+        dest="ping_misses",
+        type=int,
+        help="unanswered pings before a tunnel is taken for dead"
+    )
+    parser.add_argument(
+        "--pending-wait",
+        dest="pending_wait",
+        type=int,
+        help="seconds a new stream waits for a tunnel, -1 disables"
+    )
+    parser.add_argument(
+        "--pending-memory",
+        dest="pending_memory",
+        type=int,
+        help="bytes all streams waiting for a tunnel may buffer"
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        choices=ENGINES,
+        help="event loop, asyncio runs on uvloop when it is installed"
+    )
+    parser.add_argument(
+        "--drain",
+        dest="drain",
+        type=int,
+        help="seconds old tunnels and streams get after SIGUSR2 or SIGQUIT"
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        help="worker processes sharing the listen port"
+    )
+    parser.add_argument(
+        "--compress",
+        dest="compress",
+        help="compression codecs offered[zstd,lz4,zlib|none]"
     )
     args = parser.parse_args()
     for arg in config.keys():
         value = getattr(args, arg, None)
-        if not value:
+        # 0 is given to turn an option off, only a missing one is skipped
+        if value is None:
             continue
         config[arg] = value
     for arg in PATH_ARGUMENT:
-        value = config[arg]
+        value = config.get(arg)
+        if not value:
+            continue
         fp = pathlib.Path(value)
         config[arg] = str(fp.absolute())
         if fp.exists():
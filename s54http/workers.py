@@ -0,0 +1,304 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import importlib
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+
+from twisted.internet import (
+    defer as TwistedDefer,
+    error as TwistedError,
+    protocol as TwistedProtocol,
+    reactor,
+    task as TwistedTask,
+)
+from twisted.protocols import tls as TwistedTLS
+
+from s54http.upgrade import adopt_port
+from s54http.utils import init_logger
+
+
+__all__ = [
+    'listen_ssl',
+    'report_stats',
+    'WorkerPool',
+]
+
+
+logger = logging.getLogger(__name__)
+
+# pipe the workers write their stats to, one json object per line
+STATS_FD = 3
+# seconds between stats reports
+STATS_INTERVAL = 60
+# seconds before a crashed worker is started again, doubled while it
+# keeps crashing within STABLE_TIME seconds
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+STABLE_TIME = 10.0
+LISTEN_BACKLOG = 1024
+
+
+def listen_ssl(port, factory, ssl_ctx, interface, *,
+               reuseport=False,
+               fileno=None):
+    """
+    with reuseport every worker listens on its own socket of one port
+    and the kernel spreads the connections over them. fileno is a socket
+    listening already, handed over by an upgrade.
+    """
+    if fileno is not None:
+        return adopt_port(
+            fileno,
+            TwistedTLS.TLSMemoryBIOFactory(ssl_ctx, False, factory)
+        )
+    if not reuseport:
+        return reactor.listenSSL(
+            port,
+            factory,
+            ssl_ctx,
+            interface=interface
+        )
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('workers need SO_REUSEPORT')
+    family = socket.AF_INET6 if ':' in interface else socket.AF_INET
+    s = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind((interface, port))
+        s.listen(LISTEN_BACKLOG)
+        s.setblocking(False)
+        return reactor.adoptStreamPort(
+            s.fileno(),
+            family,
+            TwistedTLS.TLSMemoryBIOFactory(ssl_ctx, False, factory)
+        )
+    except OSError as e:
+        raise TwistedError.CannotListenError(interface, port, e)
+    finally:
+        # the adopted port has its own copy of the socket
+        s.close()
+
+
+def report_stats(stats):
+    """
+    sends stats() to the parent every STATS_INTERVAL seconds, the first
+    right away to tell it the worker is serving. a worker whose parent
+    is gone stops
+    """
+    parent = os.getppid()
+
+    def report():
+        if os.getppid() != parent:
+            logger.error('worker parent[%u] gone', parent)
+            reactor.stop()
+            return
+        line = json.dumps(stats()) + '\n'
+        try:
+            os.write(STATS_FD, line.encode('utf-8'))
+        except OSError as e:
+            logger.error('worker report stats failed[%s]', e)
+
+    TwistedTask.LoopingCall(report).start(STATS_INTERVAL, now=True)
+
+
+class WorkerProtocol(TwistedProtocol.ProcessProtocol):
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.pid = 0
+        self.buffer = b''
+
+    def connectionMade(self):
+        self.pid = self.transport.pid
+        message = {
+            'module': self.pool.module,
+            'config': dict(self.pool.config, worker=self.index),
+        }
+        self.transport.write(json.dumps(message).encode('utf-8'))
+        self.transport.closeStdin()
+
+    def childDataReceived(self, fd, data):
+        if STATS_FD != fd:
+            return
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b'\n')
+        for line in lines:
+            try:
+                stats = json.loads(line)
+            except ValueError:
+                logger.error('worker[%u] bad stats %r', self.index, line)
+                continue
+            self.pool.workerStats(self.index, stats)
+
+    def processEnded(self, reason):
+        self.pool.workerEnded(self.index, self.pid, reason)
+
+
+class WorkerPool:
+    """
+    runs `module`.serve(config) in `workers` processes, a worker that
+    exits is started again until the pool is stopped
+    """
+
+    __slots__ = [
+        'module',
+        'config',
+        'workers',
+        'processes',
+        'started',
+        'delays',
+        'stats',
+        'restarts',
+        'stopping',
+        '_serving',
+        '_ended',
+        '_timer',
+    ]
+
+    def __init__(self, module, config, workers):
+        self.module = module
+        self.config = dict(config, daemon=False, workers=1)
+        self.workers = workers
+        self.processes = {}
+        self.started = {}
+        self.delays = {}
+        self.stats = {}
+        self.restarts = 0
+        self.stopping = False
+        self._serving = []
+        self._ended = {}
+        self._timer = None
+
+    def start(self):
+        for index in range(1, self.workers + 1):
+            self.spawn(index)
+        self._timer = TwistedTask.LoopingCall(self.logStats)
+        self._timer.start(STATS_INTERVAL, now=False)
+
+    def spawn(self, index):
+        if self.stopping:
+            return
+        env = dict(os.environ)
+        # the worker imports s54http wherever the parent found it
+        env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+        process = reactor.spawnProcess(
+            WorkerProtocol(self, index),
+            sys.executable,
+            [sys.executable, '-m', 's54http.engine', __name__],
+            env=env,
+            childFDs={0: 'w', 1: 1, 2: 2, STATS_FD: 'r'}
+        )
+        self.processes[index] = process
+        self.started[index] = reactor.seconds()
+        logger.info('worker[%u] pid[%u] started', index, process.pid)
+
+    def whenServing(self):
+        """
+        fires once every worker has reported
+        """
+        d = TwistedDefer.Deferred()
+        self._serving.append(d)
+        self.checkServing()
+        return d
+
+    def checkServing(self):
+        if self._serving and len(self.stats) >= self.workers:
+            serving, self._serving = self._serving, []
+            for d in serving:
+                d.callback(None)
+
+    def workerStats(self, index, stats):
+        self.stats[index] = stats
+        self.checkServing()
+
+    def workerEnded(self, index, pid, reason):
+        self.processes.pop(index, None)
+        self.stats.pop(index, None)
+        ended = self._ended.pop(index, None)
+        if ended is not None:
+            ended.callback(None)
+        if self.stopping:
+            logger.info('worker[%u] pid[%u] stopped', index, pid)
+            return
+        delay = self.delays.get(index, RESTART_DELAY)
+        if reactor.seconds() - self.started.get(index, 0) > STABLE_TIME:
+            delay = RESTART_DELAY
+        self.delays[index] = min(delay * 2, MAX_RESTART_DELAY)
+        self.restarts += 1
+        logger.error(
+            'worker[%u] pid[%u] exited[%s], restart in %.0fs',
+            index,
+            pid,
+            reason.getErrorMessage(),
+            delay
+        )
+        reactor.callLater(delay, self.spawn, index)
+
+    def logStats(self):
+        total = {}
+        for stats in self.stats.values():
+            for key, value in stats.items():
+                if isinstance(value, int) and 'pid' != key:
+                    total[key] = total.get(key, 0) + value
+        logger.info(
+            'workers=%u/%u restarts=%u %s',
+            len(self.stats),
+            self.workers,
+            self.restarts,
+            ' '.join(f'{key}={value}' for key, value in sorted(total.items()))
+        )
+
+    def signalWorkers(self, signum):
+        for process in list(self.processes.values()):
+            try:
+                process.signalProcess(signum)
+            except TwistedError.ProcessExitedAlready:
+                pass
+
+    def drain(self):
+        """
+        the workers stop accepting and exit once their tunnels are done
+        """
+        self.stopping = True
+        self.signalWorkers(signal.SIGQUIT)
+
+    def stop(self):
+        self.stopping = True
+        if self._timer is not None and self._timer.running:
+            self._timer.stop()
+        ended = []
+        for index, process in list(self.processes.items()):
+            d = self._ended[index] = TwistedDefer.Deferred()
+            ended.append(d)
+            try:
+                process.signalProcess('TERM')
+            except TwistedError.ProcessExitedAlready:
+                pass
+        return TwistedDefer.DeferredList(ended)
+
+
+def main():
+    """
+    worker entry, reads {"module": ..., "config": {...}} from stdin
+    """
+    message = json.load(sys.stdin)
+    module = importlib.import_module(message['module'])
+    module.config.update(message['config'])
+    # the parent stops the workers, ctrl-c on a terminal too
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_logger(module.config, module.logger)
+    init_logger(module.config, logger)
+    init_logger(module.config, logging.getLogger('s54http.upgrade'))
+    module.serve(module.config)
+
+
+if __name__ == '__main__':
+    main()
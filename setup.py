@@ -17,11 +17,16 @@ setup(
         'service-identity',
         'Twisted',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'uvloop': ['uvloop'],
+    },
     python_requires=">=3.6",
     entry_points={
         'console_scripts': [
-            's5pproxy = s54http.proxy:main',
-            's5pserver = s54http.server:main',
+            's5pproxy = s54http.engine:proxy_main',
+            's5pserver = s54http.engine:server_main',
         ]
     }
 )